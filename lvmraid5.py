@@ -13,17 +13,59 @@
 # TODO: use "mdadm --wait" to wait for resync.
 
 import argparse
+import collections
+import contextlib
+import copy
+import errno
+import fnmatch
+import functools
+import glob
+import json
 import logging
+import logging.handlers
 import math
 import os
+import Queue
+import random
 import re
+import select
+import shutil
+import signal
+import socket
 import subprocess
 import sys
+import threading
 import time
 
-# TODO: move the non-standard imports to check_dependencies and give more
-# helpful errors.
-import pexpect
+# pexpect is imported on first use (see get_pexpect()), so that read-only
+# commands which never drive fdisk don't pay for the import.
+pexpect = None
+
+# Where resolved binary paths are cached between invocations.
+BINARY_CACHE_FILE = '/tmp/lvmraid5_binaries.json'
+
+# The debug log and fdisk session log, and how large they grow before being
+# rotated.
+LOG_FILE = '/tmp/lvmraid5.log'
+PEXPECT_LOG_FILE = '/tmp/lvmraid5_pexpect.log'
+LOG_MAX_BYTES = 10 * 1000 * 1000
+LOG_BACKUP_COUNT = 5
+
+# Everything is logged through this logger, which doesn't propagate, so that
+# a program using the library API keeps its own logging as it is.
+LOGGER_NAME = 'lvmraid5'
+
+
+def get_pexpect():
+    """Import pexpect on first use, with a helpful error if it's missing."""
+    global pexpect
+    if pexpect is None:
+        try:
+            import pexpect as pexpect_module
+        except ImportError:
+            check_critical(False, 'Missing dependency: the pexpect python module')
+        pexpect = pexpect_module
+    return pexpect
 
 
 def check_critical(condition, msg):
@@ -33,6 +75,21 @@ def check_critical(condition, msg):
         raise LvmRaidException(msg)
 
 
+def timed_phase(phase):
+    """Decorator attributing the time spent in a method to a phase.
+
+    See LvmRaidExec.phase().
+
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.lvmexec.phase(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def round_sigfigs(num, sig_figs, round_down, round_down_more):
     """Round to specified number of sigfigs."""
     assert(sig_figs != 0)
@@ -53,6 +110,206 @@ def round_sigfigs(num, sig_figs, round_down, round_down_more):
     return long(ret_val)
 
 
+def resolve_binaries(names, cache_file=BINARY_CACHE_FILE):
+    """Find binaries on the PATH without running them.
+
+    Returns a dictionary mapping each name to its full path, or None if it
+    can't be found.  Results are cached in a file, keyed on the binary's
+    modification time, so that the PATH is only searched again when a binary
+    is upgraded or removed.
+
+    """
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        cache = {}
+
+    paths = {}
+    cache_changed = False
+    for name in names:
+        # Use the cached path if the binary hasn't changed since.
+        entry = cache.get(name)
+        if entry is not None:
+            try:
+                if os.stat(entry[0]).st_mtime == entry[1]:
+                    paths[name] = entry[0]
+                    continue
+            except OSError:
+                pass
+
+        # Otherwise search the PATH.
+        paths[name] = None
+        cache.pop(name, None)
+        cache_changed = True
+        for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                paths[name] = path
+                cache[name] = [path, os.stat(path).st_mtime]
+                break
+
+    if cache_changed:
+        try:
+            with open(cache_file, 'w') as f:
+                json.dump(cache, f)
+        except IOError:
+            pass
+    return paths
+
+
+def parse_size(text):
+    """Parse a size such as 500GB or 4T into bytes.
+
+    Returns None if the text isn't a size.
+
+    """
+    m = re.match('^(?P<num>[0-9.]+)(?P<unit>[KMGT])B?$', text, re.IGNORECASE)
+    if m is None:
+        return None
+    units = {'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12}
+    return long(float(m.group('num')) * units[m.group('unit').upper()])
+
+
+def format_bytes(num):
+    """Format a number of bytes for humans."""
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(num) < 1000:
+            break
+        num /= 1000.0
+    else:
+        unit = 'PB'
+    return '{:.1f} {}'.format(num, unit)
+
+
+def median(values):
+    """The median of a non-empty list of numbers."""
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def format_duration(seconds):
+    """Format a duration for humans."""
+    if seconds is None:
+        return 'unknown'
+    seconds = int(seconds)
+    if seconds < 3600:
+        return '{}m {}s'.format(seconds // 60, seconds % 60)
+    return '{}h {}m'.format(seconds // 3600, (seconds % 3600) // 60)
+
+
+def parse_timeout(text):
+    """Parse a --timeout setting: NAME=SECONDS, or just SECONDS.
+
+    Returns (name, seconds), with a name of None for the default timeout and
+    seconds of None for no timeout.
+
+    """
+    name, _, seconds = text.rpartition('=')
+    try:
+        seconds = float(seconds)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid timeout: {}'.format(text))
+    return name or None, seconds or None
+
+
+def parse_chunk(text):
+    """Parse a --chunk setting: 'auto', or a power of two number of KiB."""
+    if text == 'auto':
+        return text
+    if not text.isdigit() or int(text) < 4 or int(text) & (int(text) - 1):
+        raise argparse.ArgumentTypeError(
+            "chunk size must be 'auto' or a power of two of at least 4: {}".format(text))
+    return int(text)
+
+
+def parse_size_argument(text):
+    """Parse a size given as an option (see parse_size())."""
+    size = parse_size(text)
+    if size is None:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(text))
+    return size
+
+
+def strip_option(args, option):
+    """Return a copy of a command line with an option (and its value) removed."""
+    stripped = []
+    skip_next = False
+    for arg in args:
+        if skip_next:
+            skip_next = False
+        elif arg == option:
+            skip_next = True
+        elif not arg.startswith(option + '='):
+            stripped.append(arg)
+    return stripped
+
+
+class MaintenanceWindow(object):
+    """The times of day (local time) when reshapes may run.
+
+    Written as HH:MM-HH:MM, eg. 01:00-05:00.  Several ranges can be given,
+    separated by commas, and a range can wrap past midnight (eg.
+    22:00-06:00).
+
+    """
+    range_re = re.compile('^(?P<start>[0-9]{1,2}:[0-9]{2})-(?P<end>[0-9]{1,2}:[0-9]{2})$')
+
+    def __init__(self, ranges):
+        self.ranges = ranges  # (start, end) in minutes past midnight.
+
+    @classmethod
+    def parse(cls, text):
+        """Parse a --window setting."""
+        def minutes(hhmm):
+            hours, mins = [int(val) for val in hhmm.split(':')]
+            if hours > 23 or mins > 59:
+                raise ValueError(hhmm)
+            return hours * 60 + mins
+
+        ranges = []
+        for part in text.split(','):
+            m = MaintenanceWindow.range_re.match(part.strip())
+            try:
+                if m is None:
+                    raise ValueError(part)
+                start, end = minutes(m.group('start')), minutes(m.group('end'))
+                if start == end:
+                    raise ValueError(part)
+            except ValueError:
+                raise argparse.ArgumentTypeError(
+                    'invalid maintenance window: {}'.format(text))
+            ranges.append((start, end))
+        return cls(ranges)
+
+    def __str__(self):
+        return ','.join('{:02}:{:02}-{:02}:{:02}'.format(
+            start // 60, start % 60, end // 60, end % 60) for start, end in self.ranges)
+
+    @staticmethod
+    def seconds_of_day(timestamp):
+        local = time.localtime(timestamp)
+        return local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec
+
+    def contains(self, timestamp):
+        """Whether reshapes may run at a given time."""
+        now = MaintenanceWindow.seconds_of_day(timestamp)
+        for start, end in self.ranges:
+            start, end = start * 60, end * 60
+            if (start <= now < end if start < end else now >= start or now < end):
+                return True
+        return False
+
+    def until_change(self, timestamp):
+        """Seconds from a time until the next time a range opens or closes."""
+        now = MaintenanceWindow.seconds_of_day(timestamp)
+        return min((minute * 60 - now) % 86400 or 86400
+                   for start_end in self.ranges for minute in start_end)
+
+
 class LvmRaidException(Exception):
     """Base class for exceptions in this module."""
     def __init__(self, msg):
@@ -62,12 +319,197 @@ class LvmRaidException(Exception):
         return self.msg
 
 
+class LvmRaidCancelled(LvmRaidException):
+    """Raised when a command is cancelled part way through."""
+
+
+class LvmRaidTimeout(LvmRaidException):
+    """Raised when an external command runs for longer than its timeout."""
+
+
+class LvmRaidDetached(LvmRaidException):
+    """Raised to leave a reshape running (or paused) in the background.
+
+    With --detach, commands exit rather than waiting for a reshape: the
+    journal is left for the resume command to carry on.
+
+    """
+
+
+class BackgroundLogHandler(logging.Handler):
+    """Hands log records to a background thread, which writes them.
+
+    Every line of command output is logged, so writing the log file on the
+    command's own thread would hold up the command.  Records are queued
+    instead, and passed to the target handler (eg. a file handler) by a
+    writer thread.  The queue is bounded: if the disk stalls, records are
+    dropped rather than holding up the command or eating memory, and a
+    record saying how many were dropped is logged once there's room.
+
+    """
+    QUEUE_SIZE = 10000
+
+    def __init__(self, target):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.queue = Queue.Queue(BackgroundLogHandler.QUEUE_SIZE)
+        self.dropped = 0  # Records dropped since the queue was last full.
+        self.thread = threading.Thread(target=self.write_records,
+                                       name='lvmraid5-log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def emit(self, record):
+        # Fill in the message now, while its arguments are current, but
+        # leave the formatting to the writer.
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord(dict(
+                    record.__dict__, levelno=logging.WARNING, levelname='WARNING',
+                    msg='({} log records dropped: the log fell behind)'.format(
+                        self.dropped))))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def write_records(self):
+        """Write queued records until a None is queued."""
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    return
+                self.target.handle(record)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait for the queued records to be written."""
+        if self.thread.is_alive():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        """Write the queued records and stop the writer.
+
+        Called by logging at exit.
+
+        """
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.target.close()
+        logging.Handler.close(self)
+
+
+class RotatingLogFile(object):
+    """A log file written by something other than logging (ie. pexpect).
+
+    It's rotated like the main log, by a RotatingFileHandler: once it would
+    grow beyond LOG_MAX_BYTES, it's moved aside to path.1, with up to
+    LOG_BACKUP_COUNT older logs kept.
+
+    """
+
+    def __init__(self, path):
+        self.handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+
+    def write(self, data):
+        stream = self.handler.stream
+        stream.seek(0, 2)
+        if stream.tell() > 0 and stream.tell() + len(data) > LOG_MAX_BYTES:
+            self.handler.doRollover()
+        self.handler.stream.write(data)
+
+    def flush(self):
+        self.handler.flush()
+
+    def close(self):
+        self.handler.close()
+
+
+class QueryCache(object):
+    """Results of read-only queries, kept until something changes them.
+
+    Discovery reads the same state over and over: eg. creating a partition
+    reads the drive's partition table before and after, and an array's
+    details are read again after every step.  Results are kept keyed on the
+    object's name and the source they came from (eg. ('/dev/sdb', 'fdisk')),
+    and the methods which change an object invalidate its results, so that
+    the next query goes back to the system.  State which changes by itself,
+    like sync progress, has to be invalidated by whoever polls it.
+
+    hits, misses and spawns_avoided (the processes not run thanks to a hit)
+    count how well it's doing.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        # Bumped by every invalidation, so that a query which was running
+        # at the time doesn't cache a result from before it.
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.spawns_avoided = 0
+
+    def get(self, name, source, query, spawns=1):
+        """Return a cached result, or run query() to get it.
+
+        spawns is the number of processes query() runs.  Exceptions are
+        passed on, and nothing cached.
+
+        """
+        key = (name, source)
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.spawns_avoided += spawns
+                return self.entries[key]
+            self.misses += 1
+            generation = self.generation
+        result = query()
+        with self.lock:
+            if self.generation == generation:
+                self.entries[key] = result
+        return result
+
+    def invalidate(self, names=(), sources=()):
+        """Forget the results for any of names, and from any of sources."""
+        with self.lock:
+            self.generation += 1
+            for key in list(self.entries):
+                if key[0] in names or key[1] in sources:
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries = {}
+
+    def summary(self):
+        return 'Query cache: {} hits, {} misses, {} process spawns avoided'.format(
+            self.hits, self.misses, self.spawns_avoided)
+
+
 class LvmRaidBaseClass(object):
     """Base class which all other classes inherit from.
 
     Used to provide logging function.
 
     """
+    dd_copied_re = re.compile(
+        '(?P<bytes>[0-9]+) bytes.* copied, (?P<seconds>[0-9.e+-]+) s')
 
     def __init__(self, lvmexec, name):
         """Provides common initialization function.
@@ -83,7 +525,7 @@ class LvmRaidBaseClass(object):
 
         # Configure a logger.
         self.logger_adapter = logging.LoggerAdapter(
-            logging.getLogger(''),
+            logging.getLogger(LOGGER_NAME),
             {'class_name': self.__class__.__name__,
              'instance_name': self.name})
 
@@ -102,24 +544,42 @@ class LvmRaidBaseClass(object):
     def log(self, msg, level=logging.DEBUG):
         self.logger_adapter.log(level, msg)
 
-    def run_cmd(self, cmd, prompt=True):
-        # Run the command.  TODO: capture output on failures.
-        output = ""
-        try:
-            if prompt:
-                self.maybe_prompt("""Running command '%s'""" % " ".join(cmd))
-            output = subprocess.check_output(cmd,
-                                             stderr=subprocess.STDOUT)
-            self.log("""Ran command '{}':\n{}""".format(cmd, output))
-        except subprocess.CalledProcessError:
-            self.log("""Command failed '{}':\n{}""".format(cmd, output))
-            raise
-        return output
+    def query(self, source, query):
+        """Run a read-only query of this object through the query cache."""
+        return self.lvmexec.query_cache.get(self.name, source, query)
+
+    def invalidate(self, *others):
+        """Forget the cached queries of this object, and of any others."""
+        self.lvmexec.query_cache.invalidate(
+            names=[self.name] + [other.name for other in others])
+
+    def invalidate_lvm(self):
+        """Forget the cached queries of every LV and VG.
+
+        Any LVM change can alter what others report (eg. a VG's free space
+        when its LV is extended), so LVM changes invalidate them all.
+
+        """
+        self.lvmexec.query_cache.invalidate(sources=('lvdisplay', 'vgdisplay'))
+
+    def run_cmd(self, cmd, prompt=True, retry=False, full_output=False):
+        """Run a command (see LvmRaidExec.run_cmd()), logging as this object."""
+        if prompt:
+            self.maybe_prompt("""Running command '%s'""" % " ".join(cmd))
+        return self.lvmexec.run_cmd(cmd, retry=retry, log=self.log,
+                                    full_output=full_output)
+
+    def run_dd(self, args):
+        """Run dd with the given arguments, returning its speed in bytes/s."""
+        output = self.run_cmd(['dd'] + args, prompt=False)
+        m = LvmRaidBaseClass.dd_copied_re.search(output)
+        check_critical(m is not None,
+                       'Unexpected output from dd on {}: {}'.format(self.name, output))
+        return long(m.group('bytes')) / max(float(m.group('seconds')), 1e-6)
 
     def spawn_pexpect(self, cmd):
-        return pexpect.spawn(cmd,
-                             timeout=5,
-                             logfile=file('/tmp/lvmraid5_pexpect.log', 'a'))
+        return self.lvmexec.backend.spawn(
+            cmd, timeout=self.lvmexec.timeout_for(cmd.split()[0]))
 
     def maybe_prompt(self, text):
         if self.lvmexec.args.prompt:
@@ -134,12 +594,19 @@ class HardDrive(LvmRaidBaseClass):
     fdisk_size_re = re.compile('Disk.*\,\s(?P<size>[0-9]+)\sbytes')
     fdisk_partition_list_re = re.compile(
         '(?P<name>\S*(?P<num>[0-9]+))\s+(?P<start>[0-9]+)\s+(?P<end>[0-9]+)\s+(?P<blocks>[0-9]+)\s+(?P<id>\S+).*')
+    # Throughput probes sample this many MiB at each of these fractions of
+    # the way across the drive, since speed varies from the outer tracks to
+    # the inner ones.
+    PROBE_OFFSETS = (0.02, 0.25, 0.5, 0.75, 0.98)
+    PROBE_SIZE_MB = 64
 
     def __init__(self, lvmexec, name):
         super(HardDrive, self).__init__(lvmexec, name)
         self.empty = False
+        self.rounded_size = None  # See size().
         self.partitions = {}  # Keys are the partition number.
 
+    @timed_phase('partitioning')
     def init_partitions(self):
         """Initializes the partition table on a new hard drive.
 
@@ -171,8 +638,10 @@ class HardDrive(LvmRaidBaseClass):
         fdisk.sendline('w')
 
         # Wait for exit.
-        fdisk.expect(pexpect.EOF)
+        fdisk.expect(self.lvmexec.backend.EOF)
+        self.invalidate()
 
+    @timed_phase('partitioning')
     def create_partition(self, size, allow_failure=False):
         """Create a partition.
 
@@ -225,9 +694,10 @@ class HardDrive(LvmRaidBaseClass):
             fdisk.sendline('q')
 
         # Wait for exit.
-        fdisk.expect(pexpect.EOF)
+        fdisk.expect(self.lvmexec.backend.EOF)
 
         # Refresh the drive info.
+        self.invalidate()
         self.get_info()
 
         return self.partitions.get(int(partition_num))
@@ -247,25 +717,16 @@ class HardDrive(LvmRaidBaseClass):
 
         return (self.size() - used_size)
 
+    @timed_phase('discovery')
     def get_info(self):
         """Extracts info for the hard drive."""
         self.log('Refreshing info')
-        # Spawn fdisk.  If this fails, that likely indicates the drive isn't
-        # present.
-        fdisk = self.spawn_fdisk()
-        index = fdisk.expect([HardDrive.fdisk_main_prompt_re,
-                             'fdisk: unable to open {}'.format(self.name)])
-        check_critical(index == 0,
-                       'Could not find hard drive {}'.format(self.name))
-
-        # Print the partition table.
-        fdisk.sendline('p')
-        fdisk.expect(HardDrive.fdisk_main_prompt_re)
-        output = fdisk.before
+        output = self.query('fdisk', self.read_partition_table)
 
         # Get the hard drive size.
         self.size_in_bytes = long(
             HardDrive.fdisk_size_re.search(output).group('size'))
+        self.rounded_size = None
 
         # Spin through the returned partitions, creating objects for them.
         self.empty = True
@@ -280,11 +741,27 @@ class HardDrive(LvmRaidBaseClass):
                 part.num_blocks = long(groups[4])
                 self.partitions[int(groups[1])] = part
 
+    def read_partition_table(self):
+        """Print the partition table with fdisk, returning the output."""
+        # Spawn fdisk.  If this fails, that likely indicates the drive isn't
+        # present.
+        fdisk = self.spawn_fdisk()
+        index = fdisk.expect([HardDrive.fdisk_main_prompt_re,
+                             'fdisk: unable to open {}'.format(self.name)])
+        check_critical(index == 0,
+                       'Could not find hard drive {}'.format(self.name))
+
+        # Print the partition table.
+        fdisk.sendline('p')
+        fdisk.expect(HardDrive.fdisk_main_prompt_re)
+        output = fdisk.before
+
         # Quit
         fdisk.sendline('q')
 
         # Wait for exit.
-        fdisk.expect(pexpect.EOF)
+        fdisk.expect(self.lvmexec.backend.EOF)
+        return output
 
     def size(self):
         """Returns the rounded size of the drive (in bytes).
@@ -292,11 +769,61 @@ class HardDrive(LvmRaidBaseClass):
         Round down two significant figures.
 
         """
-        return round_sigfigs(self.size_in_bytes, 2, round_down=False, round_down_more=True)
+        if self.rounded_size is None:
+            self.rounded_size = round_sigfigs(self.size_in_bytes, 2, round_down=False,
+                                              round_down_more=True)
+        return self.rounded_size
 
     def spawn_fdisk(self):
         return self.spawn_pexpect('fdisk {}'.format(self.name))
 
+    def signature(self):
+        """Returns the type of any filesystem, RAID or LVM signature found on
+        the drive itself (rather than a partition), or None.
+
+        """
+        try:
+            found = self.run_cmd(['blkid', '-p', '-o', 'value', '-s', 'TYPE',
+                                  self.name], prompt=False).strip()
+        except subprocess.CalledProcessError:
+            # blkid exits with 2 if it finds nothing.
+            return None
+        return found or None
+
+    def blank(self):
+        """Whether the drive has no partitions and no whole-drive signature."""
+        return self.empty and self.signature() is None
+
+    def probe_throughput(self, write=False):
+        """Measure the drive's sequential throughput with dd.
+
+        Returns a dictionary of the median read and write speeds in bytes/s
+        across the sampled offsets.  Writing is only allowed on a blank
+        drive (see blank()), as it overwrites the samples; otherwise the
+        write speed is None.
+
+        """
+        check_critical(not write or self.blank(),
+                       'Not write testing {}: it has partitions or data on it.'
+                       .format(self.name))
+        mb = 1024 * 1024
+        last_offset = self.size_in_bytes // mb - HardDrive.PROBE_SIZE_MB
+        speeds = {'read': [], 'write': []}
+        for fraction in HardDrive.PROBE_OFFSETS:
+            # Skip the first MiB, where a partition table would go.
+            offset = max(1, int(fraction * last_offset))
+            count = 'count={}'.format(HardDrive.PROBE_SIZE_MB)
+            speeds['read'].append(self.run_dd(
+                ['if={}'.format(self.name), 'of=/dev/null', 'bs=1M', count,
+                 'skip={}'.format(offset), 'iflag=direct']))
+            if write:
+                speeds['write'].append(self.run_dd(
+                    ['if=/dev/zero', 'of={}'.format(self.name), 'bs=1M', count,
+                     'seek={}'.format(offset), 'oflag=direct', 'conv=notrunc']))
+        self.log('Throughput samples: {}'.format(speeds))
+        return {'read': median(speeds['read']),
+                'write': median(speeds['write']) if write else None}
+
 
 class Partition(LvmRaidBaseClass):
     """Represents a partition.
@@ -304,7 +831,9 @@ class Partition(LvmRaidBaseClass):
     This is hung off both the RaidArray class, and the HardDrive class.
 
     """
-    drive_name_re = re.compile('^(?P<name>[^0-9]+)[0-9]+')
+    # Partitions of drives whose names end in a digit (loop devices, NVMe)
+    # have a 'p' before the partition number.
+    drive_name_re = re.compile('^(?P<name>.*[0-9](?=p[0-9]+$)|[^0-9]+)')
     raid_array_name_re = re.compile('')
 
     def __init__(self, lvmexec, name):
@@ -314,6 +843,7 @@ class Partition(LvmRaidBaseClass):
         self.drive = None  # The HardDrive this member is part of.
         self.num_blocks = 0
 
+    @timed_phase('discovery')
     def get_info(self):
         """Check whether the partition is part of a raid array.
 
@@ -326,10 +856,9 @@ class Partition(LvmRaidBaseClass):
 
         # Run suitable mdadm command.
         try:
-            self.run_cmd(['mdadm',
-                          '--examine',
-                          self.name],
-                         prompt=False)
+            self.query('mdadm --examine',
+                       lambda: self.run_cmd(['mdadm', '--examine', self.name],
+                                            prompt=False, full_output=True))
             # array_name = Partition.raid_array_name_re.search(output).group[0]
             # self.array = RaidArray.find_or_create(array_name)
         except subprocess.CalledProcessError:
@@ -355,6 +884,7 @@ class LogicalVolume(LvmRaidBaseClass):
                                                       self.size,
                                                       self.vg)
 
+    @timed_phase('lvm')
     def create(self, vg):
         """Create a logical volume, consuming the entire given VG."""
         # Create the LV.
@@ -366,8 +896,10 @@ class LogicalVolume(LvmRaidBaseClass):
                       vg.name])
 
         # Get info.
+        self.invalidate_lvm()
         self.get_info()
 
+    @timed_phase('lvm')
     def extend(self):
         """Extend the LV, filling all available space on its VG."""
         # Extend the LV.
@@ -376,8 +908,10 @@ class LogicalVolume(LvmRaidBaseClass):
                       self.name])
 
         # Get LV info.
+        self.invalidate_lvm()
         self.get_info()
 
+    @timed_phase('discovery')
     def get_info(self):
         """Refresh the info for the LV.
 
@@ -386,7 +920,9 @@ class LogicalVolume(LvmRaidBaseClass):
 
         """
         try:
-            output = self.run_cmd(["lvdisplay", self.name, "--units", "G"], prompt=False)
+            output = self.query('lvdisplay', lambda: self.run_cmd(
+                ["lvdisplay", self.name, "--units", "G"], prompt=False,
+                full_output=True))
             self.size = LogicalVolume.lv_size_re.search(output).group('size')
             m = LogicalVolume.vg_name_re.search(output)
             self.vg = self.find_or_create(VolumeGroup, m.group('name'))
@@ -397,6 +933,144 @@ class LogicalVolume(LvmRaidBaseClass):
         self.vg.wait_for_resync_complete()
 
 
+class Filesystem(LvmRaidBaseClass):
+    """The filesystem on a logical volume, named after the LV.
+
+    Only ext2/3/4 and XFS are supported: both can be grown while mounted, and
+    told the stripe geometry of the RAID beneath them so that they allocate
+    in whole stripes.
+
+    """
+    # The tools needed to grow and tune each type of filesystem.
+    BINARIES = {'ext2': ['resize2fs', 'tune2fs', 'e2fsck'],
+                'ext3': ['resize2fs', 'tune2fs', 'e2fsck'],
+                'ext4': ['resize2fs', 'tune2fs', 'e2fsck'],
+                'xfs': ['xfs_growfs', 'xfs_info']}
+
+    ext_block_size_re = re.compile('^Block size:\s*(?P<value>[0-9]+)', re.MULTILINE)
+    ext_block_count_re = re.compile('^Block count:\s*(?P<value>[0-9]+)', re.MULTILINE)
+    ext_stride_re = re.compile('^RAID stride:\s*(?P<value>[0-9]+)', re.MULTILINE)
+    ext_stripe_width_re = re.compile('^RAID stripe width:\s*(?P<value>[0-9]+)',
+                                     re.MULTILINE)
+    xfs_data_re = re.compile('^data\s*=\s*bsize=(?P<bsize>[0-9]+)\s+blocks=(?P<blocks>[0-9]+)',
+                             re.MULTILINE)
+    xfs_stripe_re = re.compile('sunit=(?P<sunit>[0-9]+)\s+swidth=(?P<swidth>[0-9]+) blks')
+
+    def __init__(self, lvmexec, name):
+        super(Filesystem, self).__init__(lvmexec, name)
+        self.name = name
+        self.fs_type = None
+        self.mountpoint = None
+        self.block_size = None
+        self.size = None  # Bytes.
+        self.stripe_unit = None  # Blocks, 0 if not set.
+        self.stripe_width = None  # Blocks, 0 if not set.
+
+    def is_ext(self):
+        return self.fs_type in ('ext2', 'ext3', 'ext4')
+
+    @timed_phase('discovery')
+    def get_info(self):
+        """Refresh the info for the filesystem.
+
+        There may be no filesystem, or it may not be mounted, so cope with
+        blkid and findmnt returning unsuccessfully.
+
+        """
+        self.fs_type = None
+        self.mountpoint = None
+        self.block_size = None
+        self.size = None
+        self.stripe_unit = None
+        self.stripe_width = None
+        try:
+            self.fs_type = self.run_cmd(['blkid', '-o', 'value', '-s', 'TYPE',
+                                         self.name], prompt=False).strip() or None
+        except subprocess.CalledProcessError:
+            return
+        try:
+            self.mountpoint = self.run_cmd(['findmnt', '-n', '-o', 'TARGET',
+                                            '--source', self.name],
+                                           prompt=False).split('\n')[0].strip() or None
+        except subprocess.CalledProcessError:
+            pass
+
+        if self.is_ext():
+            output = self.run_cmd(['tune2fs', '-l', self.name], prompt=False,
+                                  full_output=True)
+            self.block_size = int(
+                Filesystem.ext_block_size_re.search(output).group('value'))
+            self.size = long(Filesystem.ext_block_count_re.search(
+                output).group('value')) * self.block_size
+            m = Filesystem.ext_stride_re.search(output)
+            self.stripe_unit = int(m.group('value')) if m else 0
+            m = Filesystem.ext_stripe_width_re.search(output)
+            self.stripe_width = int(m.group('value')) if m else 0
+        elif self.fs_type == 'xfs' and self.mountpoint is not None:
+            # xfs_info only reliably takes a mount point.
+            output = self.run_cmd(['xfs_info', self.mountpoint], prompt=False,
+                                  full_output=True)
+            m = Filesystem.xfs_data_re.search(output)
+            self.block_size = int(m.group('bsize'))
+            self.size = long(m.group('blocks')) * self.block_size
+            m = Filesystem.xfs_stripe_re.search(output)
+            self.stripe_unit = int(m.group('sunit'))
+            self.stripe_width = int(m.group('swidth'))
+
+    @timed_phase('lvm')
+    def grow(self):
+        """Grow the filesystem to fill its LV.
+
+        Mounted filesystems are grown online.  An unmounted ext filesystem
+        has to be checked first; XFS can only be grown while mounted.
+
+        """
+        if self.is_ext():
+            if self.mountpoint is None:
+                self.run_cmd(['e2fsck', '-f', '-p', self.name])
+            self.run_cmd(['resize2fs', self.name])
+        else:
+            check_critical(self.mountpoint is not None,
+                           'XFS on {} can only be grown while mounted.'.format(self.name))
+            self.run_cmd(['xfs_growfs', self.mountpoint])
+        self.get_info()
+
+    @timed_phase('lvm')
+    def set_stripe_geometry(self, unit, width):
+        """Tell the filesystem the stripe unit and width, in bytes.
+
+        Returns whether the new geometry took effect.  XFS only takes a new
+        geometry as mount options, so for XFS this just says what to mount it
+        with.
+
+        """
+        if self.is_ext():
+            self.run_cmd(['tune2fs', '-E', 'stride={},stripe_width={}'.format(
+                unit // self.block_size, width // self.block_size), self.name])
+            self.get_info()
+            return True
+        self.log("""XFS only takes a new stripe geometry when mounted: mount {}
+                 with -o sunit={},swidth={} to apply it.""".format(
+                     self.name, unit // 512, width // 512), logging.WARNING)
+        return False
+
+    def describe_geometry(self, unit=None, width=None):
+        """Describe a stripe geometry in the filesystem's own terms.
+
+        The unit and width are in bytes, defaulting to the current geometry.
+
+        """
+        if unit is None:
+            unit = self.stripe_unit * self.block_size
+            width = self.stripe_width * self.block_size
+        if not unit:
+            return 'none'
+        names = ('stride', 'stripe_width') if self.is_ext() else ('sunit', 'swidth')
+        return '{}={}, {}={} ({}K unit, {}K stripe)'.format(
+            names[0], unit // self.block_size, names[1], width // self.block_size,
+            unit // 1024, width // 1024)
+
+
 class VolumeGroup(LvmRaidBaseClass):
     pv_name_re = re.compile('^\s*PV\sName\s+(?P<name>[^\s]+)', re.MULTILINE)
 
@@ -411,11 +1085,22 @@ class VolumeGroup(LvmRaidBaseClass):
             ret_str += "\n{}".format(pv)
         return ret_str
 
+    @timed_phase('lvm')
     def create(self, pvs):
         """Creates a VG from a list of PVs."""
         self.run_cmd(['vgcreate', self.name] + [pv.name for pv in pvs])
 
         # Now populate internal fields.
+        self.invalidate_lvm()
+        self.get_info()
+
+    @timed_phase('lvm')
+    def reduce(self, pv):
+        """Take a PV holding no data out of the VG, and wipe its label."""
+        self.run_cmd(['vgreduce', self.name, pv.name])
+        self.run_cmd(['pvremove', pv.name])
+        self.pvs.pop(pv.name, None)
+        self.invalidate_lvm()
         self.get_info()
 
     def drives(self):
@@ -427,6 +1112,7 @@ class VolumeGroup(LvmRaidBaseClass):
                     drives[member.drive.name] = member.drive
         return drives
 
+    @timed_phase('lvm')
     def extend(self, pv):
         """Extend the volume group by adding a new PV to it."""
         # Extend the VG.
@@ -435,8 +1121,10 @@ class VolumeGroup(LvmRaidBaseClass):
                       pv.name])
 
         # Refresh VG info.
+        self.invalidate_lvm()
         self.get_info()
 
+    @timed_phase('discovery')
     def get_info(self):
         """Get the info for this VG.
 
@@ -445,7 +1133,9 @@ class VolumeGroup(LvmRaidBaseClass):
 
         """
         try:
-            output = self.run_cmd(["vgdisplay", self.name, "--verbose"], prompt=False)
+            output = self.query('vgdisplay', lambda: self.run_cmd(
+                ["vgdisplay", self.name, "--verbose"], prompt=False,
+                full_output=True))
             m = VolumeGroup.pv_name_re.findall(output)
             for name in m:
                 self.pvs[name] = self.find_or_create(PhysicalVolume, name)
@@ -453,8 +1143,9 @@ class VolumeGroup(LvmRaidBaseClass):
             pass
 
     def wait_for_resync_complete(self):
-        for pv in self.pvs.values():
-            pv.wait_for_resync_complete()
+        """Wait for all the VG's arrays, polling them concurrently."""
+        self.lvmexec.run_parallel([pv.wait_for_resync_complete
+                                   for pv in self.pvs.values()])
 
 
 class PhysicalVolume(LvmRaidBaseClass):
@@ -467,19 +1158,25 @@ class PhysicalVolume(LvmRaidBaseClass):
     def print_details(self):
         return "   \--Physical Volume {}".format(self.name)
 
+    @timed_phase('lvm')
     def create(self):
         """Create a PV on the device with the PV's name."""
-        # Nice and easy, just call pvcreate.
-        self.run_cmd(['pvcreate', self.name])
+        # Nice and easy, just call pvcreate.  The array's device node may
+        # not have appeared yet.
+        self.run_cmd(['pvcreate', self.name], retry=True)
+        self.invalidate_lvm()
 
+    @timed_phase('discovery')
     def get_info(self):
         if self.raid_array is None:
             self.raid_array = "Creating"
             self.raid_array = self.find_or_create(RaidArray, self.name)
 
+    @timed_phase('lvm')
     def grow(self):
         # Grow the PV.
         self.run_cmd(['pvresize', self.name])
+        self.invalidate_lvm()
 
         # And refresh the PV information
         self.get_info()
@@ -494,17 +1191,35 @@ class RaidArray(LvmRaidBaseClass):
     state_re = re.compile('State\s*\:\s*(?P<state>.*)$', re.MULTILINE)
     rebuild_percentage_re = re.compile(
         'Rebuild\sStatus[^0-9]*(?P<percentage>[0-9]+)', re.MULTILINE)
+    chunk_size_re = re.compile('Chunk\sSize\s*\:\s*(?P<size>[0-9]+)K')
+    level_re = re.compile('Raid\sLevel\s*\:\s*raid(?P<level>[0-9]+)')
+    array_size_re = re.compile('Array\sSize\s*\:\s*(?P<size>[0-9]+)')
+    uuid_re = re.compile('^\s*UUID\s*\:\s*(?P<uuid>\S+)', re.MULTILINE)
+    md_name_re = re.compile('^\s*Name\s*\:\s*(?P<name>\S+)', re.MULTILINE)
+    version_re = re.compile('^\s*Version\s*\:\s*(?P<version>\S+)', re.MULTILINE)
     ARRAY_STATE_CLEAN = 'clean'
     ARRAY_STATE_RECOVERING = 'clean, degraded, recovering'
+    ARRAY_STATE_RESYNCING = 'clean, resyncing'
     ARRAY_STATE_RESHAPING = 'clean, reshaping'
+    ARRAY_STATE_CHECKING = 'clean, checking'
+
+    # Benchmarks of scratch arrays (see benchmark()): MiB copied
+    # sequentially, and the number and size in KiB of random reads.
+    BENCHMARK_SEQUENTIAL_MB = 256
+    BENCHMARK_RANDOM_READS = 32
+    BENCHMARK_RANDOM_KB = 64
+
+    # md's sync_speed_min (KiB/s) for rebuilds at high priority: its default
+    # sync_speed_max, so that other I/O doesn't slow them down.
+    HIGH_PRIORITY_SPEED = 200000
 
     @classmethod
-    def next_free_name(cls):
+    def next_free_name(cls, lvmexec):
         """Return the next available name for a raid array."""
         ii = 0
         while True:
             name = '/dev/md{}'.format(ii)
-            if not os.path.exists(name):
+            if not lvmexec.backend.exists(name):
                 return name
             ii += 1
 
@@ -525,23 +1240,54 @@ class RaidArray(LvmRaidBaseClass):
         for device in self.devices.values():
             ret_str += '{}\n'.format(device)
 
-    def create(self, members):
-        """Create a new RAID5 array."""
-        self.log('Creating RAID5 array with members {}'.format(members))
+    @staticmethod
+    def level_for(num_members):
+        """The RAID level of a new array with this many members.
+
+        Two members are mirrored: that has the same redundancy and capacity as
+        a two member RAID5, without the parity calculations, and reads can be
+        spread over both members.  It's converted to RAID5 when it grows (see
+        grow()).
+
+        """
+        return 1 if num_members == 2 else 5
+
+    @timed_phase('md')
+    def create(self, members, chunk=None, assume_clean=False, level=None):
+        """Create a new array: RAID1 for two members, otherwise RAID5.
+
+        chunk is the chunk size in KiB (default: mdadm's), which doesn't
+        apply to RAID1.  level overrides the RAID level.  An array created
+        with assume_clean isn't resynced, so its parity is garbage: only do
+        this for scratch arrays, or arrays holding no data which are then
+        repaired (see start_repair()).
+
+        """
+        level = level or RaidArray.level_for(len(members))
+        self.log('Creating RAID{} array with members {}'.format(level, members))
 
         # TODO: check the array doesn't exist.
 
         # Create the array.  This will resync in the background.
+        options = []
+        if chunk is not None and level != 1:
+            options.append('--chunk={}'.format(chunk))
+        if assume_clean:
+            options += ['--assume-clean', '--run']
         self.run_cmd(['mdadm',
                       '--create',
                       self.name,
-                      '--level=5',
+                      '--level={}'.format(level),
                       '--raid-devices={}'.format(len(members))] +
-                     [part.name for part in members])
+                     options +
+                     [part.name for part in members],
+                     retry=True)
 
         # Refresh array info.
+        self.invalidate(*members)
         self.get_info()
 
+    @timed_phase('discovery')
     def get_info(self):
         # Initialize fields.
         if self.pv is None:
@@ -550,15 +1296,35 @@ class RaidArray(LvmRaidBaseClass):
         self.devices = {}
         self.state = None
         self.op_percentage_completion = None
+        self.chunk = None  # KiB.
+        self.level = None
+        self.array_size = None  # Bytes.
+        self.member_size = None  # Bytes, see members_size().
+        self.uuid = None
+        self.md_name = None  # The name in the superblock, eg. host:0.
+        self.metadata = None  # The superblock version, eg. 1.2.
 
         # Get the info.
         try:
-            output = self.run_cmd(["mdadm", "--detail", self.name], prompt=False)
+            output = self.query('mdadm --detail', lambda: self.run_cmd(
+                ["mdadm", "--detail", self.name], prompt=False, full_output=True))
             for groups in RaidArray.members_re.findall(output):
                 self.members[groups[1]] = self.find_or_create(Partition, groups[1])
             # self.device_size = RaidArray.device_size_re.search(output).group('size')
             self.state = RaidArray.state_re.search(output).group('state').strip()
             self.log("Array state {}".format(self.state))
+            m = RaidArray.chunk_size_re.search(output)
+            self.chunk = int(m.group('size')) if m else None
+            m = RaidArray.level_re.search(output)
+            self.level = int(m.group('level')) if m else None
+            self.array_size = long(
+                RaidArray.array_size_re.search(output).group('size')) * 1024
+            m = RaidArray.uuid_re.search(output)
+            self.uuid = m.group('uuid') if m else None
+            m = RaidArray.md_name_re.search(output)
+            self.md_name = m.group('name') if m else None
+            m = RaidArray.version_re.search(output)
+            self.metadata = m.group('version') if m else None
             if self.state == RaidArray.ARRAY_STATE_RECOVERING:
                 self.op_percentage_completion = RaidArray.rebuild_percentage_re.search(output).group('percentage').strip()
                 self.log("Rebuild percentage {}".format(self.op_percentage_completion))
@@ -569,19 +1335,57 @@ class RaidArray(LvmRaidBaseClass):
             # perfectly valid.
             pass
 
-    def add(self, new_partition):
+    @timed_phase('md')
+    def add(self, new_partition, high_priority=False):
         """Add a drive to the array."""
         assert(new_partition.array is None)
         self.run_cmd(['mdadm',
                       self.name,
                       '--add',
-                      new_partition.name])
+                      new_partition.name],
+                     retry=True)
+        self.invalidate(new_partition)
 
         # Wait for async completion.
-        self.wait_for_resync_complete()
+        self.wait_for_rebuild(high_priority)
+
+    def wait_for_rebuild(self, high_priority=False):
+        """Wait for a rebuild onto a new member.
+
+        At high priority md keeps the rebuild at full speed, rather than
+        letting it slow to sync_speed_min when there's other I/O.
 
-    def grow(self, backup_file):
-        """Grow the array onto an already added spare partition."""
+        """
+        if not high_priority:
+            self.wait_for_resync_complete()
+            return
+        self.lvmexec.write_sysfs(self.md_attr('sync_speed_min'),
+                                 RaidArray.HIGH_PRIORITY_SPEED)
+        try:
+            self.wait_for_resync_complete()
+        finally:
+            self.lvmexec.write_sysfs(self.md_attr('sync_speed_min'), 'system')
+
+    def start_repair(self):
+        """Have md rewrite the parity of the whole array, in the background."""
+        if self.lvmexec.read_sysfs(self.md_attr('sync_action')) == 'idle':
+            self.lvmexec.write_sysfs(self.md_attr('sync_action'), 'repair')
+        self.invalidate()
+
+    @timed_phase('md')
+    def grow(self, backup_file, chunk=None):
+        """Grow the array onto an already added spare partition.
+
+        A two member RAID1 is first converted to RAID5 in place, which is
+        immediate since their layouts are the same.  chunk is a chunk size in
+        KiB to reshape to at the same time, if given and md allows it (the
+        array's size must be a multiple of it).
+
+        """
+        if self.level == 1:
+            self.log('Converting {} to RAID5'.format(self.name), logging.INFO)
+            self.run_cmd(['mdadm', self.name, '--grow', '--level=5'])
+            self.refresh()
 
         # Grow the array.  Note that the info for this array has been refreshed
         # since the add, so the new drive is already included in the member
@@ -590,21 +1394,72 @@ class RaidArray(LvmRaidBaseClass):
                       self.name,
                       '--grow',
                       '--raid-devices={}'.format(len(self.members)),
-                      '--backup-file={}'.format(backup_file)])
+                      '--backup-file={}'.format(backup_file)] +
+                     (['--chunk={}'.format(chunk)]
+                      if chunk not in (None, self.chunk) and
+                      self.array_size % (chunk * 1024) == 0 else []))
+        self.invalidate()
 
         # Wait for async completion.
         self.wait_for_resync_complete()
 
+    @timed_phase('md')
+    def stop(self):
+        """Stop the array, and wipe the md superblocks from its members."""
+        self.run_cmd(['mdadm', '--stop', self.name])
+        for member in self.members.values():
+            self.run_cmd(['mdadm', '--zero-superblock', member.name])
+        self.invalidate(*self.members.values())
+        self.members = {}
+        self.get_info()
+
+    def benchmark(self):
+        """Measure the array's sequential and random throughput with dd.
+
+        Returns a dictionary of speeds in bytes/s.  This overwrites the start
+        of the array, so is only for scratch arrays.
+
+        """
+        count = 'count={}'.format(RaidArray.BENCHMARK_SEQUENTIAL_MB)
+        speeds = {
+            'write': self.run_dd(['if=/dev/zero', 'of={}'.format(self.name),
+                                  'bs=1M', count, 'oflag=direct',
+                                  'conv=notrunc']),
+            'read': self.run_dd(['if={}'.format(self.name), 'of=/dev/null',
+                                 'bs=1M', count, 'iflag=direct'])}
+
+        # Random reads, at the same offsets for every array.
+        blocks = self.array_size // (RaidArray.BENCHMARK_RANDOM_KB * 1024)
+        offsets = random.Random(0)
+        seconds = 0
+        for _ in range(RaidArray.BENCHMARK_RANDOM_READS):
+            speed = self.run_dd(['if={}'.format(self.name), 'of=/dev/null',
+                                 'bs={}K'.format(RaidArray.BENCHMARK_RANDOM_KB),
+                                 'count=1',
+                                 'skip={}'.format(offsets.randrange(blocks)),
+                                 'iflag=direct'])
+            seconds += RaidArray.BENCHMARK_RANDOM_KB * 1024 / speed
+        speeds['random'] = (RaidArray.BENCHMARK_RANDOM_READS *
+                            RaidArray.BENCHMARK_RANDOM_KB * 1024 / seconds)
+        self.log('Benchmark with {}K chunks: {}'.format(self.chunk, speeds))
+        return speeds
+
     def is_clean(self):
         return (self.state == RaidArray.ARRAY_STATE_CLEAN)
 
     def members_size(self):
-        size = None
-        for part in self.members.values():
-            assert((size is None) or (size == part.size()))
-            size = part.size()
-        return size
+        if self.member_size is None:
+            for part in self.members.values():
+                assert((self.member_size is None) or (self.member_size == part.size()))
+                self.member_size = part.size()
+        return self.member_size
+
+    def refresh(self):
+        """Refresh the info, which may have changed by itself (eg. a sync)."""
+        self.invalidate()
+        self.get_info()
 
+    @timed_phase('md')
     def remove_member(self, member):
         """"Remove a given member from an array.
 
@@ -625,89 +1480,4255 @@ class RaidArray(LvmRaidBaseClass):
                       member.name])
 
         # Refresh info
+        self.invalidate(member)
         self.get_info()
 
+    def md_attr(self, attr):
+        """The path of one of the array's md attributes in sysfs."""
+        return '/sys/block/{}/md/{}'.format(
+            os.path.basename(self.lvmexec.backend.realpath(self.name)), attr)
+
+    def pause_scrub(self):
+        """Stop a check of the array (see Scrubber), so that an operation can
+        go ahead.  Returns whether there was one.
+
+        md keeps where an interrupted check had got to in sync_min, and the
+        scrub records it, so the next scrub carries on from there.
+
+        """
+        if self.lvmexec.read_sysfs(self.md_attr('sync_action')) != 'check':
+            return False
+        self.log('Pausing the scrub of {}: scrub again later to finish it.'.format(
+            self.name), logging.INFO)
+        self.lvmexec.write_sysfs(self.md_attr('sync_action'), 'idle')
+        self.refresh()
+        return True
+
+    def pause_reshape(self):
+        """Freeze the array's reshape where it has got to."""
+        self.lvmexec.write_sysfs(self.md_attr('sync_action'), 'frozen')
+
+    def continue_reshape(self, limit=None):
+        """Let a paused reshape carry on.
+
+        With limit, md stops the reshape by itself once it reaches that many
+        bytes of each member, so it needs no process watching over it.
+
+        """
+        sync_max = 'max'
+        if limit is not None:
+            chunk = (self.chunk or 64) * 1024
+            sync_max = max(chunk, limit - limit % chunk) // 512
+        if self.lvmexec.read_sysfs(self.md_attr('sync_max')) != str(sync_max):
+            self.lvmexec.write_sysfs(self.md_attr('sync_max'), sync_max)
+        if self.lvmexec.read_sysfs(self.md_attr('sync_action')) == 'frozen':
+            self.lvmexec.write_sysfs(self.md_attr('sync_action'), 'idle')
+
+    def hold_reshape(self, progress, speed):
+        """Pause or continue a reshape to suit the maintenance window.
+
+        progress is the reshape's progress (see SyncMonitor.array_progress())
+        and speed its recent speed, if known.  Returns how long to wait before
+        looking again.  With --detach, raises LvmRaidDetached instead once the
+        reshape is paused, or running with a limit of where it can get to
+        before the window closes.
+
+        """
+        window = getattr(self.lvmexec.args, 'window', None)
+        detach = getattr(self.lvmexec.args, 'detach', False)
+        now = self.lvmexec.backend.time()
+        if window is not None and not window.contains(now):
+            if progress['action'] != 'frozen':
+                self.log('Pausing the reshape of {} until the maintenance window'
+                         .format(self.name), logging.INFO)
+                self.pause_reshape()
+            message = 'The reshape of {} is paused until the maintenance window opens'
+        else:
+            limit = None
+            if window is not None and detach and progress['done'] is not None:
+                drives = [member.drive.name for member in self.members.values()]
+                speed = (speed or self.lvmexec.op_history.typical_speed(drives) or
+                         Plan.DEFAULT_SPEED)
+                limit = progress['done'] + long(speed * window.until_change(now))
+            self.continue_reshape(limit)
+            message = 'The reshape of {} is running in the background'
+        if detach:
+            self.lvmexec.journal.record_pause(self.name, progress['completed'], now)
+            raise LvmRaidDetached((message + ': run the resume command to carry on.')
+                                  .format(self.name))
+        if window is None:
+            return 15
+        if window.contains(now):
+            return min(15, window.until_change(now))
+        return window.until_change(now)
+
+    def report_progress(self, monitor, action):
+        """Report the progress of a resync or reshape being waited for."""
+        progress = monitor.array_progress(self.name)
+        self.lvmexec.progress(
+            phase=action, array=self.name,
+            percent=(None if progress['completed'] is None
+                     else progress['completed'] * 100),
+            speed=progress['speed'], eta=progress['eta'],
+            message='Waiting for {} to finish {} ({})'.format(
+                self, action, monitor.summary(self.name)))
+
+    @timed_phase('sync_wait')
     def wait_for_resync_complete(self):
-        """Wait for this array to complete resynchronisation."""
+        """Wait for this array to complete resynchronisation.
+
+        Reshapes are confined to the maintenance window, if there is one (see
+        hold_reshape()).
+
+        """
         self.get_info()
         completion_text = None
+        monitor = SyncMonitor(self.lvmexec, [self.name])
+        first_sample = None
+        speed = None
         while self.state != RaidArray.ARRAY_STATE_CLEAN:
-            if self.state == RaidArray.ARRAY_STATE_RECOVERING:
-                completion_text = "Resync"
-                print("Waiting for {} to finish resync ({}% complete)...\r"
-                      .format(self, self.op_percentage_completion))
-                time.sleep(15)
-                self.get_info()
-            elif self.state == RaidArray.ARRAY_STATE_RESHAPING:
-                completion_text = "Reshape"
-                print("Waiting for {} to finish reshape ({}% complete)...\r"
-                      .format(self, self.op_percentage_completion))
-                time.sleep(15)
-                self.get_info()
-            else:
-                check_critical(False,
-                               "Unexpected RAID array state: {}".format(self.state))
+            # A scrub is paused rather than waited for.  A repair, which md
+            # may also report as checking, is waited for like a resync.
+            if self.state == RaidArray.ARRAY_STATE_CHECKING and self.pause_scrub():
+                continue
+            with self.lvmexec.tracer.span('Wait for {}'.format(self.name), 'wait',
+                                          state=self.state,
+                                          percentage=self.op_percentage_completion):
+                if self.state in (RaidArray.ARRAY_STATE_RECOVERING,
+                                  RaidArray.ARRAY_STATE_RESYNCING,
+                                  RaidArray.ARRAY_STATE_CHECKING):
+                    completion_text = "Resync"
+                    monitor.sample()
+                    first_sample = first_sample or monitor.samples[0]
+                    speed = monitor.array_progress(self.name)['speed'] or speed
+                    self.report_progress(monitor, 'resync')
+                    self.lvmexec.sleep(15)
+                    self.refresh()
+                elif self.state == RaidArray.ARRAY_STATE_RESHAPING:
+                    completion_text = "Reshape"
+                    monitor.sample()
+                    first_sample = first_sample or monitor.samples[0]
+                    speed = monitor.array_progress(self.name)['speed'] or speed
+                    delay = self.hold_reshape(monitor.array_progress(self.name), speed)
+                    self.report_progress(monitor, 'reshape')
+                    self.lvmexec.sleep(delay)
+                    self.refresh()
+                else:
+                    check_critical(False,
+                                   "Unexpected RAID array state: {}".format(self.state))
 
         if completion_text is not None:
             self.log("{} complete for {}".format(completion_text, self),
                      logging.INFO)
+            self.lvmexec.op_history.record_sync(first_sample[1][self.name],
+                                                first_sample[0],
+                                                self.lvmexec.backend.time(),
+                                                speed)
         else:
             self.log("Array already clean")
 
 
-class LvmRaidExec:
-    """Represents a single invocation of the lvmraid script."""
-    def __init__(self, args):
-        # Hash of child instances.
-        self.child_objs = {}
+class PlanStep(object):
+    """A single step of an operation, and the data it moves.
 
-        # Configure logging.
-        self.setup_logging()
+    Steps refer to drives, arrays and partitions by name, or by a reference
+    (eg. 'partition1') for objects which will only be created when the plan is
+    run.
 
-        # Check all our dependencies are met, before we bother trying anything
-        # more complex.
-        self.check_dependencies()
+    """
 
-        parser = argparse.ArgumentParser(
-            description='Helper utility for lvm and mdadm.')
-        parser.add_argument('-p', '--prompt',
-                            action='store_true',
-                            help="Prompt before performing any detructive actions.")
-        subparsers = parser.add_subparsers()
+    ref_re = re.compile(r'\b[a-z]+[0-9]+\b')
 
-        # Add parse for the add command.
-        add_parser = subparsers.add_parser(
-            'add',
-            help="""Add a new drive to an existing array, increasing the array's
-            number of drives by one.  To add a new drive to the array without
-            changing the total number of drives, see the 'replace' command.
-            If the new drive is large enough to increase the array size, it
-            will do so.""")
-        add_parser.add_argument(
-            '--mdadm-backup-file',
-            default='/tmp/lvmraid5_mdadm_backup_file.txt',
-            help="""Backup file for mdadm to use.  This should be on a physical
-            drive other than the array.""")
-        add_parser.add_argument(
-            'lv', help='The LVM Logical Volume to add the drive to')
-        add_parser.add_argument('drive_to_add',
-                                help='The drive to add (eg. /dev/sda)')
-        add_parser.set_defaults(func=self.add)
+    def __init__(self, action, description, **params):
+        self.action = action
+        self.description = description
+        self.params = params
+        self.reads = {}  # Bytes read, keyed on drive name.
+        self.writes = {}  # Bytes written, keyed on drive name.
 
-        # Parser for the create command.
-        create_parser = subparsers.add_parser(
-            'create',
-            help="""Create a new array from a set of drives.""")
-        create_parser.add_argument(
-            '--vg_name',
-            help="""The name of the LVM Volume Group to create (default:
-            /dev/lvmraid_vg<N>""")
-        create_parser.add_argument(
-            'drives_for_create',
+    def add_io(self, drive, read=0, written=0):
+        self.reads[drive] = self.reads.get(drive, 0) + long(read)
+        self.writes[drive] = self.writes.get(drive, 0) + long(written)
+
+    def to_dict(self):
+        return {'action': self.action,
+                'description': self.description,
+                'params': self.params,
+                'reads': self.reads,
+                'writes': self.writes}
+
+    @classmethod
+    def from_dict(cls, data):
+        step = cls(data['action'], data['description'], **data['params'])
+        step.reads = data['reads']
+        step.writes = data['writes']
+        return step
+
+    def duration(self, speed, drive_speeds=None):
+        """Estimated duration, given the speed of each drive in bytes/s.
+
+        drive_speeds gives the speed of any drives which differ from speed.
+        The drives all work in parallel, so the busiest one sets the pace.
+
+        """
+        drive_speeds = drive_speeds or {}
+        busiest = 0
+        for drive in set(self.reads) | set(self.writes):
+            busiest = max(busiest,
+                          float(self.reads.get(drive, 0) + self.writes.get(drive, 0)) /
+                          drive_speeds.get(drive, speed))
+        return busiest
+
+    def describe(self, refs):
+        """The description, with the references resolved so far replaced by
+        what they refer to."""
+        def resolve(m):
+            value = refs.get(m.group(0))
+            if value is None:
+                return m.group(0)
+            # Chunk sizes are in KiB.
+            return '{}K'.format(value) if isinstance(value, (int, long)) else value
+        return PlanStep.ref_re.sub(resolve, self.description)
+
+    def __str__(self):
+        return self.description
+
+
+class Plan(object):
+    """An ordered list of steps making up an operation."""
+    DEFAULT_SPEED = 100 * 1000 * 1000  # Bytes/s per drive.
+
+    def __init__(self, description, speed=DEFAULT_SPEED):
+        self.description = description
+        self.speed = speed
+        self.drive_speeds = {}  # Drives known to differ from speed.
+        self.steps = []
+        self.num_refs = 0
+
+    def add_step(self, action, description, **params):
+        step = PlanStep(action, description, **params)
+        self.steps.append(step)
+        return step
+
+    def new_ref(self, kind):
+        """Returns a reference for an object created by the plan."""
+        self.num_refs += 1
+        return '{}{}'.format(kind, self.num_refs)
+
+    def drive_totals(self):
+        """Returns total bytes (read, written) keyed on drive name."""
+        totals = {}
+        for step in self.steps:
+            for drive in set(step.reads) | set(step.writes):
+                read, written = totals.get(drive, (0, 0))
+                totals[drive] = (read + step.reads.get(drive, 0),
+                                 written + step.writes.get(drive, 0))
+        return totals
+
+    def to_dict(self):
+        """The plan as plain data, so it can be saved (see OperationJournal)."""
+        return {'description': self.description,
+                'speed': self.speed,
+                'drive_speeds': self.drive_speeds,
+                'num_refs': self.num_refs,
+                'steps': [step.to_dict() for step in self.steps]}
+
+    @classmethod
+    def from_dict(cls, data):
+        plan = cls(data['description'], speed=data['speed'])
+        plan.drive_speeds = data['drive_speeds']
+        plan.num_refs = data['num_refs']
+        plan.steps = [PlanStep.from_dict(step) for step in data['steps']]
+        return plan
+
+    def duration(self):
+        """Estimated duration of the plan.  Steps are run one at a time."""
+        return sum(step.duration(self.speed, self.drive_speeds)
+                   for step in self.steps)
+
+    def __str__(self):
+        return self.describe({})
+
+    def describe(self, refs):
+        """The plan, with the references resolved so far (see
+        PlanStep.describe())."""
+        lines = ['Plan to {}:'.format(self.description)]
+        for index, step in enumerate(self.steps):
+            line = '{:3}. {}'.format(index + 1, step.describe(refs))
+            duration = step.duration(self.speed, self.drive_speeds)
+            if duration > 0:
+                line += ' (~{})'.format(format_duration(duration))
+            lines.append(line)
+            for drive in sorted(set(step.reads) | set(step.writes)):
+                lines.append('       {}: read {}, write {}'.format(
+                    drive, format_bytes(step.reads.get(drive, 0)),
+                    format_bytes(step.writes.get(drive, 0))))
+        lines.append('Data moved per drive:')
+        for drive, (read, written) in sorted(self.drive_totals().items()):
+            lines.append('  {}: read {}, write {}'.format(
+                drive, format_bytes(read), format_bytes(written)))
+        speeds = ''.join('; {} at {}/s'.format(drive, format_bytes(speed))
+                         for drive, speed in sorted(self.drive_speeds.items()))
+        lines.append('Estimated time: {} (at {}/s per drive{})'.format(
+            format_duration(self.duration()), format_bytes(self.speed), speeds))
+        return '\n'.join(lines)
+
+
+# Subset sums are found over this many steps of the space available, and
+# leftover space within this fraction of the next size down is rounded down
+# to it rather than making a tier of its own.
+LAYOUT_RESOLUTION = 1 << 16
+LAYOUT_LEVEL_TOLERANCE = 0.01
+
+# Leftover space on a drive under this fraction of the drive is treated as
+# rounding error (see HardDrive.unallocated_size()).
+LAYOUT_MIN_LEFTOVER = 0.05
+
+
+def best_subset_sum(sizes, capacity, resolution=LAYOUT_RESOLUTION):
+    """Choose the subset of sizes with the largest total not above capacity.
+
+    Returns the indices of the chosen sizes.  The search is a bitset of the
+    reachable totals, in steps of capacity / resolution, so it stays fast
+    however large the sizes are: the total found is within one step per size
+    of the best possible, but never over capacity.
+
+    """
+    if capacity <= 0 or not sizes:
+        return []
+    if sum(sizes) <= capacity:
+        return list(range(len(sizes)))
+    unit = max(1, capacity // resolution)
+    weights = [size // unit for size in sizes]
+    limit = capacity // unit
+    mask = (1 << (limit + 1)) - 1
+
+    # reachable[ii] has bit n set if a subset of the first ii sizes has
+    # weights totalling n.  Rounding the weights down means nothing which
+    # fits is missed, but a subset found may not quite fit, in which case
+    # the next lower total is tried.
+    reachable = [1]
+    for weight in weights:
+        reachable.append((reachable[-1] | (reachable[-1] << weight)) & mask)
+    target = reachable[-1].bit_length() - 1
+    while target >= 0:
+        if (reachable[-1] >> target) & 1:
+            chosen = []
+            total = target
+            for index in reversed(range(len(weights))):
+                if not (reachable[index] >> total) & 1:
+                    chosen.append(index)
+                    total -= weights[index]
+            if sum(sizes[index] for index in chosen) <= capacity:
+                return sorted(chosen)
+        target -= 1
+    return []
+
+
+def compute_layout(tiers, drives):
+    """Work out the tiers of RAID5 arrays giving the most usable capacity.
+
+    tiers are the existing arrays, as dictionaries of 'member_size',
+    'drives' (the member drives' names) and 'clean'.  drives are the drives
+    with space to lay out, new or existing, as dictionaries of 'name',
+    'free' (the space to lay out), and optionally 'size' (the whole drive's
+    size, if more than its free space) and 'required' (the indices of
+    degraded tiers it must rebuild).
+
+    Joining a clean tier adds all of the space joined to the capacity, so
+    each drive joins the set of tiers which fills it most closely (a subset
+    sum).  The space left over on all of the drives is then split into new
+    tiers at each distinct size, as create does, which uses all but the
+    largest leftover.  Between them, that's the most capacity the existing
+    tiers allow.
+
+    Returns a dictionary of:
+    - 'joins': the indices of the tiers each drive joins, keyed on name.
+    - 'new_tiers': the new tiers, as dictionaries of 'member_size' and
+      'drives'.
+    - 'leftover': the space left unused on each drive, keyed on name.
+    - 'capacity': the usable capacity added, in bytes.
+
+    """
+    joins = collections.OrderedDict()
+    leftover = collections.OrderedDict()
+    capacity = 0
+    subset_cache = {}
+    for drive in drives:
+        required = list(drive.get('required', []))
+        free = drive['free'] - sum(tiers[index]['member_size'] for index in required)
+        check_critical(free >= 0, 'Drive {} is too small for the arrays it must rebuild.'
+                       .format(drive['name']))
+        candidates = [index for index, tier in enumerate(tiers)
+                      if tier['clean'] and index not in required and
+                      drive['name'] not in tier['drives']]
+        # Shelves of identical drives all need the same subset.
+        key = (free, tuple(candidates))
+        if key not in subset_cache:
+            sizes = [tiers[index]['member_size'] for index in candidates]
+            subset_cache[key] = [candidates[index]
+                                 for index in best_subset_sum(sizes, free)]
+        chosen = subset_cache[key]
+        joins[drive['name']] = sorted(required + chosen)
+        capacity += sum(tiers[index]['member_size'] for index in chosen)
+        leftover[drive['name']] = free - sum(tiers[index]['member_size']
+                                             for index in chosen)
+        if leftover[drive['name']] < LAYOUT_MIN_LEFTOVER * drive.get('size', drive['free']):
+            leftover[drive['name']] = 0
+
+    # Round each drive's leftover down to a level, merging levels which are
+    # within rounding error of each other.
+    levels = []
+    for free in sorted(set(leftover.values())):
+        if free > 0 and (not levels or
+                         free > levels[-1] * (1 + LAYOUT_LEVEL_TOLERANCE)):
+            levels.append(free)
+
+    # Each slice between one level and the next becomes a tier, of every
+    # drive with space up to the higher level.
+    new_tiers = []
+    prev_level = 0
+    for level in levels:
+        members = [name for name, free in leftover.items() if free >= level]
+        if len(members) < 2:
+            break
+        new_tiers.append({'member_size': level - prev_level, 'drives': members})
+        capacity += (len(members) - 1) * (level - prev_level)
+        prev_level = level
+    for name, free in leftover.items():
+        leftover[name] = free - max([level for level in levels
+                                     if level <= min(free, prev_level)] or [0])
+
+    return {'joins': joins,
+            'new_tiers': new_tiers,
+            'leftover': leftover,
+            'capacity': capacity}
+
+
+class Planner(object):
+    """Decides the steps of an operation, without making any changes.
+
+    Planning works on a simple model of the volume group: its arrays (member
+    size, member drives and whether they're clean) and the unallocated space
+    on each drive.  The model is updated as steps are planned, so several
+    drives can be planned in turn to compare alternatives.
+
+    lv is None when planning the creation of a new one.
+
+    """
+    def __init__(self, lvmexec, lv, speed=Plan.DEFAULT_SPEED):
+        self.lvmexec = lvmexec
+        self.lv = lv
+        self.speed = speed
+        self.num_hypothetical = 0
+
+        # Build the model from the live objects.
+        self.arrays = []
+        self.unallocated = {}
+        if lv is None:
+            return
+        for pv in lv.vg.pvs.values():
+            array = pv.raid_array
+            self.arrays.append({
+                'name': array.name,
+                'member_size': array.members_size(),
+                'drives': [member.drive.name for member in array.members.values()],
+                'partitions': list(array.members),
+                'clean': array.is_clean(),
+                'chunk': array.chunk,
+                'level': array.level})
+        for drive in lv.vg.drives().values():
+            self.unallocated[drive.name] = drive.unallocated_size()
+
+    def resolve_drive(self, drive_name):
+        """Returns the name and size of a drive, which may be hypothetical."""
+        # A size rather than a drive plans for a drive which isn't attached
+        # yet.
+        size = parse_size(drive_name)
+        if size is not None:
+            self.num_hypothetical += 1
+            return 'new-drive-{}'.format(self.num_hypothetical), size
+
+        drive = self.lvmexec.find_or_create(HardDrive, drive_name)
+        check_critical(drive.empty,
+                       'New drive {} is not empty.'.format(drive_name))
+        return drive.name, drive.size()
+
+    def plan_add_replace(self, drive_name, grow, plan=None):
+        """Plan adding a drive (grow is True) or replacing one (grow is False).
+
+        If grow is False then the array must be degraded, and the total number
+        of drives in the array doesn't change.
+
+        If grow is True then the array must be clean, and the total number of
+        drives in the array is increased by one.
+
+        The drive can be any size: compute_layout() works out which arrays it
+        joins, and which new arrays to make from the space left on it and on
+        the existing drives, for the most capacity.  Existing drives with
+        unallocated space may join arrays too.
+
+        """
+        drive_name, drive_size = self.resolve_drive(drive_name)
+        if plan is None:
+            plan = Plan('{} {} to {}'.format('add' if grow else 'replace with',
+                                              drive_name, self.lv),
+                        speed=self.speed)
+        extend_lv = False
+
+        # Arrays are joined in order of the number of drives in them (largest
+        # to smallest).
+        arrays = sorted(self.arrays,
+                        key=lambda element: len(element['drives']),
+                        reverse=True)
+        self.lvmexec.log("Existing array sizes: {}".format(
+            [array['member_size'] for array in arrays]))
+
+        if grow:
+            # The LV must be clean.  It may be resyncing at the moment, so wait.
+            plan.add_step('wait', 'Wait for any resync of {} to complete'.format(self.lv))
+            for array in arrays:
+                array['clean'] = True
+            required = []
+        else:
+            # Spin through the unclean arrays, checking that:
+            # - there's at least one unclean array
+            # - the drive being added is large enough to be added to all the
+            #   unclean arrays.
+            required = [index for index, array in enumerate(arrays)
+                        if not array['clean']]
+            unclean_size = sum(arrays[index]['member_size'] for index in required)
+            check_critical(unclean_size != 0,
+                           """The LV is clean; cannot replace drive in it.""")
+            check_critical(unclean_size <= drive_size,
+                           """The LV needs a drive of size at least {} to make
+                           the array clean.""".format(unclean_size))
+
+            # How much LV data each array holds decides how it's made clean
+            # (see rebuild_order()).
+            used = self.pv_used()
+            for array in arrays:
+                array['used'] = used.get(array['name'])
+
+        drives = [{'name': drive_name, 'free': drive_size, 'required': required}]
+        drives += [{'name': name, 'free': free}
+                   for name, free in sorted(self.unallocated.items())
+                   if free > 0 and name != drive_name]
+        layout = compute_layout(arrays, drives)
+        self.lvmexec.log('Layout: {}'.format(layout))
+        check_critical(layout['joins'][drive_name] or layout['new_tiers'],
+                       """Drive {} is too small to join any of the arrays, and
+                       there isn't enough unallocated space on the other drives
+                       to make a new array with it.""".format(drive_name))
+
+        plan.add_step('init_partitions',
+                      'Initialize the partition table on {}'.format(drive_name),
+                      drive=drive_name)
+        repairs = []
+        for drive in drives:
+            for index in sorted(layout['joins'][drive['name']],
+                                key=lambda index: self.rebuild_order(arrays[index])):
+                array = arrays[index]
+                partition = self.plan_partition(plan, drive['name'],
+                                                array['member_size'], array['name'])
+                if not array['clean'] and array.get('used') == 0:
+                    self.plan_recreate(plan, array, drive['name'], partition)
+                    if array['level'] != 1:
+                        repairs.append(array['name'])
+                else:
+                    self.plan_add(plan, array, drive['name'], partition)
+
+                # If the array was clean, we're adding a spare, so grow onto it.
+                if array['clean']:
+                    self.plan_grow(plan, array)
+                    extend_lv = True
+                array['clean'] = True
+
+        # Now make new arrays from the space left over.
+        for tier in layout['new_tiers']:
+            self.plan_new_array(plan, tier['drives'], tier['member_size'])
+            extend_lv = True
+        self.unallocated.update(layout['leftover'])
+
+        # Once the rebuilds are done, recreated RAID5 arrays have their parity
+        # made good in the background.
+        for array_name in repairs:
+            plan.add_step('repair',
+                          'Start a background repair of the parity of {}'.format(
+                              array_name),
+                          array=array_name)
+
+        if extend_lv:
+            # Now ask the LV to grow to consume the space.
+            plan.add_step('lvextend', 'Extend {} to fill {}'.format(
+                self.lv, self.lv.vg))
+        return plan
+
+    def plan_create(self, drive_names, vg_name, chunk=None):
+        """Plan creating arrays, a VG and an LV from a set of empty drives.
+
+        Each drive is split into partitions at the sizes of the smaller
+        drives, and each set of same-sized partitions becomes an array (see
+        compute_layout()).
+
+        The arrays have the given chunk size in KiB (default: mdadm's).  With
+        a chunk of 'auto', it's chosen by benchmarking scratch arrays on the
+        partitions of the first array.
+
+        """
+        # Check that we've been passed at least 2 drives.  We don't currently
+        # support creating degraded arrays.
+        check_critical(len(drive_names) >= 2,
+                       "Must have at least 2 drives for array creation")
+        drive_sizes = collections.OrderedDict(
+            self.resolve_drive(drive_name) for drive_name in drive_names)
+        self.lvmexec.log('Found drive sizes: {}'.format(set(drive_sizes.values())))
+
+        tiers = compute_layout([], [{'name': drive_name, 'free': drive_size}
+                                    for drive_name, drive_size in drive_sizes.items()]
+                               )['new_tiers']
+        self.lvmexec.log('Creating arrays with sizes: {}'.format(
+            [tier['member_size'] for tier in tiers]), logging.INFO)
+
+        lv_name = vg_name + '/lvol0'
+        plan = Plan('create {} from {}'.format(lv_name, ', '.join(drive_sizes)),
+                    speed=self.speed)
+        partitions = {}
+        for drive_name in drive_sizes:
+            plan.add_step('init_partitions',
+                          'Initialize the partition table on {}'.format(drive_name),
+                          drive=drive_name)
+            partitions[drive_name] = [
+                self.plan_partition(plan, drive_name, tier['member_size'], 'a new array')
+                for tier in tiers if drive_name in tier['drives']]
+
+        # The arrays resync in the background, so aren't waited for.
+        arrays = []
+        for index, tier in enumerate(tiers):
+            size = tier['member_size']
+            members = [(drive_name, partitions[drive_name][index])
+                       for drive_name in tier['drives']]
+            if chunk == 'auto':
+                chunk = plan.new_ref('chunk')
+                plan.add_step('choose_chunk',
+                              'Benchmark chunk sizes on {} for chunk size {}'.format(
+                                  ', '.join(part for _, part in members), chunk),
+                              ref=chunk, partitions=[part for _, part in members])
+            level = RaidArray.level_for(len(members))
+            ref = plan.new_ref('array')
+            step = plan.add_step('create_array',
+                                 'Create new RAID{} array {} from {}{}'.format(
+                                     level, ref, ', '.join(part for _, part in members),
+                                     self.describe_chunk(chunk, level)),
+                                 array=ref, partitions=[part for _, part in members],
+                                 chunk=chunk)
+            for drive_name, _ in members[:-1]:
+                step.add_io(drive_name, read=size)
+            step.add_io(members[-1][0], written=size)
+            plan.add_step('pvcreate', 'Create a PV on {}'.format(ref), array=ref)
+            arrays.append(ref)
+
+        plan.add_step('vgcreate', 'Create {} from the PVs on {}'.format(
+            vg_name, ', '.join(arrays)), vg=vg_name, arrays=arrays)
+        plan.add_step('lvcreate', 'Create {} filling {}'.format(lv_name, vg_name),
+                      lv=lv_name, vg=vg_name)
+        return plan
+
+    def plan_remove(self, drive_name):
+        """Plan removing a drive, leaving its arrays degraded."""
+        plan = Plan('remove {} from {}'.format(drive_name, self.lv),
+                    speed=self.speed)
+        drive = self.lvmexec.find_or_create(HardDrive, drive_name)
+
+        # Work out which arrays have a member on the drive.
+        removals = []
+        for partition in drive.partitions.values():
+            for pv in self.lv.vg.pvs.values():
+                if partition in pv.raid_array.members.values():
+                    removals.append((pv.raid_array.name, partition.name))
+        check_critical(removals, '{} has no partitions in {}.'.format(drive_name,
+                                                                    self.lv))
+        arrays = sorted(array for array, _ in removals)
+
+        # Wait for just those arrays to complete resync (this will exit if
+        # they aren't clean or resyncing).  Other arrays are unaffected.
+        plan.add_step('wait', 'Wait for any resync of {} to complete'.format(
+            ', '.join(arrays)), arrays=arrays)
+
+        # Remove the drive from each array it's in.
+        for array, partition in sorted(removals):
+            plan.add_step('remove_member',
+                          'Remove {} from {}'.format(partition, array),
+                          array=array, partition=partition)
+        return plan
+
+    def pv_used(self):
+        """The bytes allocated to LVs on each PV, keyed on the PV's name."""
+        return dict((pv['pv_name'], long(pv['pv_used']))
+                    for pv in StatusReport(self.lvmexec, None).lvm_report(
+                        'pvs', ['pv_name', 'pv_used']))
+
+    @staticmethod
+    def rebuild_order(array):
+        """The sort key for the order in which a replacement joins arrays.
+
+        Degraded arrays holding LV data come first, so the data is at risk
+        for as short a time as possible: those with the least to rebuild for
+        the data they hold (member size over bytes used) first, which
+        minimises the total of the data at risk over time.  Then degraded
+        arrays holding none, which are recreated rather than rebuilt, then
+        clean arrays.
+
+        """
+        used = array.get('used')
+        if array['clean']:
+            return (2, 0)
+        if used == 0:
+            return (1, 0)
+        return (0, float(array['member_size']) / used if used else 0)
+
+    def plan_partition(self, plan, drive_name, size, purpose):
+        """Plan creating a partition, returning its reference."""
+        ref = plan.new_ref('partition')
+        plan.add_step('create_partition',
+                      'Create {} partition {} on {} for {}'.format(
+                          format_bytes(size), ref, drive_name, purpose),
+                      drive=drive_name, size=size, ref=ref)
+        return ref
+
+    def plan_add(self, plan, array, drive_name, partition):
+        """Plan adding a partition to an array.
+
+        If the array is degraded, this rebuilds the missing member: every other
+        member is read in full, and the new one written.  Arrays holding LV
+        data are rebuilt at high priority (see RaidArray.wait_for_rebuild()).
+
+        """
+        params = {}
+        description = ''
+        if not array['clean']:
+            params['priority'] = 'high'
+            description = ' and rebuild at high priority'
+            if array.get('used') is not None:
+                description += ' ({} of data)'.format(format_bytes(array['used']))
+        step = plan.add_step('add',
+                             'Add {} to {}{}'.format(partition, array['name'],
+                                                      description),
+                             array=array['name'], partition=partition, **params)
+        if not array['clean']:
+            for member_drive in array['drives']:
+                step.add_io(member_drive, read=array['member_size'])
+            step.add_io(drive_name, written=array['member_size'])
+        array['drives'].append(drive_name)
+        array['partitions'].append(partition)
+
+    def plan_recreate(self, plan, array, drive_name, partition):
+        """Plan recreating a degraded array which holds no LV data.
+
+        There's nothing on it worth rebuilding, so its PV is taken out of the
+        VG, and the array recreated from its remaining members and the new
+        partition with --assume-clean, which reads and writes nothing, before
+        going back in the VG.  A RAID5's parity is then garbage, so it's
+        repaired afterwards (see plan_add_replace()).
+
+        """
+        plan.add_step('vgreduce', 'Remove the PV on {} (which holds no data) from {}'
+                      .format(array['name'], self.lv.vg), array=array['name'])
+        partitions = array['partitions'] + [partition]
+        plan.add_step('recreate_array',
+                      'Recreate RAID{} array {} from {} without a rebuild{}'.format(
+                          array['level'], array['name'], ', '.join(partitions),
+                          self.describe_chunk(array['chunk'], array['level'])),
+                      array=array['name'], partitions=partitions,
+                      level=array['level'], chunk=array['chunk'])
+        plan.add_step('pvcreate', 'Create a PV on {}'.format(array['name']),
+                      array=array['name'])
+        plan.add_step('vgextend', 'Add the PV on {} to {}'.format(array['name'],
+                                                                  self.lv.vg),
+                      array=array['name'])
+        array['drives'].append(drive_name)
+        array['partitions'] = partitions
+
+    def plan_grow(self, plan, array):
+        """Plan growing an array onto a newly added spare, and its PV.
+
+        The reshape reads every old member in full, and rewrites the array's
+        contents across all the members.  A RAID1 is converted to RAID5 first,
+        which moves no data.
+
+        """
+        old_count = len(array['drives']) - 1
+        description = 'Reshape {} from {} to {} members'
+        chunk = None
+        if array['level'] == 1:
+            # Mirrors have no chunk size, so take that of the other arrays.
+            chunk = self.usual_chunk()
+            description = ('Convert {} to RAID5 and reshape it from {} to {} members' +
+                           self.describe_chunk(chunk))
+            array['level'] = 5
+            array['chunk'] = chunk
+        step = plan.add_step('grow', description.format(
+            array['name'], old_count, old_count + 1), array=array['name'],
+            chunk=chunk)
+        for member_drive in array['drives'][:-1]:
+            step.add_io(member_drive, read=array['member_size'])
+        for member_drive in array['drives']:
+            step.add_io(member_drive,
+                        written=array['member_size'] * (old_count - 1) / old_count)
+        plan.add_step('pvresize', 'Resize the PV on {}'.format(array['name']),
+                      array=array['name'])
+
+    def plan_new_array(self, plan, drive_names, member_size):
+        """Plan creating a new array and PV, and adding it to the VG.
+
+        The initial resync reads all but one member, and writes the last.
+
+        """
+        partitions = [self.plan_partition(plan, drive_name, member_size, 'a new array')
+                      for drive_name in drive_names]
+
+        chunk = self.usual_chunk()
+        level = RaidArray.level_for(len(partitions))
+        ref = plan.new_ref('array')
+        step = plan.add_step('create_array',
+                             'Create new RAID{} array {} from {}{}'.format(
+                                 level, ref, ', '.join(partitions),
+                                 self.describe_chunk(chunk, level)),
+                             array=ref, partitions=partitions, chunk=chunk)
+        for drive_name in drive_names[:-1]:
+            step.add_io(drive_name, read=member_size)
+        step.add_io(drive_names[-1], written=member_size)
+        plan.add_step('pvcreate', 'Create a PV on {}'.format(ref), array=ref)
+        plan.add_step('vgextend', 'Add the PV on {} to {}'.format(ref, self.lv.vg),
+                      array=ref)
+
+        self.arrays.append({'name': ref,
+                            'member_size': member_size,
+                            'drives': list(drive_names),
+                            'partitions': partitions,
+                            'clean': True,
+                            'chunk': None if level == 1 else chunk,
+                            'level': level})
+
+    def usual_chunk(self):
+        """The chunk size most of the arrays were created with, to keep to."""
+        chunks = [array['chunk'] for array in self.arrays
+                  if array['chunk'] is not None]
+        return max(set(chunks), key=chunks.count) if chunks else None
+
+    @staticmethod
+    def describe_chunk(chunk, level=5):
+        """Describe the chunk size of a new array, for a step's description."""
+        if chunk is None or level == 1:
+            return ''
+        if isinstance(chunk, int):
+            return ' with {}K chunks'.format(chunk)
+        return ' with chunk size {}'.format(chunk)
+
+
+class StatusReport(object):
+    """Machine-readable status of a logical volume and everything under it.
+
+    Everything is gathered in a single pass: one call each to lvs, vgs and pvs,
+    plus reads of the md and block device state from sysfs.  Unlike building
+    the object graph, this never runs fdisk or mdadm.
+
+    """
+    LVM_REPORT_ARGS = ['--noheadings', '--nosuffix', '--units', 'b',
+                       '--separator', '|']
+    # The values md reports in array_state and sync_action.
+    ARRAY_STATES = ('clear', 'inactive', 'suspended', 'readonly', 'read-auto',
+                    'clean', 'active', 'write-pending', 'active-idle', 'broken')
+    SYNC_ACTIONS = ('idle', 'resync', 'recover', 'check', 'repair', 'reshape',
+                    'frozen')
+
+    def __init__(self, lvmexec, lv_name):
+        self.lvmexec = lvmexec
+        self.lv_name = lv_name
+        self.timestamp = None
+        self.lv = None
+        self.vg = None
+        self.pvs = []
+        self.arrays = []
+        self.drives = []
+
+    def lvm_report(self, cmd, fields, *targets):
+        """Run an LVM reporting command, returning a list of dictionaries."""
+        output = self.lvmexec.run_cmd([cmd] + StatusReport.LVM_REPORT_ARGS +
+                                      ['-o', ','.join(fields)] + list(targets),
+                                      full_output=True)
+        rows = []
+        for line in output.splitlines():
+            if line.strip():
+                rows.append(dict(zip(fields,
+                                     [val.strip() for val in line.split('|')])))
+        return rows
+
+    def gather(self):
+        """Gather the status."""
+        self.timestamp = self.lvmexec.backend.time()
+        try:
+            lvs = self.lvm_report('lvs', ['lv_name', 'vg_name', 'lv_size'],
+                                  self.lv_name)
+        except subprocess.CalledProcessError:
+            lvs = []
+        check_critical(len(lvs) == 1,
+                       'Could not find logical volume {}'.format(self.lv_name))
+        self.lv = {'name': self.lv_name,
+                   'vg': lvs[0]['vg_name'],
+                   'size': long(lvs[0]['lv_size'])}
+
+        vg = self.lvm_report('vgs', ['vg_name', 'vg_size', 'vg_free',
+                                     'vg_extent_count', 'vg_free_count'],
+                             self.lv['vg'])[0]
+        self.vg = {'name': vg['vg_name'],
+                   'size': long(vg['vg_size']),
+                   'free': long(vg['vg_free']),
+                   'extents': long(vg['vg_extent_count']),
+                   'free_extents': long(vg['vg_free_count'])}
+
+        drive_names = set()
+        for pv in self.lvm_report('pvs', ['pv_name', 'vg_name', 'pv_size',
+                                          'pv_used', 'pv_free']):
+            if pv['vg_name'] != self.vg['name']:
+                continue
+            self.pvs.append({'name': pv['pv_name'],
+                             'size': long(pv['pv_size']),
+                             'used': long(pv['pv_used']),
+                             'free': long(pv['pv_free'])})
+            array = self.gather_array(pv['pv_name'])
+            self.arrays.append(array)
+            drive_names.update(member['drive'] for member in array['members'])
+
+        for drive_name in sorted(drive_names):
+            self.drives.append(self.gather_drive(drive_name))
+        return self
+
+    def gather_array(self, name):
+        """Gather the status of an md array from sysfs."""
+        kernel_name = os.path.basename(self.lvmexec.backend.realpath(name))
+        md_dir = '/sys/block/{}/md'.format(kernel_name)
+        read = lambda attr: self.lvmexec.read_sysfs(os.path.join(md_dir, attr))
+
+        array = {'name': name,
+                 'state': read('array_state'),
+                 'level': read('level'),
+                 'raid_disks': int(read('raid_disks') or 0),
+                 'degraded': int(read('degraded') or 0),
+                 'sync_action': read('sync_action'),
+                 'sync_completed': None,
+                 'sync_done': None,
+                 'sync_total': None,
+                 'sync_speed': None,
+                 'member_size': long(read('component_size') or 0) * 1024,
+                 'chunk_size': long(read('chunk_size') or 0),
+                 'members': []}
+
+        # Sync progress is given in sectors of each member, and speed in KiB/s.
+        completed = read('sync_completed')
+        if completed is not None and '/' in completed:
+            done, total = [long(val) for val in completed.split('/')]
+            array['sync_done'] = done * 512
+            array['sync_total'] = total * 512
+            if total > 0:
+                array['sync_completed'] = float(done) / total
+        speed = read('sync_speed')
+        if speed is not None and speed.isdigit():
+            array['sync_speed'] = long(speed) * 1024
+
+        for dev_dir in sorted(self.lvmexec.list_sysfs(os.path.join(md_dir, 'dev-*'))):
+            block = self.lvmexec.backend.realpath(os.path.join(dev_dir, 'block'))
+            state = self.lvmexec.read_sysfs(os.path.join(dev_dir, 'state')) or ''
+            array['members'].append({
+                'name': '/dev/' + os.path.basename(block),
+                'drive': '/dev/' + os.path.basename(os.path.dirname(block)),
+                'state': state,
+                'healthy': 'in_sync' in state.split(',')})
+        return array
+
+    def gather_drive(self, name):
+        """Gather the size and unallocated space of a drive from sysfs."""
+        block_dir = '/sys/block/{}'.format(os.path.basename(name))
+        size = long(self.lvmexec.read_sysfs(os.path.join(block_dir, 'size')) or 0)
+        used = 0
+        for part_dir in self.lvmexec.list_sysfs(
+                os.path.join(block_dir, os.path.basename(name) + '*')):
+            part_size = long(self.lvmexec.read_sysfs(
+                os.path.join(part_dir, 'size')) or 0)
+            # Skip the extended partition, which shows up as a couple of
+            # sectors rather than the space it contains.
+            if part_size > 2:
+                used += part_size
+        return {'name': name,
+                'size': size * 512,
+                'unallocated': max(0, size - used) * 512}
+
+    def to_json(self):
+        return json.dumps({'timestamp': self.timestamp,
+                           'lv': self.lv,
+                           'vg': self.vg,
+                           'pvs': self.pvs,
+                           'arrays': self.arrays,
+                           'drives': self.drives},
+                          indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """Format the status for the node-exporter textfile collector."""
+        metrics = collections.OrderedDict()
+
+        def escape(value):
+            return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+                    .replace('\n', '\\n'))
+
+        def add_enum(name, help_text, labels, key, values, current):
+            # One series per possible value, so that a change of state flips
+            # values rather than starting a new series.
+            if current is not None and current not in values:
+                values = values + (current,)
+            for value in values:
+                add(name, help_text, dict(labels, **{key: value}),
+                    int(value == current))
+
+        def add(name, help_text, labels, value):
+            if value is None:
+                return
+            if name not in metrics:
+                metrics[name] = ['# HELP lvmraid5_{} {}'.format(name, help_text),
+                                 '# TYPE lvmraid5_{} gauge'.format(name)]
+            label_text = ','.join('{}="{}"'.format(key, escape(labels[key]))
+                                  for key in sorted(labels))
+            metrics[name].append('lvmraid5_{}{{{}}} {}'.format(name, label_text,
+                                                               value))
+
+        add('lv_size_bytes', 'Size of the logical volume.',
+            {'lv': self.lv['name'], 'vg': self.vg['name']}, self.lv['size'])
+        add('vg_size_bytes', 'Size of the volume group.',
+            {'vg': self.vg['name']}, self.vg['size'])
+        add('vg_free_bytes', 'Unallocated space in the volume group.',
+            {'vg': self.vg['name']}, self.vg['free'])
+        for pv in self.pvs:
+            add('pv_size_bytes', 'Size of the physical volume.',
+                {'pv': pv['name']}, pv['size'])
+            add('pv_used_bytes', 'Space allocated on the physical volume.',
+                {'pv': pv['name']}, pv['used'])
+        for array in self.arrays:
+            labels = {'array': array['name']}
+            add_enum('array_state', 'md array state (1 for the current state).',
+                     labels, 'state', self.ARRAY_STATES, array['state'])
+            add_enum('array_sync_action',
+                     'md sync action (1 for the current action).',
+                     labels, 'action', self.SYNC_ACTIONS, array['sync_action'])
+            add('array_degraded', 'Number of missing members in the md array.',
+                labels, array['degraded'])
+            add('array_raid_disks', 'Number of members the md array should have.',
+                labels, array['raid_disks'])
+            add('array_member_size_bytes', 'Size of each member of the md array.',
+                labels, array['member_size'])
+            add('array_sync_completed_ratio', 'Progress of the current sync action.',
+                labels, array['sync_completed'])
+            add('array_sync_speed_bytes', 'Speed of the current sync action.',
+                labels, array['sync_speed'])
+            for member in array['members']:
+                add('member_healthy', 'Whether the md array member is in sync.',
+                    dict(labels, member=member['name'], drive=member['drive']),
+                    int(member['healthy']))
+        for drive in self.drives:
+            add('drive_size_bytes', 'Size of the drive.',
+                {'drive': drive['name']}, drive['size'])
+            add('drive_unallocated_bytes', 'Unpartitioned space on the drive.',
+                {'drive': drive['name']}, drive['unallocated'])
+        add('status_timestamp_seconds', 'When the status was gathered.', {},
+            self.timestamp)
+
+        return '\n'.join(line for lines in metrics.values() for line in lines) + '\n'
+
+    def write_textfile(self, path):
+        """Atomically write the Prometheus metrics to a file."""
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus())
+        os.rename(tmp_path, path)
+
+    def __str__(self):
+        lines = ['Logical Volume {} ({} bytes), Volume Group {} ({} of {} bytes free)'
+                 .format(self.lv['name'], self.lv['size'], self.vg['name'],
+                         self.vg['free'], self.vg['size'])]
+        for array in self.arrays:
+            line = '  {} {} {} members of {} bytes: {}, {}'.format(
+                array['name'], array['level'], array['raid_disks'],
+                array['member_size'], array['state'], array['sync_action'])
+            if array['degraded']:
+                line += ', DEGRADED ({} missing)'.format(array['degraded'])
+            if array['sync_completed'] is not None:
+                line += ', {:.1f}% complete'.format(array['sync_completed'] * 100)
+            lines.append(line)
+            for member in array['members']:
+                lines.append('    {} ({})'.format(member['name'], member['state']))
+        for drive in self.drives:
+            lines.append('  Drive {}: {} bytes, {} unallocated'.format(
+                drive['name'], drive['size'], drive['unallocated']))
+        return '\n'.join(lines)
+
+
+class SyncMonitor(object):
+    """Tracks the progress of md sync operations over time.
+
+    Each call to sample() reads the state of the arrays from sysfs, and the I/O
+    counters of their members from /proc/diskstats.  Speeds and ETAs are
+    smoothed over a moving window of samples.
+
+    """
+    DEFAULT_WINDOW = 60  # Seconds.
+
+    # A drive this busy (fraction of time with I/O in flight) is limiting the
+    # speed of the arrays it's in.
+    BOTTLENECK_UTILIZATION = 0.9
+
+    def __init__(self, lvmexec, array_names, window=DEFAULT_WINDOW):
+        self.lvmexec = lvmexec
+        self.array_names = array_names
+        self.window = window
+        self.samples = collections.deque()  # (time, arrays, diskstats)
+
+    def sample(self):
+        """Take a sample of the current state."""
+        report = StatusReport(self.lvmexec, None)
+        arrays = dict((name, report.gather_array(name))
+                      for name in self.array_names)
+        self.samples.append((self.lvmexec.backend.time(), arrays,
+                             self.read_diskstats()))
+
+        # Drop samples which have fallen out of the window, keeping at least two
+        # so that there's always a rate.
+        while (len(self.samples) > 2 and
+               self.samples[-1][0] - self.samples[1][0] >= self.window):
+            self.samples.popleft()
+
+    def read_diskstats(self):
+        """Returns sectors read, sectors written and ms busy per device."""
+        stats = {}
+        for line in (self.lvmexec.read_sysfs('/proc/diskstats') or '').splitlines():
+            fields = line.split()
+            if len(fields) >= 13:
+                stats[fields[2]] = (long(fields[5]), long(fields[9]),
+                                    long(fields[12]))
+        return stats
+
+    def array_progress(self, name):
+        """Returns the latest state of an array, with smoothed speed and ETA.
+
+        Speeds and remaining bytes are per member of the array.
+
+        """
+        first_time, first_arrays = self.samples[0][0:2]
+        last_time, last_arrays = self.samples[-1][0:2]
+        first, last = first_arrays[name], last_arrays[name]
+
+        progress = {'array': name,
+                    'action': last['sync_action'],
+                    'completed': last['sync_completed'],
+                    'speed': last['sync_speed'],
+                    'done': last['sync_done'],
+                    'remaining': None,
+                    'eta': None}
+        if last['sync_total'] is None:
+            return progress
+
+        progress['remaining'] = last['sync_total'] - last['sync_done']
+        if (first['sync_done'] is not None and last_time > first_time and
+                last['sync_done'] > first['sync_done']):
+            progress['speed'] = ((last['sync_done'] - first['sync_done']) /
+                                 (last_time - first_time))
+        if progress['speed']:
+            progress['eta'] = progress['remaining'] / progress['speed']
+        return progress
+
+    def member_stats(self, name):
+        """Returns throughput and utilization of each member's drive."""
+        first_time, _, first_stats = self.samples[0]
+        last_time, last_arrays, last_stats = self.samples[-1]
+        elapsed = last_time - first_time
+
+        members = []
+        for member in last_arrays[name]['members']:
+            part = os.path.basename(member['name'])
+            drive = os.path.basename(member['drive'])
+            speed = None
+            utilization = None
+            if elapsed > 0 and part in first_stats and part in last_stats:
+                sectors = ((last_stats[part][0] - first_stats[part][0]) +
+                           (last_stats[part][1] - first_stats[part][1]))
+                speed = sectors * 512 / elapsed
+            if elapsed > 0 and drive in first_stats and drive in last_stats:
+                busy_ms = last_stats[drive][2] - first_stats[drive][2]
+                utilization = min(1.0, busy_ms / (elapsed * 1000))
+            members.append({'name': member['name'],
+                            'drive': member['drive'],
+                            'state': member['state'],
+                            'speed': speed,
+                            'utilization': utilization,
+                            'bottleneck': (utilization is not None and
+                                           utilization >= SyncMonitor.BOTTLENECK_UTILIZATION)})
+        return members
+
+    def summary(self, name):
+        """One line summary of an array's progress."""
+        progress = self.array_progress(name)
+        text = '{}'.format(progress['action'])
+        if progress['completed'] is not None:
+            text += ' {:.1f}% complete'.format(progress['completed'] * 100)
+        if progress['speed']:
+            text += ', {}/s'.format(format_bytes(progress['speed']))
+        if progress['remaining'] is not None:
+            text += ', {} remaining'.format(format_bytes(progress['remaining']))
+        if progress['eta'] is not None:
+            text += ', ETA {}'.format(format_duration(progress['eta']))
+        return text
+
+    def render(self):
+        """Multi-line dashboard of all the arrays and their members."""
+        lines = []
+        for name in self.array_names:
+            lines.append('{}: {}'.format(name, self.summary(name)))
+            for member in self.member_stats(name):
+                line = '    {} ({})'.format(member['name'], member['state'])
+                if member['speed'] is not None:
+                    line += ' {}/s'.format(format_bytes(member['speed']))
+                if member['utilization'] is not None:
+                    line += ', drive {} {:.0f}% busy'.format(
+                        member['drive'], member['utilization'] * 100)
+                if member['bottleneck']:
+                    line += ' <- bottleneck'
+                lines.append(line)
+        return '\n'.join(lines)
+
+
+class StackTuner(object):
+    """Tunes the block devices beneath a logical volume for a workload.
+
+    The stack is the LV's device-mapper device, on md arrays, on the member
+    drives.  md and dm devices are bio-based, with no I/O scheduler or
+    request queue of their own, so all they take is read-ahead.  Each
+    array's is set from its full stripe width (chunk size times data
+    members), so that sequential reads fetch whole stripes, and the LV's is
+    the largest of its arrays', since a read can land on any tier.  The
+    member drives take the scheduler, nr_requests and queue depth.
+
+    Settings a device doesn't have (eg. queue_depth on drives which aren't
+    SCSI or SATA) are skipped.  None of them persist across a reboot.
+
+    """
+    # The settings of each profile.  Read-ahead is in KiB: stripes full
+    # stripes, but at least min_read_ahead (eg. for mirrors, which have no
+    # stripes).  The first of the schedulers the kernel offers is used.
+    PROFILES = {
+        # Large sequential transfers: several stripes of read-ahead, and deep
+        # queues for the scheduler to merge and sort.
+        'throughput': {'stripes': 4,
+                       'min_read_ahead': 1024,
+                       'schedulers': {'rotational': ['mq-deadline'],
+                                      'ssd': ['none']},
+                       'nr_requests': 256,
+                       'queue_depth': 32},
+        # Small random I/O: a single stripe of read-ahead, and short queues so
+        # that requests don't wait behind each other.
+        'latency': {'stripes': 1,
+                    'min_read_ahead': 128,
+                    'schedulers': {'rotational': ['bfq', 'mq-deadline'],
+                                   'ssd': ['kyber', 'none']},
+                    'nr_requests': 64,
+                    'queue_depth': 8}}
+    DEFAULT_PROFILE = 'throughput'
+
+    def __init__(self, lvmexec, lv_name, profile=DEFAULT_PROFILE):
+        self.lvmexec = lvmexec
+        self.lv_name = lv_name
+        self.profile = profile
+
+    def read_ahead(self, array):
+        """The read-ahead for an array, in KiB."""
+        settings = StackTuner.PROFILES[self.profile]
+        stripe = 0
+        if array['level'] != 'raid1':
+            stripe = array['chunk_size'] // 1024 * (array['raid_disks'] - 1)
+        return max(settings['min_read_ahead'], settings['stripes'] * stripe)
+
+    def setting(self, device, path, recommended):
+        """A setting of a device, or None if the device doesn't have it."""
+        current = self.lvmexec.read_sysfs(path)
+        if current is None or recommended is None:
+            return None
+        return {'device': device,
+                'name': os.path.basename(path),
+                'path': path,
+                'current': current,
+                'recommended': str(recommended)}
+
+    def scheduler(self, device, path, rotational):
+        """The scheduler setting of a drive: the profile's first available.
+
+        The kernel lists the schedulers with the current one in brackets.
+
+        """
+        available = self.lvmexec.read_sysfs(path)
+        if available is None:
+            return None
+        names = available.split()
+        current = [name.strip('[]') for name in names if name.startswith('[')]
+        names = [name.strip('[]') for name in names]
+        wanted = StackTuner.PROFILES[self.profile]['schedulers'][
+            'rotational' if rotational else 'ssd']
+        recommended = [name for name in wanted if name in names]
+        if not recommended:
+            return None
+        return {'device': device,
+                'name': 'scheduler',
+                'path': path,
+                'current': current[0] if current else 'none',
+                'recommended': recommended[0]}
+
+    def settings(self):
+        """The current and recommended settings of every device in the stack.
+
+        Returns a list of dictionaries, each with the device, the name of the
+        setting, its sysfs path, and its current and recommended values, top
+        of the stack first.
+
+        """
+        settings = StackTuner.PROFILES[self.profile]
+        report = StatusReport(self.lvmexec, self.lv_name).gather()
+        block_dir = lambda name: '/sys/block/{}'.format(
+            os.path.basename(self.lvmexec.backend.realpath(name)))
+
+        # The LV reads ahead as far as the furthest reaching array.
+        read_aheads = [self.read_ahead(array) for array in report.arrays]
+        found = [self.setting(self.lv_name,
+                              block_dir(self.lv_name) + '/queue/read_ahead_kb',
+                              max(read_aheads or [settings['min_read_ahead']]))]
+        for array, read_ahead in zip(report.arrays, read_aheads):
+            found.append(self.setting(array['name'],
+                                      block_dir(array['name']) + '/queue/read_ahead_kb',
+                                      read_ahead))
+        for drive in report.drives:
+            queue_dir = block_dir(drive['name']) + '/queue'
+            rotational = self.lvmexec.read_sysfs(queue_dir + '/rotational') != '0'
+            found.append(self.scheduler(drive['name'], queue_dir + '/scheduler',
+                                        rotational))
+            found.append(self.setting(drive['name'], queue_dir + '/nr_requests',
+                                      settings['nr_requests']))
+            found.append(self.setting(drive['name'],
+                                      block_dir(drive['name']) + '/device/queue_depth',
+                                      settings['queue_depth']))
+        return [setting for setting in found if setting is not None]
+
+    def apply(self):
+        """Apply the profile, returning the settings which were changed.
+
+        A setting the device refuses (eg. a queue depth beyond what it
+        supports) is logged and left as it is.
+
+        """
+        changed = []
+        for setting in self.settings():
+            if setting['current'] == setting['recommended']:
+                continue
+            try:
+                self.lvmexec.write_sysfs(setting['path'], setting['recommended'])
+            except (IOError, OSError) as e:
+                self.lvmexec.log('Could not set {} of {} to {}: {}'.format(
+                    setting['name'], setting['device'], setting['recommended'],
+                    e.strerror or e), logging.WARNING)
+                continue
+            changed.append(setting)
+        return changed
+
+
+class Scrubber(object):
+    """Checks the parity of a logical volume's arrays, a window at a time.
+
+    Each window is the same range of every member of an array, fenced off
+    with md's sync_min and sync_max before starting a check (or repair).
+    When the window is done its mismatch_cnt is recorded in the history, so
+    the next scrub carries on from the end of the last window, and a repair
+    can be aimed at just the windows which had mismatches.
+
+    Arrays which share a drive are never scrubbed at the same time.  Arrays
+    on disjoint sets of drives are grouped, and each group's arrays are
+    scrubbed together, unless serial is set.  A scrub stops once it has
+    covered budget bytes of each member, summed over the arrays, and md is
+    held to max_speed bytes/s per member while it runs.
+
+    An operation which needs an array that's being checked pauses the check
+    (see RaidArray.pause_scrub()).  The window is then recorded as far as it
+    got, and the rest of that array is left to the next scrub.
+
+    """
+    DEFAULT_WINDOW = 4 * 1000 * 1000 * 1000
+    POLL_INTERVAL = 10  # Seconds.
+
+    def __init__(self, lvmexec, lv_name, window=DEFAULT_WINDOW, budget=None,
+                 max_speed=None, serial=False):
+        self.lvmexec = lvmexec
+        self.lv_name = lv_name
+        self.window = window
+        self.budget = budget
+        self.max_speed = max_speed
+        self.serial = serial
+        self.results = []  # The windows scrubbed, as recorded in the history.
+
+    def arrays(self):
+        """The LV's arrays which can be scrubbed, least recently first.
+
+        Arrays part way through a pass come first, then those whose last
+        window was longest ago.  Busy arrays (eg. resyncing) are skipped.
+
+        """
+        report = StatusReport(self.lvmexec, self.lv_name).gather()
+        arrays = []
+        for array in report.arrays:
+            if array['sync_action'] != 'idle':
+                self.lvmexec.log('Not scrubbing {}, which is busy ({})'.format(
+                    array['name'], array['sync_action']), logging.WARNING)
+                continue
+            checks = [window for window in
+                      self.lvmexec.op_history.scrubs(array['name'])
+                      if window['action'] == 'check' and
+                      window['total'] == array['member_size']]
+            array['position'] = 0
+            array['last_scrubbed'] = 0
+            if checks:
+                array['last_scrubbed'] = checks[-1]['finished']
+                if checks[-1]['end'] < array['member_size']:
+                    array['position'] = checks[-1]['end']
+            arrays.append(array)
+        arrays.sort(key=lambda array: (array['position'] == 0,
+                                       array['last_scrubbed']))
+        return arrays
+
+    def groups(self, arrays):
+        """Split arrays into groups with no drive in common."""
+        groups = []
+        for array in arrays:
+            drives = set(member['drive'] for member in array['members'])
+            for group in groups:
+                if not self.serial and not drives & group[0]:
+                    group[0].update(drives)
+                    group[1].append(array)
+                    break
+            else:
+                groups.append((drives, [array]))
+        return [group[1] for group in groups]
+
+    def alignment(self, array):
+        """Windows start and end on chunk boundaries."""
+        return array['chunk_size'] or 64 * 1024
+
+    def check_windows(self, arrays):
+        """The windows to check in each array, within the budget.
+
+        Returns a list of (start, end) byte offsets for each array.
+
+        """
+        budget = self.budget
+        windows = []
+        for array in arrays:
+            align = self.alignment(array)
+            size = max(align, self.window - self.window % align)
+            ranges = []
+            position = array['position']
+            while (position < array['member_size'] and
+                   (budget is None or budget >= align)):
+                end = min(position + size, array['member_size'])
+                if budget is not None:
+                    end = min(end, position + budget - budget % align)
+                    budget -= end - position
+                ranges.append((position, end))
+                position = end
+            windows.append(ranges)
+        return windows
+
+    def repair_windows(self, arrays):
+        """The windows in each array which had mismatches, and haven't been
+        repaired since."""
+        windows = []
+        for array in arrays:
+            bad = collections.OrderedDict()
+            for window in self.lvmexec.op_history.scrubs(array['name']):
+                key = (window['start'], window['end'])
+                if window['action'] == 'check' and window['mismatches']:
+                    bad[key] = True
+                elif window['action'] == 'repair':
+                    bad.pop(key, None)
+            windows.append(list(bad.keys()))
+        return windows
+
+    def run(self, action='check'):
+        """Scrub the arrays, returning the windows scrubbed."""
+        arrays = self.arrays()
+        if action == 'check':
+            windows = self.check_windows(arrays)
+        else:
+            windows = self.repair_windows(arrays)
+        work = dict((array['name'], ranges)
+                    for array, ranges in zip(arrays, windows) if ranges)
+        for group in self.groups([array for array in arrays
+                                  if array['name'] in work]):
+            self.lvmexec.log('Scrubbing {} together'.format(
+                ', '.join(array['name'] for array in group)))
+            self.lvmexec.run_parallel([
+                functools.partial(self.scrub_array, array, work[array['name']],
+                                  action)
+                for array in group])
+        return self.results
+
+    def scrub_array(self, array, windows, action):
+        """Check or repair each window of an array in turn."""
+        md_dir = '/sys/block/{}/md/'.format(
+            os.path.basename(self.lvmexec.backend.realpath(array['name'])))
+        write = lambda attr, value: self.lvmexec.write_sysfs(md_dir + attr, value)
+        read = lambda attr: self.lvmexec.read_sysfs(md_dir + attr)
+        if self.max_speed is not None:
+            write('sync_speed_max', self.max_speed // 1024)
+        try:
+            for start, end in windows:
+                started = self.lvmexec.backend.time()
+                write('sync_max', 'max')
+                write('sync_min', start // 512)
+                write('sync_max', end // 512)
+                write('sync_action', action)
+                while True:
+                    self.lvmexec.sleep(Scrubber.POLL_INTERVAL)
+                    completed = read('sync_completed') or ''
+                    if read('sync_action') == 'idle' or '/' not in completed:
+                        break
+                    if long(completed.split('/')[0]) * 512 >= end:
+                        break
+                # If the check was interrupted, md has kept where it got to.
+                paused = False
+                if read('sync_action') == 'idle':
+                    stopped = long(read('sync_min') or 0) * 512
+                    if start < stopped < end:
+                        end = stopped
+                        paused = True
+                window = {'array': array['name'],
+                          'action': action,
+                          'start': start,
+                          'end': end,
+                          'total': array['member_size'],
+                          'mismatches': long(read('mismatch_cnt') or 0),
+                          'started': started,
+                          'finished': self.lvmexec.backend.time()}
+                if read('sync_action') != 'idle':
+                    write('sync_action', 'idle')
+                self.lvmexec.op_history.record_scrub(window)
+                self.results.append(window)
+                self.lvmexec.log('{} {} from {} to {} of {}: {} mismatched sectors'
+                                 .format(action.capitalize(), array['name'],
+                                         format_bytes(start), format_bytes(end),
+                                         format_bytes(array['member_size']),
+                                         window['mismatches']),
+                                 logging.INFO)
+                if paused:
+                    self.lvmexec.log('The scrub of {} was paused by another operation'
+                                     .format(array['name']), logging.WARNING)
+                    break
+        finally:
+            # Leave the array as md would have it, even if cancelled part way
+            # through a window (which the next scrub starts again).
+            if read('sync_action') in ('check', 'repair'):
+                write('sync_action', 'idle')
+            write('sync_min', 0)
+            write('sync_max', 'max')
+            if self.max_speed is not None:
+                write('sync_speed_max', 'system')
+
+
+class OperationHistory(object):
+    """A local SQLite history of operations, and the syncs they waited for.
+
+    Each sync records the array's geometry, the drives involved, the bytes
+    rebuilt or restriped per member and how long it took, so that estimates
+    can be based on how this hardware actually performs, and slowdowns as
+    drives age can be spotted.
+
+    The windows checked by each scrub are recorded too, with the mismatches
+    found in each, so that a scrub carries on where the last one stopped (see
+    Scrubber).
+
+    Recording history is best effort: if the database can't be opened, a
+    warning is logged and operations carry on regardless.
+
+    """
+    DEFAULT_PATH = '/var/lib/lvmraid5/history.db'
+
+    # Number of recent syncs compared against earlier ones to find
+    # regressions, and used to estimate speeds.
+    RECENT_SYNCS = 3
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS operations (
+            id INTEGER PRIMARY KEY,
+            command TEXT,
+            argv TEXT,
+            started REAL,
+            finished REAL,
+            status TEXT);
+        CREATE TABLE IF NOT EXISTS phases (
+            operation_id INTEGER,
+            phase TEXT,
+            seconds REAL);
+        CREATE TABLE IF NOT EXISTS syncs (
+            id INTEGER PRIMARY KEY,
+            operation_id INTEGER,
+            array TEXT,
+            action TEXT,
+            level TEXT,
+            raid_devices INTEGER,
+            member_size INTEGER,
+            drives TEXT,
+            bytes INTEGER,
+            started REAL,
+            finished REAL,
+            speed REAL);
+        CREATE TABLE IF NOT EXISTS scrubs (
+            id INTEGER PRIMARY KEY,
+            operation_id INTEGER,
+            array TEXT,
+            action TEXT,
+            start INTEGER,
+            end INTEGER,
+            total INTEGER,
+            mismatches INTEGER,
+            started REAL,
+            finished REAL);
+        """
+
+    def __init__(self, lvmexec, path):
+        self.lvmexec = lvmexec
+        self.path = path
+        self.db = None
+        self.operation_id = None
+        # Syncs are recorded by the threads waiting for each array.
+        self.lock = threading.Lock()
+
+    def connect(self, create=True):
+        """Open the database, returning False if there's no history."""
+        if self.db is not None:
+            return True
+        if self.path is None or (not create and not os.path.exists(self.path)):
+            return False
+        # Imported here so that commands which don't use the history don't
+        # pay for the import.
+        import sqlite3
+        try:
+            if not os.path.isdir(os.path.dirname(self.path) or '.'):
+                os.makedirs(os.path.dirname(self.path))
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.executescript(OperationHistory.SCHEMA)
+        except (OSError, sqlite3.Error) as e:
+            self.lvmexec.log('Not recording history in {}: {}'.format(self.path, e),
+                             logging.WARNING)
+            self.path = None
+            self.db = None
+            return False
+        return True
+
+    def begin_operation(self, command, argv):
+        if self.connect():
+            with self.db:
+                self.operation_id = self.db.execute(
+                    'INSERT INTO operations (command, argv, started) VALUES (?, ?, ?)',
+                    (command, json.dumps(argv), self.lvmexec.backend.time())).lastrowid
+
+    def end_operation(self, status, phase_times):
+        if self.operation_id is None:
+            return
+        with self.db:
+            self.db.execute(
+                'UPDATE operations SET finished = ?, status = ? WHERE id = ?',
+                (self.lvmexec.backend.time(), status, self.operation_id))
+            self.db.executemany(
+                'INSERT INTO phases (operation_id, phase, seconds) VALUES (?, ?, ?)',
+                [(self.operation_id, phase, seconds)
+                 for phase, seconds in phase_times.items()])
+
+    def record_sync(self, array, started, finished, speed=None):
+        """Record a completed sync.
+
+        array is the state of the array when the sync was first seen, as
+        returned by StatusReport.gather_array().  Only the part of the sync
+        which was watched is counted.  speed is the speed seen while the sync
+        was running: the finish time is only known to within a polling
+        interval, so that's more accurate for short syncs.
+
+        """
+        if array['sync_total'] is None or finished <= started:
+            return
+        num_bytes = array['sync_total'] - array['sync_done']
+        if not speed:
+            speed = num_bytes / (finished - started)
+        with self.lock:
+            if self.connect():
+                self.insert_sync(array, num_bytes, started, finished, speed)
+
+    def insert_sync(self, array, num_bytes, started, finished, speed):
+        with self.db:
+            self.db.execute(
+                """INSERT INTO syncs (operation_id, array, action, level,
+                raid_devices, member_size, drives, bytes, started, finished,
+                speed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (self.operation_id, array['name'], array['sync_action'],
+                 array['level'], array['raid_disks'], array['member_size'],
+                 ','.join(sorted(set(member['drive'] for member in array['members']))),
+                 num_bytes, started, finished, speed))
+
+    def syncs(self, drive=None):
+        """Returns the recorded syncs, oldest first, optionally for one drive."""
+        if not self.connect(create=False):
+            return []
+        cursor = self.db.execute(
+            """SELECT array, action, level, raid_devices, member_size, drives,
+            bytes, started, finished, speed FROM syncs ORDER BY started""")
+        fields = [column[0] for column in cursor.description]
+        syncs = []
+        for row in cursor:
+            sync = dict(zip(fields, row))
+            sync['drives'] = sync['drives'].split(',')
+            if drive is None or drive in sync['drives']:
+                syncs.append(sync)
+        return syncs
+
+    def record_scrub(self, window):
+        """Record a window of an array which has been checked or repaired.
+
+        window is a dictionary of the array, action, the start and end of
+        the window and total size of each member in bytes, the mismatch_cnt
+        (in sectors) and when it started and finished.
+
+        """
+        with self.lock:
+            if self.connect():
+                with self.db:
+                    self.db.execute(
+                        """INSERT INTO scrubs (operation_id, array, action, start,
+                        end, total, mismatches, started, finished) VALUES
+                        (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                        (self.operation_id, window['array'], window['action'],
+                         window['start'], window['end'], window['total'],
+                         window['mismatches'], window['started'],
+                         window['finished']))
+
+    def scrubs(self, array=None):
+        """Returns the recorded scrub windows, oldest first."""
+        if not self.connect(create=False):
+            return []
+        cursor = self.db.execute(
+            """SELECT array, action, start, end, total, mismatches, started,
+            finished FROM scrubs ORDER BY finished, id""")
+        fields = [column[0] for column in cursor.description]
+        return [window for window in (dict(zip(fields, row)) for row in cursor)
+                if array is None or window['array'] == array]
+
+    def phase_times(self):
+        """Returns the median seconds in each phase, keyed on command.
+
+        Also returns the number of operations each median is over.
+
+        """
+        if not self.connect(create=False):
+            return {}
+        times = {}
+        for command, phase, seconds in self.db.execute(
+                """SELECT command, phase, seconds FROM phases JOIN operations
+                ON phases.operation_id = operations.id
+                WHERE status = 'ok'"""):
+            times.setdefault(command, {}).setdefault(phase, []).append(seconds)
+        counts = dict(self.db.execute(
+            """SELECT command, COUNT(*) FROM operations WHERE status = 'ok'
+            GROUP BY command"""))
+        return dict((command, (dict((phase, median(values))
+                                    for phase, values in phases.items()),
+                               counts.get(command, 0)))
+                    for command, phases in times.items())
+
+    def typical_speed(self, drives=None):
+        """The median speed of recent syncs involving any of the drives.
+
+        Returns None if there's no history to go on.
+
+        """
+        syncs = [sync for sync in self.syncs()
+                 if drives is None or set(drives) & set(sync['drives'])]
+        if not syncs:
+            return None
+        return median([sync['speed']
+                       for sync in syncs[-OperationHistory.RECENT_SYNCS:]])
+
+    def drive_trends(self, threshold):
+        """Compare each drive's recent sync speeds with its earlier ones.
+
+        Returns a list of dictionaries (drive, syncs, earlier, recent,
+        change, regressed), where earlier and recent are median speeds and a
+        drive has regressed if it's slowed by more than threshold (a
+        fraction).  Speeds are only compared once there are at least two
+        earlier syncs.
+
+        """
+        by_drive = {}
+        for sync in self.syncs():
+            for drive in sync['drives']:
+                by_drive.setdefault(drive, []).append(sync['speed'])
+
+        trends = []
+        for drive, speeds in sorted(by_drive.items()):
+            recent = speeds[-OperationHistory.RECENT_SYNCS:]
+            earlier = speeds[:-OperationHistory.RECENT_SYNCS]
+            trend = {'drive': drive,
+                     'syncs': len(speeds),
+                     'earlier': median(earlier) if len(earlier) >= 2 else None,
+                     'recent': median(recent),
+                     'change': None,
+                     'regressed': False}
+            if trend['earlier']:
+                trend['change'] = (trend['recent'] - trend['earlier']) / trend['earlier']
+                trend['regressed'] = trend['change'] < -threshold
+            trends.append(trend)
+        return trends
+
+
+class OperationJournal(object):
+    """A crash-safe record of the progress of a plan being run.
+
+    Before each step that changes anything, the journal is rewritten (to a
+    temporary file which is synced and renamed over the old one) with the
+    step about to run, and a checkpoint of the state it's about to change.
+    If the process dies, the resume command uses this to work out whether
+    the interrupted step took effect, and carries on from there.
+
+    Steps which run concurrently (see LvmRaidExec.step_groups()) can be in
+    progress together, and finish out of order: next_step is the first step
+    not yet completed, and completed lists any later steps which have.
+
+    The journal is removed once the plan completes.
+
+    """
+    DEFAULT_PATH = '/var/lib/lvmraid5/journal.json'
+
+    @staticmethod
+    def path_for(vg_name):
+        """The journal for operations on one VG, so several can run at once."""
+        return os.path.join(os.path.dirname(OperationJournal.DEFAULT_PATH),
+                            'journal-{}.json'.format(os.path.basename(vg_name)))
+
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return self.path is not None
+
+    def load(self):
+        """Returns the journal of an interrupted plan, or None."""
+        if not self.enabled():
+            return None
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except IOError:
+            return None
+        return self.data
+
+    def write(self):
+        if not self.enabled():
+            return
+        directory = os.path.dirname(self.path) or '.'
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=1, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    def begin(self, command, lv_name, plan, options):
+        """Start journalling a plan."""
+        self.data = {'command': command,
+                     'lv': lv_name,
+                     'plan': plan.to_dict(),
+                     'options': options,
+                     'refs': {},
+                     'next_step': 0,
+                     'completed': [],
+                     'in_progress': {}}
+        self.write()
+
+    def start_step(self, index, refs, checkpoint=None):
+        """Record that a step is about to run."""
+        with self.lock:
+            self.data['refs'] = dict(refs)
+            self.data['in_progress'][str(index)] = checkpoint or {}
+            self.write()
+
+    def finish_step(self, index, refs):
+        """Record that a step has completed."""
+        with self.lock:
+            self.data['refs'] = dict(refs)
+            self.data['in_progress'].pop(str(index), None)
+            completed = set(self.data['completed'])
+            completed.add(index)
+            while self.data['next_step'] in completed:
+                completed.remove(self.data['next_step'])
+                self.data['next_step'] += 1
+            self.data['completed'] = sorted(completed)
+            self.write()
+
+    def record_pause(self, array, completed, when):
+        """Record how far a reshape had got when the command detached."""
+        with self.lock:
+            if self.data is None:
+                return
+            self.data['paused'] = {'array': array,
+                                   'completed': completed,
+                                   'time': when}
+            self.write()
+
+    def finish(self):
+        """The plan has completed (or never changed anything): forget it."""
+        self.data = None
+        if self.enabled() and os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class MdadmConfig(object):
+    """The section of mdadm.conf that lvmraid5 keeps for its arrays.
+
+    Without ARRAY lines, mdadm has to assemble arrays at boot by scanning
+    every device for superblocks, and may give them different names (eg.
+    /dev/md127).  The section lists each VG's arrays by UUID and name, under
+    a hint line naming the VG and its PVs, so that the assemble command can
+    assemble exactly those arrays and have LVM look only at them.  It's
+    rewritten whenever a VG's arrays change; the rest of the file is left
+    alone.
+
+    """
+    BEGIN = '# BEGIN lvmraid5: this section is managed by lvmraid5, do not edit'
+    END = '# END lvmraid5'
+    hint_re = re.compile('^# lvmraid5 vg=(?P<vg>\S+) pvs=(?P<pvs>\S*)$')
+    array_re = re.compile('^ARRAY\s+(?P<device>\S+)')
+    uuid_re = re.compile('UUID=(?P<uuid>\S+)')
+
+    # Writers of the file, in this process (see Operation).
+    lock = threading.Lock()
+
+    @staticmethod
+    def default_path():
+        """Where the system's mdadm.conf is: Debian keeps it in /etc/mdadm."""
+        if os.path.isdir('/etc/mdadm'):
+            return '/etc/mdadm/mdadm.conf'
+        return '/etc/mdadm.conf'
+
+    @staticmethod
+    def array_line(array):
+        """The ARRAY line for an array, in the style of mdadm --detail --scan."""
+        return 'ARRAY {}{}{} UUID={}'.format(
+            array['device'],
+            ' metadata={}'.format(array['metadata']) if array.get('metadata') else '',
+            ' name={}'.format(array['name']) if array['name'] else '',
+            array['uuid'])
+
+    def __init__(self, path):
+        self.path = path
+
+    def enabled(self):
+        return self.path is not None
+
+    def read(self):
+        """Split the file into the lines before, the VGs and the lines after.
+
+        The VGs are an ordered dictionary of the hint for each VG: a
+        dictionary of its PVs, and the ARRAY lines listed under it.
+
+        """
+        try:
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+        except IOError:
+            lines = []
+        if MdadmConfig.BEGIN not in lines:
+            return lines, collections.OrderedDict(), []
+        begin = lines.index(MdadmConfig.BEGIN)
+        end = (lines.index(MdadmConfig.END) if MdadmConfig.END in lines[begin:]
+               else len(lines))
+        vgs = collections.OrderedDict()
+        hint = None
+        for line in lines[begin + 1:end]:
+            m = MdadmConfig.hint_re.match(line)
+            if m is not None:
+                hint = vgs.setdefault(m.group('vg'), {
+                    'pvs': [pv for pv in m.group('pvs').split(',') if pv],
+                    'arrays': []})
+            elif hint is not None and MdadmConfig.array_re.match(line):
+                hint['arrays'].append(line)
+        return lines[:begin], vgs, lines[end + 1:]
+
+    def vgs(self):
+        """The VGs listed, as returned by read()."""
+        return self.read()[1]
+
+    def uuid_of(self, device):
+        """The UUID an array is listed with, or None."""
+        for vg in self.vgs().values():
+            for line in vg['arrays']:
+                if MdadmConfig.array_re.match(line).group('device') == device:
+                    m = MdadmConfig.uuid_re.search(line)
+                    return m and m.group('uuid')
+        return None
+
+    def conflicts(self, arrays):
+        """ARRAY lines outside the managed section for any of the arrays.
+
+        These are typically left by mdadm --detail --scan >> mdadm.conf (as
+        Debian's installer does), and go stale when an array is recreated
+        with a new UUID.
+
+        """
+        if not self.enabled():
+            return []
+        before, _, after = self.read()
+        devices = set(array['device'] for array in arrays)
+        uuids = set(array['uuid'].lower() for array in arrays)
+        found = []
+        for line in before + after:
+            m = MdadmConfig.array_re.match(line)
+            if m is None:
+                continue
+            uuid = MdadmConfig.uuid_re.search(line)
+            if (m.group('device') in devices or
+                    (uuid is not None and uuid.group('uuid').lower() in uuids)):
+                found.append(line)
+        return found
+
+    def update(self, vg_name, arrays):
+        """List a VG's arrays (dictionaries of device, uuid and name).
+
+        A VG with no arrays is dropped.  Returns whether anything changed.
+
+        """
+        if not self.enabled():
+            return False
+        vg_name = os.path.basename(vg_name)
+        with MdadmConfig.lock:
+            before, vgs, after = self.read()
+            entry = {'pvs': [array['device'] for array in arrays],
+                     'arrays': [MdadmConfig.array_line(array) for array in arrays]}
+            if vgs.get(vg_name) == (entry if arrays else None):
+                return False
+            if arrays:
+                vgs[vg_name] = entry
+            else:
+                vgs.pop(vg_name, None)
+
+            section = []
+            if vgs:
+                section.append(MdadmConfig.BEGIN)
+                for name, vg in vgs.items():
+                    section.append('# lvmraid5 vg={} pvs={}'.format(
+                        name, ','.join(vg['pvs'])))
+                    section += vg['arrays']
+                section.append(MdadmConfig.END)
+            self.write(before + section + after)
+        return True
+
+    def write(self, lines):
+        """Replace the file, atomically as for the journal."""
+        directory = os.path.dirname(self.path) or '.'
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(self.path):
+            shutil.copymode(self.path, tmp_path)
+        os.rename(tmp_path, self.path)
+
+
+class RealBackend(object):
+    """Runs commands and reads state on the real system.
+
+    All access to the system goes through a backend, so that a simulation can
+    be substituted (see SimulatedBackend).
+
+    Commands may be run from several threads at once (see
+    LvmRaidExec.run_parallel()).
+
+    """
+    concurrent = True
+
+    # Seconds between checks for a timeout or cancellation while a command
+    # runs, and how long a terminated command gets to exit before it's killed.
+    POLL_INTERVAL = 0.1
+    TERMINATE_GRACE = 2
+
+    # Lines of a command's output kept, from the end, unless all of it is
+    # asked for.
+    OUTPUT_TAIL_LINES = 200
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pexpect_logfile = None
+
+    @property
+    def EOF(self):
+        """What to expect() for the end of a spawned process."""
+        return get_pexpect().EOF
+
+    def run(self, cmd, timeout=None, cancel=None, on_output=None,
+            full_output=False):
+        """Run a command, returning its output (stdout and stderr combined).
+
+        The output is passed to on_output a line at a time as it arrives.
+        Only the last OUTPUT_TAIL_LINES lines are returned, unless
+        full_output is set.  If the command runs for longer than timeout
+        seconds, or the cancel event is set, the command is terminated and
+        LvmRaidTimeout or LvmRaidCancelled raised.
+
+        Raises subprocess.CalledProcessError if the command fails.
+
+        """
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, close_fds=True)
+        if full_output:
+            lines = []
+        else:
+            lines = collections.deque(maxlen=RealBackend.OUTPUT_TAIL_LINES)
+
+        def read_output():
+            for line in iter(proc.stdout.readline, b''):
+                lines.append(line)
+                if on_output is not None:
+                    on_output(line)
+
+        reader = threading.Thread(target=read_output)
+        reader.daemon = True
+        reader.start()
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            reader.join(RealBackend.POLL_INTERVAL)
+            if not reader.is_alive():
+                break
+            if cancel is not None and cancel.is_set():
+                self.terminate(proc)
+                raise LvmRaidCancelled('Cancelled: {}'.format(' '.join(cmd)))
+            if deadline is not None and time.time() > deadline:
+                self.terminate(proc)
+                raise LvmRaidTimeout('Timed out after {:g}s: {}'.format(
+                    timeout, ' '.join(cmd)))
+
+        output = ''.join(lines)
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+        return output
+
+    def terminate(self, proc):
+        """Stop a command, killing it if it doesn't exit promptly."""
+        proc.terminate()
+        deadline = time.time() + RealBackend.TERMINATE_GRACE
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(RealBackend.POLL_INTERVAL)
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+    def spawn(self, cmd, timeout=None):
+        """Spawn an interactive command, returning a pexpect object.
+
+        timeout applies to each expect().
+
+        """
+        return get_pexpect().spawn(cmd, timeout=timeout,
+                                   logfile=self.pexpect_log())
+
+    def pexpect_log(self):
+        """The fdisk session log, opened once and shared by every spawn."""
+        with self.lock:
+            if self.pexpect_logfile is None:
+                self.pexpect_logfile = RotatingLogFile(PEXPECT_LOG_FILE)
+            return self.pexpect_logfile
+
+    def sleep(self, seconds, cancel=None):
+        """Sleep, waking early to raise LvmRaidCancelled if cancelled."""
+        if cancel is None:
+            time.sleep(seconds)
+        elif cancel.wait(seconds):
+            raise LvmRaidCancelled('Cancelled while waiting')
+
+    def time(self):
+        return time.time()
+
+    def read_file(self, path):
+        """Read a file (typically in sysfs), returning None if it's missing."""
+        try:
+            with open(path) as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def write_file(self, path, text):
+        """Write to a file (typically in sysfs)."""
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def glob(self, pattern):
+        return glob.glob(pattern)
+
+    def realpath(self, path):
+        return os.path.realpath(path)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def find_binaries(self, names):
+        return resolve_binaries(names)
+
+    def close(self):
+        with self.lock:
+            if self.pexpect_logfile is not None:
+                self.pexpect_logfile.close()
+                self.pexpect_logfile = None
+
+
+class SimulatedEOF(object):
+    """Stands in for pexpect.EOF when talking to simulated commands."""
+
+
+class SimulatedFdisk(object):
+    """Simulates an interactive fdisk session on a simulated drive.
+
+    Supports the subset of the pexpect interface used on fdisk (expect(),
+    sendline(), before and match), producing the same prompts and output as
+    the old-style (util-linux 2.20) fdisk with an MS-DOS partition table.
+
+    """
+    prompt = '\nCommand (m for help): '
+    last_sector_prompt = 'Last sector, +sectors or +size{{K,M,G}} ({}-{}, default {}): '
+
+    def __init__(self, backend, drive_name):
+        self.backend = backend
+        self.drive_name = drive_name
+        self.output = ''
+        self.pos = 0
+        self.before = ''
+        self.match = None
+        self.exited = False
+        self.state = 'command'
+        self.new_partition = None
+
+        drive = backend.state['drives'].get(drive_name)
+        if drive is None:
+            self.write('fdisk: unable to open {}: No such file or directory\n'
+                       .format(drive_name))
+            self.exited = True
+        else:
+            self.drive = drive
+            self.extended = copy.deepcopy(drive['extended'])
+            self.partitions = copy.deepcopy(drive['partitions'])
+            self.write('\nWelcome to fdisk (util-linux 2.20.1).\n' +
+                       SimulatedFdisk.prompt)
+
+    def write(self, text):
+        self.output += text
+
+    def expect(self, patterns):
+        """Wait for one of the patterns, returning the index of the match."""
+        if not isinstance(patterns, list):
+            patterns = [patterns]
+
+        best = None
+        for index, pattern in enumerate(patterns):
+            if pattern is SimulatedEOF:
+                continue
+            m = re.compile(pattern).search(self.output, self.pos)
+            if m is not None and (best is None or m.start() < best[1].start()):
+                best = (index, m)
+        if best is not None:
+            self.before = self.output[self.pos:best[1].start()]
+            self.match = best[1]
+            self.pos = best[1].end()
+            return best[0]
+
+        if self.exited and SimulatedEOF in patterns:
+            self.before = self.output[self.pos:]
+            self.pos = len(self.output)
+            return patterns.index(SimulatedEOF)
+
+        raise LvmRaidException(
+            'Simulated fdisk on {} timed out waiting for {}, with output: {}'
+            .format(self.drive_name, patterns, self.output[self.pos:]))
+
+    def sendline(self, line):
+        """Send a line of input to the simulated fdisk."""
+        assert(not self.exited)
+        getattr(self, 'handle_' + self.state)(line.strip())
+
+    def total_sectors(self):
+        return self.drive['size'] // 512
+
+    def logical_numbers(self):
+        return sorted(int(num) for num in self.partitions if int(num) >= 5)
+
+    def next_logical_start(self):
+        logicals = self.logical_numbers()
+        if logicals:
+            return self.partitions[str(logicals[-1])]['end'] + 1 + 2048
+        return self.extended['start'] + 2048
+
+    def handle_command(self, line):
+        if line == 'p':
+            self.write(self.table() + SimulatedFdisk.prompt)
+        elif line == 'n':
+            if self.extended is None:
+                self.write('Partition type:\n'
+                           '   p   primary (0 primary, 0 extended, 4 free)\n'
+                           '   e   extended\n'
+                           'Select (default p): ')
+            else:
+                self.write('Partition type:\n'
+                           '   p   primary (0 primary, 1 extended, 3 free)\n'
+                           '   l   logical (numbered from 5)\n'
+                           'Select (default p): ')
+            self.state = 'select'
+        elif line == 't':
+            self.write('Partition number (1-{0}, default {0}): '.format(
+                max([1] + self.logical_numbers())))
+            self.state = 'type_number'
+        elif line == 'w':
+            self.drive['extended'] = self.extended
+            self.drive['partitions'] = self.partitions
+            self.write('The partition table has been altered!\n\n'
+                       'Calling ioctl() to re-read partition table.\n'
+                       'Syncing disks.\n')
+            self.exited = True
+        elif line == 'q':
+            self.exited = True
+        else:
+            self.write('{}: unknown command'.format(line) + SimulatedFdisk.prompt)
+
+    def handle_select(self, line):
+        if line == 'e' and self.extended is None:
+            self.write('Partition number (1-4, default 1): ')
+            self.state = 'extended_number'
+        elif line == 'l' and self.extended is not None:
+            num = max([4] + self.logical_numbers()) + 1
+            first = self.next_logical_start()
+            self.new_partition = {'num': num, 'start': first, 'min': first,
+                                  'max': self.extended['end'], 'type': '83'}
+            self.write('Adding logical partition {}\n'.format(num))
+            self.write('First sector ({0}-{1}, default {0}): '.format(
+                first, self.extended['end']))
+            self.state = 'first_sector'
+        else:
+            raise LvmRaidException(
+                'Simulated fdisk does not support partition type {}'.format(line))
+
+    def handle_extended_number(self, line):
+        self.new_partition = {'num': int(line or 1), 'start': 2048, 'min': 2048,
+                              'max': self.total_sectors() - 1, 'type': '5'}
+        self.write('First sector (2048-{}, default 2048): '.format(
+            self.total_sectors() - 1))
+        self.state = 'first_sector'
+
+    def handle_first_sector(self, line):
+        new = self.new_partition
+        if line:
+            new['start'] = int(line)
+        self.write('Using default value {}\n'.format(new['start']))
+        self.write(SimulatedFdisk.last_sector_prompt.format(new['start'],
+                                                            new['max'],
+                                                            new['max']))
+        self.state = 'last_sector'
+
+    def handle_last_sector(self, line):
+        new = self.new_partition
+        if not line:
+            end = new['max']
+        elif line.startswith('+') and line.endswith('K'):
+            end = new['start'] + int(line[1:-1]) * 2 - 1
+        else:
+            end = int(line)
+        if end > new['max']:
+            self.write('Value out of range.\n')
+            self.write(SimulatedFdisk.last_sector_prompt.format(new['start'],
+                                                                new['max'],
+                                                                new['max']))
+            return
+
+        partition = {'start': new['start'], 'end': end, 'type': new['type']}
+        if new['type'] == '5':
+            self.extended = partition
+        self.partitions[str(new['num'])] = partition
+        self.new_partition = None
+        self.write(SimulatedFdisk.prompt)
+        self.state = 'command'
+
+    def handle_type_number(self, line):
+        self.type_number = line
+        self.write('Hex code (type L to list codes): ')
+        self.state = 'type_code'
+
+    def handle_type_code(self, line):
+        self.partitions[self.type_number]['type'] = line
+        self.write('Changed system type of partition {} to {} (Linux raid autodetect)\n'
+                   .format(self.type_number, line) + SimulatedFdisk.prompt)
+        self.state = 'command'
+
+    def table(self):
+        """The output of fdisk's print command."""
+        lines = ['',
+                 'Disk {}: {} MB, {} bytes'.format(self.drive_name,
+                                                   self.drive['size'] // 1000000,
+                                                   self.drive['size']),
+                 '255 heads, 63 sectors/track, {} cylinders, total {} sectors'.format(
+                     self.total_sectors() // 16065, self.total_sectors()),
+                 'Units = sectors of 1 * 512 = 512 bytes',
+                 'Sector size (logical/physical): 512 bytes / 512 bytes',
+                 'I/O size (minimum/optimal): 512 bytes / 512 bytes',
+                 'Disk identifier: 0x00000000',
+                 '',
+                 '   Device Boot      Start         End      Blocks   Id  System']
+        for num in sorted(self.partitions, key=int):
+            part = self.partitions[num]
+            system = {'5': 'Extended', 'fd': 'Linux raid autodetect'}.get(
+                part['type'], 'Linux')
+            lines.append('{}{:<10} {:>11} {:>11} {:>11}   {:>2}  {}'.format(
+                self.drive_name, num, part['start'], part['end'],
+                (part['end'] - part['start'] + 1) // 2, part['type'], system))
+        return '\n'.join(lines) + '\n'
+
+
+class SimulatedBackend(object):
+    """An in-memory simulation of drives, md arrays and LVM.
+
+    Understands the fdisk, mdadm and LVM commands that lvmraid5 runs, and the
+    sysfs files it reads.  Time is simulated too: sleeping advances the clock
+    instantly, and resyncs, rebuilds and reshapes progress at a configurable
+    rate, so that whole scenarios run in milliseconds.
+
+    The state is a plain dictionary, so it can be saved to a file between
+    invocations (see --simulate).
+
+    There's a single simulated clock, advanced by whichever caller sleeps,
+    so tasks which would run in parallel on the real system are run one
+    after another, to keep simulations deterministic.
+
+    """
+    concurrent = False
+    DEFAULT_RATE = 100 * 1000 * 1000  # Bytes/s per member.
+    EXTENT_SIZE = 4 * 1024 * 1024
+    DATA_OFFSET = 1024 * 1024  # Space used by the md superblock.
+    SCHEDULERS = ['mq-deadline', 'kyber', 'bfq', 'none']  # For drives.
+    ASSEMBLE_TIME = 0.05  # Seconds to read each member's superblock.
+    EOF = SimulatedEOF
+
+    def __init__(self, drive_sizes=None, rate=DEFAULT_RATE, state=None,
+                 state_file=None):
+        """Create a simulation of drives with the given sizes.
+
+        The drives are named /dev/sdb, /dev/sdc, etc.
+
+        """
+        self.state_file = state_file
+        if state is not None:
+            self.state = state
+            return
+
+        self.state = {'time': 1000000000.0,
+                      'rate': rate,
+                      'drives': {},
+                      'arrays': {},
+                      'pvs': {},
+                      'vgs': {},
+                      'lvs': {},
+                      'io': {}}
+        for index, size in enumerate(drive_sizes or []):
+            self.add_drive('/dev/sd' + chr(ord('b') + index), size)
+
+    @classmethod
+    def load(cls, state_file, drive_sizes=None):
+        """Load a simulation from a file, or create a new one.
+
+        drive_sizes is a comma-separated string of sizes (eg. 1TB,2TB), used
+        if the file doesn't exist yet.
+
+        """
+        try:
+            with open(state_file) as f:
+                return cls(state=json.load(f), state_file=state_file)
+        except IOError:
+            check_critical(drive_sizes is not None,
+                           'No simulation in {}: give --simulate-drives to start one.'
+                           .format(state_file))
+            sizes = [parse_size(size) for size in drive_sizes.split(',')]
+            check_critical(None not in sizes,
+                           'Invalid drive sizes: {}'.format(drive_sizes))
+            return cls(drive_sizes=sizes, state_file=state_file)
+
+    def close(self):
+        """Save the simulation, if it's kept in a file."""
+        if self.state_file is not None:
+            with open(self.state_file, 'w') as f:
+                json.dump(self.state, f, indent=1, sort_keys=True)
+
+    def add_drive(self, name, size):
+        """Attach a new, empty drive."""
+        self.state['drives'][name] = {'size': long(size),
+                                      'extended': None,
+                                      'partitions': {}}
+
+    def make_filesystem(self, lv_name, fs_type, mountpoint=None):
+        """Make a filesystem filling an LV, with no stripe geometry set."""
+        lv = self.state['lvs'][self.lvm_name(lv_name)]
+        lv['fs'] = {'type': fs_type,
+                    'block_size': 4096,
+                    'blocks': lv['extents'] * SimulatedBackend.EXTENT_SIZE // 4096,
+                    'stripe_unit': 0,
+                    'stripe_width': 0,
+                    'mountpoint': mountpoint}
+
+    def shutdown(self):
+        """Simulate a reboot, up to the point where anything is assembled.
+
+        The arrays are stopped, keeping their superblocks (and any sync,
+        which carries on once reassembled), and the VGs deactivated.
+
+        """
+        self.state.setdefault('stopped', {})
+        for array in self.state['arrays'].values():
+            self.state['stopped'][array['uuid']] = array
+        self.state['arrays'] = {}
+        for vg in self.state['vgs'].values():
+            vg['active'] = False
+
+    #
+    # The backend interface.
+    #
+
+    def run(self, cmd, timeout=None, cancel=None, on_output=None,
+            full_output=False):
+        # Simulated commands complete instantly, so never time out, and their
+        # output is short, so is always returned in full.
+        if cancel is not None and cancel.is_set():
+            raise LvmRaidCancelled('Cancelled: {}'.format(' '.join(cmd)))
+        self.advance()
+        handler = getattr(self, 'run_' + cmd[0], None)
+        if handler is None:
+            raise OSError(2, 'Simulated command not found: {}'.format(cmd[0]))
+        output = handler(cmd[1:])
+        returncode = 0
+        if isinstance(output, tuple):
+            returncode, output = output
+        if on_output is not None:
+            for line in output.splitlines(True):
+                on_output(line)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, output)
+        return output
+
+    def spawn(self, cmd, timeout=None):
+        args = cmd.split()
+        assert(args[0] == 'fdisk')
+        return SimulatedFdisk(self, args[1])
+
+    def sleep(self, seconds, cancel=None):
+        if cancel is not None and cancel.is_set():
+            raise LvmRaidCancelled('Cancelled while waiting')
+        self.state['time'] += seconds
+        self.advance()
+
+    def time(self):
+        return self.state['time']
+
+    def read_file(self, path):
+        self.advance()
+        if path == '/proc/diskstats':
+            return self.diskstats()
+        return self.sysfs().get(path)
+
+    def write_file(self, path, text):
+        """Writes to the md sysfs attributes which control syncs."""
+        self.advance()
+        m = re.match('^/sys/block/(?P<dev>[^/]+)/(?P<attr>queue/[a-z_]+|device/queue_depth)$',
+                     path)
+        if m is not None:
+            self.write_queue_attr(m.group('dev'), m.group('attr'), text.strip(), path)
+            return
+        m = re.match('^/sys/block/(?P<md>md[0-9]+)/md/(?P<attr>[a-z_]+)$', path)
+        array = m and self.state['arrays'].get('/dev/' + m.group('md'))
+        if array is None:
+            raise IOError(errno.ENOENT, 'No such file or directory', path)
+        attr, value = m.group('attr'), text.strip()
+        op = array['op']
+        if attr == 'sync_min':
+            if op is not None:
+                raise IOError(errno.EBUSY, 'Device or resource busy', path)
+            array['sync_min'] = long(value) * 512
+        elif attr == 'sync_max':
+            array['sync_max'] = None if value == 'max' else long(value) * 512
+            self.rebase_op(array)
+        elif attr == 'sync_speed_max':
+            array['speed_max'] = None if value == 'system' else long(value) * 1024
+            self.rebase_op(array)
+        elif attr == 'sync_speed_min':
+            # There's no other I/O to give way to, so this doesn't change the
+            # speed.
+            array['speed_min'] = None if value == 'system' else long(value) * 1024
+        elif attr == 'sync_action' and value == 'frozen':
+            if op is not None:
+                op['frozen'] = True
+        elif attr == 'sync_action' and value == 'idle':
+            if op is not None and op['action'] in ('check', 'repair'):
+                # Like md, keep where an interrupted check got to.
+                array['sync_min'] = op['done'] - op['done'] % 512
+                array['op'] = None
+            elif op is not None and op.get('frozen'):
+                # Unfreezing restarts the sync from where it had got to.
+                op['frozen'] = False
+                self.rebase_op(array)
+        elif attr == 'sync_action' and value in ('check', 'repair'):
+            if op is not None:
+                raise IOError(errno.EBUSY, 'Device or resource busy', path)
+            array['mismatch_cnt'] = 0
+            self.start_op(array, value)
+        else:
+            raise IOError(errno.EINVAL, 'Invalid argument', path)
+
+    def glob(self, pattern):
+        return sorted(fnmatch.filter(self.sysfs_dirs(), pattern))
+
+    def realpath(self, path):
+        m = re.match('^/sys/block/md[0-9]+/md/dev-(?P<part>[a-z]+)(?P<num>[0-9]+)/block$',
+                     path)
+        if m is not None:
+            return '/sys/devices/simulated/block/{0}/{0}{1}'.format(
+                m.group('part'), m.group('num'))
+        # LVs are device-mapper devices, numbered in order of their names.
+        if self.lvm_name(path) in self.state['lvs']:
+            return '/dev/dm-{}'.format(sorted(self.state['lvs']).index(
+                self.lvm_name(path)))
+        return path
+
+    def exists(self, path):
+        return (path in self.state['arrays'] or path in self.state['drives'] or
+                self.find_partition(path) is not None)
+
+    def find_binaries(self, names):
+        return dict((name, '/sbin/' + name) for name in names)
+
+    #
+    # Helpers.
+    #
+
+    def find_partition(self, name):
+        """Returns the drive name and partition number of a partition name."""
+        m = re.match('^(?P<drive>.*[^0-9])(?P<num>[0-9]+)$', name)
+        if m is None:
+            return None
+        drive = self.state['drives'].get(m.group('drive'))
+        if drive is None or m.group('num') not in drive['partitions']:
+            return None
+        return m.group('drive'), m.group('num')
+
+    def partition_size(self, name):
+        drive_name, num = self.find_partition(name)
+        part = self.state['drives'][drive_name]['partitions'][num]
+        return (part['end'] - part['start'] + 1) * 512
+
+    def array_of(self, partition):
+        """Returns the name of the array a partition is a member of."""
+        for name, array in self.state['arrays'].items():
+            if partition in [member['name'] for member in array['members']]:
+                return name
+        return None
+
+    def capacity(self, array):
+        """The usable size of an array."""
+        raid_devices = array['raid_devices']
+        if array['op'] is not None and array['op']['action'] == 'reshape':
+            raid_devices = array['op']['old_raid_devices']
+        data_devices = 1 if array['level'] == 1 else raid_devices - 1
+        return data_devices * array['component_size']
+
+    def in_sync(self, array):
+        return [member for member in array['members']
+                if member['state'] == 'in_sync']
+
+    def account_io(self, partition, read=0, written=0, busy=0):
+        """Add to the I/O counters of a partition and its drive."""
+        drive_name = self.find_partition(partition)[0]
+        for device in (partition, drive_name):
+            counters = self.state['io'].setdefault(
+                os.path.basename(device), [0, 0, 0])
+            counters[0] += read // 512
+            counters[1] += written // 512
+            counters[2] += int(busy * 1000)
+
+    def op_rate(self, array):
+        """The speed of an array's sync, limited by its sync_speed_max."""
+        return min(self.state['rate'], array.get('speed_max') or self.state['rate'])
+
+    def advance(self):
+        """Bring any sync operations up to the current time.
+
+        Syncs pause while frozen, or when they reach the array's sync_max.  A
+        check or repair counts the sectors of any parity mismatches (planted
+        in the array's 'bad' list of offsets) that it passes.
+
+        """
+        now = self.state['time']
+        for array in self.state['arrays'].values():
+            op = array['op']
+            if op is None or op.get('frozen'):
+                continue
+            rate = self.op_rate(array)
+            limit = op['total']
+            if array.get('sync_max') is not None:
+                limit = min(limit, array['sync_max'])
+            done = max(op['done'], min(limit, op.get('base', 0) +
+                                       long((now - op['start']) * rate)))
+            delta = done - op['done']
+            elapsed = (delta / float(rate))
+            for member in array['members']:
+                if member['state'] == 'in_sync':
+                    self.account_io(member['name'], read=delta, busy=elapsed)
+                if (member['state'] == 'rebuilding' or
+                        (op['action'] == 'reshape' and member['state'] == 'in_sync')):
+                    self.account_io(member['name'], written=delta)
+            if op['action'] in ('check', 'repair'):
+                found = [offset for offset in array.get('bad', [])
+                         if op['done'] <= offset < done]
+                array['mismatch_cnt'] = array.get('mismatch_cnt', 0) + 8 * len(found)
+                if op['action'] == 'repair':
+                    array['bad'] = [offset for offset in array.get('bad', [])
+                                    if offset not in found]
+            op['done'] = done
+
+            if done >= op['total']:
+                for member in array['members']:
+                    if member['state'] == 'rebuilding':
+                        member['state'] = 'in_sync'
+                array['op'] = None
+                # Like md, forget the limits once a sync completes.
+                array['sync_max'] = None
+                if op['action'] in ('check', 'repair'):
+                    array['sync_min'] = 0
+
+    def start_op(self, array, action):
+        base = 0
+        if action in ('check', 'repair'):
+            base = array.get('sync_min', 0)
+        array['op'] = {'action': action,
+                       'start': self.state['time'],
+                       'total': array['component_size'],
+                       'base': base,
+                       'done': base,
+                       'old_raid_devices': array['raid_devices']}
+
+    def rebase_op(self, array):
+        """Carry on a sync from where it's got to, eg. at a new speed."""
+        if array['op'] is not None:
+            array['op']['base'] = array['op']['done']
+            array['op']['start'] = self.state['time']
+
+    def array_state(self, array):
+        """The state reported by mdadm --detail."""
+        op = array['op']
+        if op is not None and op['action'] == 'recover':
+            return 'clean, degraded, recovering'
+        if op is not None and op['action'] == 'reshape':
+            return 'clean, reshaping'
+        # md reports a repair as a resync.
+        if op is not None and op['action'] in ('resync', 'repair'):
+            return 'clean, resyncing'
+        if op is not None and op['action'] == 'check':
+            return 'clean, checking'
+        if len(self.in_sync(array)) < array['raid_devices']:
+            return 'clean, degraded'
+        return 'clean'
+
+    def pv_extents(self, name):
+        return max(0, (self.capacity(self.state['arrays'][name]) -
+                       SimulatedBackend.DATA_OFFSET) // SimulatedBackend.EXTENT_SIZE)
+
+    def vg_extents(self, vg_name):
+        """Returns the (total, free) extents of a VG."""
+        total = sum(self.state['pvs'][pv]['extents']
+                    for pv in self.state['vgs'][vg_name]['pvs'])
+        used = sum(lv['extents'] for lv in self.state['lvs'].values()
+                   if lv['vg'] == vg_name)
+        return total, total - used
+
+    def pv_used(self, pv_name):
+        """Extents allocated on a PV.  LVs fill their VG's PVs in order."""
+        pv = self.state['pvs'][pv_name]
+        if pv['vg'] is None:
+            return 0
+        used = sum(lv['extents'] for lv in self.state['lvs'].values()
+                   if lv['vg'] == pv['vg'])
+        for name in self.state['vgs'][pv['vg']]['pvs']:
+            extents = self.state['pvs'][name]['extents']
+            if name == pv_name:
+                return min(used, extents)
+            used = max(0, used - extents)
+        return 0
+
+    def lvm_name(self, name):
+        """Strip the /dev/ prefix from a VG or LV name."""
+        if name.startswith('/dev/'):
+            name = name[len('/dev/'):]
+        return name
+
+    #
+    # Simulated commands.
+    #
+
+    def run_partprobe(self, args):
+        return ''
+
+    def run_dd(self, args):
+        """Copies take time according to the drive's read_speed or
+        write_speed, if set, or the simulation's rate.
+
+        Arrays are modelled too, crudely: sequential reads lose a little
+        per chunk, writes smaller than a stripe pay for read-modify-write,
+        and small (random) reads pay a seek per chunk.
+
+        """
+        options = dict(arg.split('=', 1) for arg in args)
+        block_size = (1024 * 1024 if options['bs'] == '1M'
+                      else 1024 * int(options['bs'].rstrip('K')))
+        num_bytes = block_size * long(options['count'])
+        reading = options['of'] == '/dev/null'
+        name = options['if'] if reading else options['of']
+        if name in self.state['arrays']:
+            seconds = self.array_io_time(self.state['arrays'][name], block_size,
+                                         num_bytes, reading)
+        elif name in self.state['drives']:
+            drive = self.state['drives'][name]
+            key = 'read_speed' if reading else 'write_speed'
+            seconds = float(num_bytes) / drive.get(key, self.state['rate'])
+        else:
+            return (1, "dd: failed to open '{}': No such file or directory\n"
+                    .format(name))
+        self.state['time'] += seconds
+        records = options['count']
+        return ('{0}+0 records in\n{0}+0 records out\n'
+                '{1} bytes ({2}) copied, {3:g} s, {4}/s\n'.format(
+                    records, num_bytes, format_bytes(num_bytes), seconds,
+                    format_bytes(num_bytes / seconds)))
+
+    SEEK_TIME = 0.008
+
+    def array_io_time(self, array, block_size, num_bytes, reading):
+        """How long simulated I/O to an array takes."""
+        data_devices = array['raid_devices'] - 1
+        chunk = array['chunk'] * 1024
+        if block_size < 1024 * 1024:
+            # Random I/O: a seek for each chunk touched.
+            seeks = -(-block_size // chunk)
+            return (SimulatedBackend.SEEK_TIME * seeks +
+                    float(num_bytes) / self.state['rate'])
+        speed = data_devices * self.state['rate']
+        if reading:
+            speed *= float(chunk) / (chunk + 128 * 1024)
+        else:
+            speed *= min(1.0, float(block_size) / (chunk * data_devices))
+        return num_bytes / speed
+
+    def run_pvcreate(self, args):
+        if args == ['--version']:
+            return '  LVM version:     2.02.98(2) (2012-10-15)\n'
+        name = args[0]
+        if name not in self.state['arrays']:
+            return (5, '  Device {} not found (or ignored by filtering).\n'.format(name))
+        self.state['pvs'][name] = {'vg': None, 'extents': self.pv_extents(name)}
+        return '  Physical volume "{}" successfully created\n'.format(name)
+
+    def run_pvresize(self, args):
+        name = args[0]
+        self.state['pvs'][name]['extents'] = self.pv_extents(name)
+        return '  Physical volume "{}" changed\n'.format(name)
+
+    def run_vgcreate(self, args):
+        vg_name = self.lvm_name(args[0])
+        for pv in args[1:]:
+            self.state['pvs'][pv]['vg'] = vg_name
+        self.state['vgs'][vg_name] = {'pvs': list(args[1:])}
+        return '  Volume group "{}" successfully created\n'.format(vg_name)
+
+    def run_vgreduce(self, args):
+        vg_name = self.lvm_name(args[0])
+        for pv in args[1:]:
+            if self.pv_used(pv):
+                return (5, '  Physical volume "{}" still in use\n'.format(pv))
+            self.state['pvs'][pv]['vg'] = None
+            self.state['vgs'][vg_name]['pvs'].remove(pv)
+        return '  Removed "{}" from volume group "{}"\n'.format(args[1], vg_name)
+
+    def run_pvremove(self, args):
+        pv = self.state['pvs'].get(args[0])
+        if pv is None or pv['vg'] is not None:
+            return (5, '  PV {} cannot be removed\n'.format(args[0]))
+        del self.state['pvs'][args[0]]
+        return '  Labels on physical volume "{}" successfully wiped.\n'.format(args[0])
+
+    def run_vgextend(self, args):
+        vg_name = self.lvm_name(args[0])
+        for pv in args[1:]:
+            self.state['pvs'][pv]['vg'] = vg_name
+            self.state['vgs'][vg_name]['pvs'].append(pv)
+        return '  Volume group "{}" successfully extended\n'.format(vg_name)
+
+    def run_vgchange(self, args):
+        """Activate a VG, seeing only the devices the --config filter allows."""
+        vg_name = self.lvm_name(args[-1])
+        if vg_name not in self.state['vgs']:
+            return (5, '  Volume group "{}" not found\n'.format(vg_name))
+        accept = None
+        if '--config' in args:
+            accept = re.findall('"a\|(.*?)\|"', args[args.index('--config') + 1])
+        for pv in self.state['vgs'][vg_name]['pvs']:
+            if (pv not in self.state['arrays'] or
+                    accept is not None and not any(re.match(pattern, pv)
+                                                   for pattern in accept)):
+                return (5, '  Couldn\'t find device for PV {}.\n'.format(pv))
+        self.state['vgs'][vg_name]['active'] = True
+        return '  {} logical volume(s) in volume group "{}" now active\n'.format(
+            len([lv for lv in self.state['lvs'].values() if lv['vg'] == vg_name]),
+            vg_name)
+
+    def run_lvcreate(self, args):
+        lv_name = os.path.basename(args[args.index('--name') + 1])
+        vg_name = self.lvm_name(args[-1])
+        self.state['lvs']['{}/{}'.format(vg_name, lv_name)] = {
+            'vg': vg_name, 'extents': self.vg_extents(vg_name)[1]}
+        return '  Logical volume "{}" created\n'.format(lv_name)
+
+    def run_lvextend(self, args):
+        lv = self.state['lvs'][self.lvm_name(args[-1])]
+        lv['extents'] += self.vg_extents(lv['vg'])[1]
+        return '  Logical volume {} successfully resized\n'.format(args[-1])
+
+    def run_lvdisplay(self, args):
+        lv_name = self.lvm_name(args[0])
+        if lv_name not in self.state['lvs']:
+            return (5, '  One or more specified logical volume(s) not found.\n')
+        lv = self.state['lvs'][lv_name]
+        return ('  --- Logical volume ---\n'
+                '  LV Path                /dev/{}\n'
+                '  LV Name                {}\n'
+                '  VG Name                {}\n'
+                '  LV Size                {:.2f} GB\n').format(
+                    lv_name, lv_name.split('/')[-1], lv['vg'],
+                    lv['extents'] * SimulatedBackend.EXTENT_SIZE / 1e9)
+
+    def run_vgdisplay(self, args):
+        vg_name = self.lvm_name(args[0])
+        if vg_name not in self.state['vgs']:
+            return (5, '  Volume group "{}" not found\n'.format(vg_name))
+        total, free = self.vg_extents(vg_name)
+        output = ('  --- Volume group ---\n'
+                  '  VG Name               {}\n'
+                  '  Total PE              {}\n'
+                  '  Free  PE / Size       {}\n'
+                  '\n'
+                  '  --- Physical volumes ---\n').format(vg_name, total, free)
+        for pv in self.state['vgs'][vg_name]['pvs']:
+            output += '  PV Name               {}     \n'.format(pv)
+        return output
+
+    def lvm_report(self, args, rows):
+        """Format a report for lvs, vgs or pvs."""
+        fields = args[args.index('-o') + 1].split(',')
+        separator = args[args.index('--separator') + 1]
+        return ''.join('  ' + separator.join(str(row[field]) for field in fields) + '\n'
+                       for row in rows)
+
+    def run_lvs(self, args):
+        targets = [self.lvm_name(arg) for arg in args if arg.count('/') >= 1 and
+                   self.lvm_name(arg) in self.state['lvs']]
+        if not targets:
+            return (5, '  One or more specified logical volume(s) not found.\n')
+        rows = []
+        for name in targets:
+            lv = self.state['lvs'][name]
+            rows.append({'lv_name': name.split('/')[-1],
+                         'vg_name': lv['vg'],
+                         'lv_size': lv['extents'] * SimulatedBackend.EXTENT_SIZE})
+        return self.lvm_report(args, rows)
+
+    def run_vgs(self, args):
+        rows = []
+        for name in [self.lvm_name(args[-1])]:
+            total, free = self.vg_extents(name)
+            rows.append({'vg_name': name,
+                         'vg_size': total * SimulatedBackend.EXTENT_SIZE,
+                         'vg_free': free * SimulatedBackend.EXTENT_SIZE,
+                         'vg_extent_count': total,
+                         'vg_free_count': free,
+                         'vg_extent_size': SimulatedBackend.EXTENT_SIZE})
+        return self.lvm_report(args, rows)
+
+    def run_pvs(self, args):
+        rows = []
+        for name in sorted(self.state['pvs']):
+            pv = self.state['pvs'][name]
+            used = self.pv_used(name)
+            rows.append({'pv_name': name,
+                         'vg_name': pv['vg'] or '',
+                         'pv_size': pv['extents'] * SimulatedBackend.EXTENT_SIZE,
+                         'pv_used': used * SimulatedBackend.EXTENT_SIZE,
+                         'pv_free': (pv['extents'] - used) * SimulatedBackend.EXTENT_SIZE,
+                         'pv_pe_count': pv['extents'],
+                         'pv_pe_alloc_count': used})
+        return self.lvm_report(args, rows)
+
+    def lv_filesystem(self, name):
+        """Returns the filesystem on an LV, or mounted at a path."""
+        for lv_name, lv in self.state['lvs'].items():
+            fs = lv.get('fs')
+            if fs is not None and name in ('/dev/' + lv_name, fs['mountpoint']):
+                return lv, fs
+        return None, None
+
+    def run_blkid(self, args):
+        drive = self.state['drives'].get(args[-1])
+        if drive is not None:
+            if drive.get('signature') is None:
+                return (2, '')
+            return drive['signature'] + '\n'
+        _, fs = self.lv_filesystem(args[-1])
+        if fs is None:
+            return (2, '')
+        return fs['type'] + '\n'
+
+    def run_findmnt(self, args):
+        _, fs = self.lv_filesystem(args[-1])
+        if fs is None or fs['mountpoint'] is None:
+            return (1, '')
+        return fs['mountpoint'] + '\n'
+
+    def run_e2fsck(self, args):
+        return ''
+
+    def run_tune2fs(self, args):
+        _, fs = self.lv_filesystem(args[-1])
+        if fs is None or not fs['type'].startswith('ext'):
+            return (1, 'tune2fs: Bad magic number in super-block while trying '
+                    'to open {}\n'.format(args[-1]))
+        if args[0] == '-E':
+            options = dict(option.split('=') for option in args[1].split(','))
+            fs['stripe_unit'] = int(options['stride'])
+            fs['stripe_width'] = int(options['stripe_width'])
+            return ''
+        output = ('Filesystem volume name:   <none>\n'
+                  'Block count:              {}\n'
+                  'Block size:               {}\n').format(fs['blocks'], fs['block_size'])
+        if fs['stripe_unit']:
+            output += ('RAID stride:              {}\n'
+                       'RAID stripe width:        {}\n').format(
+                           fs['stripe_unit'], fs['stripe_width'])
+        return output
+
+    def run_resize2fs(self, args):
+        lv, fs = self.lv_filesystem(args[-1])
+        fs['blocks'] = lv['extents'] * SimulatedBackend.EXTENT_SIZE // fs['block_size']
+        return 'The filesystem on {} is now {} (4k) blocks long.\n'.format(
+            args[-1], fs['blocks'])
+
+    def run_xfs_info(self, args):
+        _, fs = self.lv_filesystem(args[-1])
+        return ('meta-data={}  isize=512    agcount=4, agsize=65536 blks\n'
+                'data     =                       bsize={}   blocks={}, imaxpct=25\n'
+                '         =                       sunit={}    swidth={} blks\n').format(
+                    args[-1], fs['block_size'], fs['blocks'], fs['stripe_unit'],
+                    fs['stripe_width'])
+
+    def run_xfs_growfs(self, args):
+        lv, fs = self.lv_filesystem(args[-1])
+        old_blocks = fs['blocks']
+        fs['blocks'] = lv['extents'] * SimulatedBackend.EXTENT_SIZE // fs['block_size']
+        return 'data blocks changed from {} to {}\n'.format(old_blocks, fs['blocks'])
+
+    def run_mdadm(self, args):
+        if args == ['-V']:
+            return 'mdadm - v3.2.5 - 18th May 2012\n'
+        if args[0] == '--detail':
+            return self.mdadm_detail(args[1])
+        if args[0] == '--examine':
+            if self.array_of(args[1]) is None:
+                return (1, 'mdadm: No md superblock detected on {}.\n'.format(args[1]))
+            return '{}:\n          Magic : a92b4efc\n'.format(args[1])
+        if args[0] == '--create':
+            return self.mdadm_create(args[1:])
+        if args[0] == '--assemble':
+            return self.mdadm_assemble(args[1:])
+        if args[0] == '--stop':
+            if self.state['arrays'].pop(args[1], None) is None:
+                return (1, 'mdadm: error opening {}: No such file or directory\n'
+                        .format(args[1]))
+            return 'mdadm: stopped {}\n'.format(args[1])
+        if args[0] == '--zero-superblock':
+            if self.array_of(args[1]) is not None:
+                return (1, 'mdadm: Couldn\'t open {} for write - not zeroing\n'
+                        .format(args[1]))
+            return ''
+
+        name, mode, operand = args[0], args[1], args[2]
+        array = self.state['arrays'].get(name)
+        if array is None:
+            return (1, 'mdadm: error opening {}: No such file or directory\n'.format(name))
+        if mode == '--add':
+            if self.find_partition(operand) is None or self.array_of(operand):
+                return (1, 'mdadm: cannot add {}\n'.format(operand))
+            member = {'name': operand, 'state': 'spare'}
+            array['members'].append(member)
+            if len(self.in_sync(array)) < array['raid_devices'] and array['op'] is None:
+                member['state'] = 'rebuilding'
+                self.start_op(array, 'recover')
+            return 'mdadm: added {}\n'.format(operand)
+        if mode == '--grow':
+            options = dict(arg.lstrip('-').split('=', 1) for arg in args[2:] if '=' in arg)
+            if 'level' in options:
+                # Only the takeover of a two member mirror is supported.  md
+                # picks the largest chunk size up to 64K which divides the
+                # members.
+                if (options['level'] != '5' or array['level'] != 1 or
+                        array['raid_devices'] != 2 or array['op'] is not None):
+                    return (1, 'mdadm: {} level change not supported\n'.format(name))
+                array['level'] = 5
+                array['chunk'] = 64
+                while array['component_size'] % (array['chunk'] * 1024):
+                    array['chunk'] //= 2
+                return 'mdadm: level of {} changed to raid5\n'.format(name)
+            new_devices = int(options['raid-devices'])
+            spares = [member for member in array['members'] if member['state'] == 'spare']
+            if new_devices - array['raid_devices'] > len(spares):
+                return (1, 'mdadm: Need {} spares to grow {}\n'.format(
+                    new_devices - array['raid_devices'], name))
+            if new_devices == array['raid_devices']:
+                return ''
+            if array['op'] is not None:
+                return (1, 'mdadm: Cannot reshape {}: Device or resource busy\n'.format(name))
+            if 'chunk' in options:
+                if self.capacity(array) % (int(options['chunk']) * 1024):
+                    return (1, 'mdadm: Invalid chunk size {}K for {}\n'.format(
+                        options['chunk'], name))
+                array['chunk'] = int(options['chunk'])
+            self.start_op(array, 'reshape')
+            for member in spares[:new_devices - array['raid_devices']]:
+                member['state'] = 'in_sync'
+            array['raid_devices'] = new_devices
+            return ''
+        if mode == '--fail':
+            for member in array['members']:
+                if member['name'] == operand:
+                    member['state'] = 'faulty'
+                    return 'mdadm: set {} faulty in {}\n'.format(operand, name)
+            return (1, 'mdadm: {} not in {}\n'.format(operand, name))
+        if mode == '--remove':
+            for member in array['members']:
+                if member['name'] == operand and member['state'] in ('faulty', 'spare'):
+                    array['members'].remove(member)
+                    return 'mdadm: hot removed {} from {}\n'.format(operand, name)
+            return (1, 'mdadm: hot remove failed for {}: Device or resource busy\n'
+                    .format(operand))
+        return (1, 'mdadm: unsupported simulated command {}\n'.format(args))
+
+    def mdadm_create(self, args):
+        name = args[0]
+        options = {}
+        partitions = []
+        for arg in args[1:]:
+            if arg.startswith('--'):
+                key, _, value = arg[2:].partition('=')
+                options[key] = value
+            else:
+                partitions.append(arg)
+        if name in self.state['arrays']:
+            return (1, 'mdadm: device {} already active\n'.format(name))
+        for part in partitions:
+            if self.find_partition(part) is None or self.array_of(part):
+                return (1, 'mdadm: cannot open {}: Device or resource busy\n'.format(part))
+
+        # Mirrors have no chunks, but mdadm rounds their size to 64K.
+        chunk = 0 if options['level'] == '1' else int(options.get('chunk', 512))
+        member_size = min(self.partition_size(part) for part in partitions)
+        component_size = member_size - SimulatedBackend.DATA_OFFSET
+        component_size -= component_size % ((chunk or 64) * 1024)
+        # UUIDs are numbered in order of creation.
+        self.state['num_created'] = self.state.get('num_created', 0) + 1
+        array = {'level': int(options['level']),
+                 'raid_devices': int(options['raid-devices']),
+                 'chunk': chunk,
+                 'component_size': component_size,
+                 'uuid': '{:08x}:{:08x}:{:08x}:{:08x}'.format(
+                     self.state['num_created'], 0, 0, int(self.state['time'])),
+                 'name': 'simulated:{}'.format(name[len('/dev/md'):]),
+                 'members': [{'name': part, 'state': 'in_sync'} for part in partitions],
+                 'op': None}
+        self.state['arrays'][name] = array
+
+        if 'assume-clean' not in options:
+            if array['level'] == 1:
+                self.start_op(array, 'resync')
+            else:
+                # RAID5 arrays are built by recovering onto the last member.
+                array['members'][-1]['state'] = 'rebuilding'
+                self.start_op(array, 'recover')
+        return 'mdadm: array {} started.\n'.format(name)
+
+    def mdadm_assemble(self, args):
+        """Assemble an array listed in the mdadm.conf given with --config."""
+        options = dict(arg[2:].split('=', 1) for arg in args if arg.startswith('--'))
+        name = [arg for arg in args if not arg.startswith('--')][0]
+        if name in self.state['arrays']:
+            return (1, 'mdadm: {} is already in use.\n'.format(name))
+        uuid = MdadmConfig(options.get('config')).uuid_of(name)
+        if uuid is None:
+            return (1, 'mdadm: {} not identified in config file.\n'.format(name))
+        array = self.state.get('stopped', {}).pop(uuid, None)
+        if array is None:
+            return (1, 'mdadm: no devices found for {}\n'.format(name))
+        self.state['time'] += SimulatedBackend.ASSEMBLE_TIME * len(array['members'])
+        self.rebase_op(array)
+        self.state['arrays'][name] = array
+        return 'mdadm: {} has been started with {} drives.\n'.format(
+            name, len(self.in_sync(array)))
+
+    def mdadm_detail(self, name):
+        array = self.state['arrays'].get(name)
+        if array is None:
+            return (1, 'mdadm: cannot open {}: No such file or directory\n'.format(name))
+        op = array['op']
+        in_sync = len(self.in_sync(array))
+        lines = ['{}:'.format(name),
+                 '        Version : 1.2',
+                 '     Raid Level : raid{}'.format(array['level']),
+                 '     Array Size : {}'.format(self.capacity(array) // 1024),
+                 '  Used Dev Size : {}'.format(array['component_size'] // 1024),
+                 '   Raid Devices : {}'.format(array['raid_devices']),
+                 '  Total Devices : {}'.format(len(array['members'])),
+                 '    Persistence : Superblock is persistent',
+                 '',
+                 '          State : {}'.format(self.array_state(array)),
+                 ' Active Devices : {}'.format(in_sync),
+                 'Working Devices : {}'.format(len([
+                     member for member in array['members'] if member['state'] != 'faulty'])),
+                 ' Failed Devices : {}'.format(len([
+                     member for member in array['members'] if member['state'] == 'faulty'])),
+                 '  Spare Devices : {}'.format(len([
+                     member for member in array['members']
+                     if member['state'] in ('spare', 'rebuilding')])),
+                 '']
+        if array['level'] != 1:
+            lines += ['         Layout : left-symmetric',
+                      '     Chunk Size : {}K'.format(array['chunk']),
+                      '']
+        if op is not None:
+            status = {'recover': 'Rebuild', 'reshape': 'Reshape', 'resync': 'Resync',
+                      'check': 'Check', 'repair': 'Repair'}
+            lines += [' {} Status : {}% complete'.format(
+                status[op['action']], op['done'] * 100 // op['total'])]
+            if op['action'] == 'reshape':
+                lines += ['  Delta Devices : {}, ({}->{})'.format(
+                    array['raid_devices'] - op['old_raid_devices'],
+                    op['old_raid_devices'], array['raid_devices'])]
+            lines += ['']
+        lines += ['           Name : {}'.format(array.get('name', 'simulated')),
+                  '           UUID : {}'.format(array['uuid']),
+                  '',
+                  '    Number   Major   Minor   RaidDevice State']
+        slot = 0
+        for number, member in enumerate(array['members']):
+            drive_name, num = self.find_partition(member['name'])
+            minor = 16 * (ord(drive_name[-1]) - ord('a')) + int(num)
+            if member['state'] == 'in_sync':
+                raid_device, state = slot, 'active sync'
+                slot += 1
+            elif member['state'] == 'rebuilding':
+                raid_device, state = slot, 'spare rebuilding'
+                slot += 1
+            else:
+                raid_device, state = '-', member['state']
+            lines.append('    {:6}  {:6}  {:6}  {:>10}      {}   {}'.format(
+                number, 8, minor, raid_device, state, member['name']))
+        return '\n'.join(lines) + '\n'
+
+    #
+    # Simulated sysfs.
+    #
+
+    def sysfs_dirs(self):
+        """The sysfs directories which exist."""
+        dirs = []
+        for name, array in self.state['arrays'].items():
+            md_dir = '/sys/block/{}/md'.format(os.path.basename(name))
+            dirs.append(md_dir)
+            for member in array['members']:
+                dirs.append('{}/dev-{}'.format(md_dir, os.path.basename(member['name'])))
+        for name, drive in self.state['drives'].items():
+            block_dir = '/sys/block/{}'.format(os.path.basename(name))
+            dirs.append(block_dir)
+            for num in drive['partitions']:
+                dirs.append('{}/{}{}'.format(block_dir, os.path.basename(name), num))
+        return dirs
+
+    def sysfs(self):
+        """The contents of the sysfs files, keyed on path."""
+        files = {}
+        for name, array in self.state['arrays'].items():
+            md_dir = '/sys/block/{}/md/'.format(os.path.basename(name))
+            op = array['op']
+            files[md_dir + 'array_state'] = 'clean\n'
+            files[md_dir + 'level'] = 'raid{}\n'.format(array['level'])
+            files[md_dir + 'raid_disks'] = '{}\n'.format(array['raid_devices'])
+            files[md_dir + 'degraded'] = '{}\n'.format(
+                0 if op is not None and op['action'] == 'reshape' else
+                max(0, array['raid_devices'] - len(self.in_sync(array))))
+            files[md_dir + 'component_size'] = '{}\n'.format(
+                array['component_size'] // 1024)
+            files[md_dir + 'chunk_size'] = '{}\n'.format(array['chunk'] * 1024)
+            files[md_dir + 'sync_action'] = '{}\n'.format(
+                'idle' if op is None else 'frozen' if op.get('frozen') else op['action'])
+            if op is None:
+                files[md_dir + 'sync_completed'] = 'none\n'
+                files[md_dir + 'sync_speed'] = 'none\n'
+            else:
+                files[md_dir + 'sync_completed'] = '{} / {}\n'.format(
+                    op['done'] // 512, op['total'] // 512)
+                files[md_dir + 'sync_speed'] = '{}\n'.format(self.op_rate(array) // 1024)
+            files[md_dir + 'sync_min'] = '{}\n'.format(array.get('sync_min', 0) // 512)
+            files[md_dir + 'sync_max'] = '{}\n'.format(
+                'max' if array.get('sync_max') is None else array['sync_max'] // 512)
+            files[md_dir + 'mismatch_cnt'] = '{}\n'.format(array.get('mismatch_cnt', 0))
+            for member in array['members']:
+                files['{}dev-{}/state'.format(md_dir, os.path.basename(member['name']))] = \
+                    {'rebuilding': 'spare'}.get(member['state'], member['state']) + '\n'
+        for name, drive in self.state['drives'].items():
+            block_dir = '/sys/block/{}/'.format(os.path.basename(name))
+            files[block_dir + 'size'] = '{}\n'.format(drive['size'] // 512)
+            for num, part in drive['partitions'].items():
+                size = part['end'] - part['start'] + 1
+                if part['type'] == '5':
+                    size = 2
+                files['{}{}{}/size'.format(block_dir, os.path.basename(name), num)] = \
+                    '{}\n'.format(size)
+        for device, attrs in self.queue_attrs().items():
+            for attr, value in attrs.items():
+                if attr == 'queue/scheduler':
+                    value = ' '.join('[{}]'.format(name) if name == value else name
+                                     for name in SimulatedBackend.SCHEDULERS)
+                files['/sys/block/{}/{}'.format(device, attr)] = '{}\n'.format(value)
+        return files
+
+    def queue_attrs(self):
+        """The request queue attributes of each block device, keyed on name.
+
+        Drives are rotational, with a choice of schedulers and a queue depth.
+        md and dm devices only have read-ahead: md starts with two stripes'
+        worth.  Writes are kept in the 'queues' state.
+
+        """
+        devices = {}
+        for name in self.state['drives']:
+            devices[os.path.basename(name)] = {
+                'queue/read_ahead_kb': 128,
+                'queue/rotational': 1,
+                'queue/scheduler': 'mq-deadline',
+                'queue/nr_requests': 64,
+                'device/queue_depth': 32}
+        for name, array in self.state['arrays'].items():
+            devices[os.path.basename(name)] = {
+                'queue/read_ahead_kb': max(128, 2 * array['chunk'] *
+                                           (array['raid_devices'] - 1))}
+        for index, name in enumerate(sorted(self.state['lvs'])):
+            devices['dm-{}'.format(index)] = {'queue/read_ahead_kb': 128}
+        for device, attrs in self.state.get('queues', {}).items():
+            if device in devices:
+                devices[device].update(attrs)
+        return devices
+
+    def write_queue_attr(self, device, attr, value, path):
+        attrs = self.queue_attrs().get(device, {})
+        if attr not in attrs or attr == 'queue/rotational':
+            raise IOError(errno.ENOENT, 'No such file or directory', path)
+        if attr == 'queue/scheduler':
+            if value not in SimulatedBackend.SCHEDULERS:
+                raise IOError(errno.EINVAL, 'Invalid argument', path)
+        elif not value.isdigit() or (attr == 'device/queue_depth' and int(value) > 32):
+            raise IOError(errno.EINVAL, 'Invalid argument', path)
+        else:
+            value = int(value)
+        self.state.setdefault('queues', {}).setdefault(device, {})[attr] = value
+
+    def diskstats(self):
+        lines = []
+        for device, (read, written, busy) in sorted(self.state['io'].items()):
+            lines.append('   8       0 {} 0 0 {} 0 0 0 {} 0 0 {} {}'.format(
+                device, read, written, busy, busy))
+        return '\n'.join(lines) + '\n'
+
+
+class Tracer(object):
+    """Records nested spans of time, in Chrome trace-event format.
+
+    The trace can be loaded into chrome://tracing or Perfetto to see a flame
+    chart of where a command spent its time.  When disabled (the default),
+    spans cost next to nothing and aren't recorded.
+
+    """
+
+    def __init__(self, backend, path=None):
+        self.backend = backend
+        self.path = path
+        self.events = []
+        self.lock = threading.Lock()
+
+    def enabled(self):
+        return self.path is not None
+
+    def begin(self, name, category, **args):
+        """Start a span, returning it to be passed to end()."""
+        return {'name': name, 'cat': category, 'args': args,
+                'start': self.backend.time()}
+
+    def end(self, span, **args):
+        """Finish a span, adding any results (eg. exit status) to its args."""
+        if not self.enabled():
+            return
+        span['args'].update(args)
+        event = {'name': span['name'],
+                 'cat': span['cat'],
+                 'ph': 'X',
+                 'ts': long(span['start'] * 1e6),
+                 'dur': long((self.backend.time() - span['start']) * 1e6),
+                 'pid': os.getpid(),
+                 'tid': threading.current_thread().ident,
+                 'args': span['args']}
+        with self.lock:
+            self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """Record the time spent in a block.
+
+        Yields the span's args, so the block can add results to them.
+
+        """
+        span = self.begin(name, category, **args)
+        try:
+            yield span['args']
+        except Exception as e:
+            self.end(span, error=str(e))
+            raise
+        self.end(span)
+
+    def close(self):
+        """Write the trace to file, if tracing is enabled."""
+        if self.enabled():
+            with open(self.path, 'w') as f:
+                json.dump({'traceEvents': self.events,
+                           'displayTimeUnit': 'ms'}, f)
+
+
+class TracingBackend(object):
+    """Wraps a backend, tracing each command, fdisk session and sleep."""
+
+    def __init__(self, backend, tracer):
+        self.backend = backend
+        self.tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    @staticmethod
+    def unwrap(backend):
+        """Returns the backend a (possibly) traced backend wraps."""
+        while isinstance(backend, TracingBackend):
+            backend = backend.backend
+        return backend
+
+    def run(self, cmd, **kwargs):
+        with self.tracer.span(' '.join(cmd), 'cmd') as args:
+            try:
+                output = self.backend.run(cmd, **kwargs)
+            except subprocess.CalledProcessError as e:
+                args.update(exit_status=e.returncode,
+                            output_bytes=len(e.output or ''))
+                raise
+            args.update(exit_status=0, output_bytes=len(output))
+        return output
+
+    def spawn(self, cmd, **kwargs):
+        return TracedSession(self.backend.spawn(cmd, **kwargs), self.backend.EOF,
+                             self.tracer, self.tracer.begin(cmd, 'pexpect'))
+
+    def sleep(self, seconds, **kwargs):
+        with self.tracer.span('sleep', 'sleep', seconds=seconds):
+            self.backend.sleep(seconds, **kwargs)
+
+
+class TracedSession(object):
+    """Wraps a pexpect session, tracing it from spawn until EOF."""
+
+    def __init__(self, session, eof, tracer, span):
+        self.session = session
+        self.eof = eof
+        self.tracer = tracer
+        self.span = span
+        self.sent = []
+        self.received = 0
+
+    @property
+    def before(self):
+        return self.session.before
+
+    @property
+    def match(self):
+        return self.session.match
+
+    def sendline(self, line):
+        self.sent.append(line)
+        return self.session.sendline(line)
+
+    def expect(self, patterns):
+        try:
+            index = self.session.expect(patterns)
+        except Exception as e:
+            self.finish(error=str(e))
+            raise
+        self.received += len(self.session.before or '')
+        pattern = patterns[index] if isinstance(patterns, list) else patterns
+        if pattern is self.eof:
+            self.finish(exit_status=getattr(self.session, 'exitstatus', None))
+        return index
+
+    def finish(self, **args):
+        self.tracer.end(self.span, sent=self.sent, output_bytes=self.received,
+                        **args)
+
+
+class LvmRaidDaemon(object):
+    """Long-running service which keeps a warm copy of the object graph.
+
+    Read-only commands are answered from the cached objects of the daemon's
+    LvmRaidExec instance.  When the kernel reports a block device change (via
+    a netlink uevent), or the state of an md array changes in sysfs, the
+    objects for that device are discarded (see discard()); after a job, all
+    of them are.  Mutating commands are queued and run one at a time by a
+    worker thread.
+
+    Clients talk to the daemon over a Unix socket, sending a single line of
+    JSON containing the command line, and receiving a single line of JSON in
+    reply.  Each client is served on a thread of its own, so that a slow
+    command doesn't hold up the daemon; the commands run against the cached
+    objects still run one at a time.
+
+    Jobs can be cancelled with the cancel command.  On SIGTERM the daemon
+    cancels the running job, waits for it to stop and exits.
+
+    """
+    DEFAULT_SOCKET = '/run/lvmraid5d.sock'
+    NETLINK_KOBJECT_UEVENT = 15
+    MD_SYSFS_ATTRS = ('array_state', 'sync_action', 'degraded', 'raid_disks')
+    MD_SYSFS_POLL_INTERVAL = 1
+    # Seconds a client has to send its request, so that one which never
+    # finishes its line doesn't hold on to a thread.
+    CLIENT_TIMEOUT = 5
+
+    def __init__(self, lvmexec, socket_path):
+        self.lvmexec = lvmexec
+        self.socket_path = socket_path
+        self.jobs = []  # All jobs submitted, in order.
+        self.pending = collections.deque()
+        self.jobs_cond = threading.Condition()
+        # Held while a command runs against the cached objects.
+        self.commands_lock = threading.Lock()
+        self.stale = threading.Event()  # Set when all the objects are stale.
+        self.changed = set()  # The devices whose objects are stale.
+        self.changed_lock = threading.Lock()
+        self.md_signature = {}
+        self.md_checked = 0
+
+    def serve(self):
+        """Serve requests until cancelled."""
+        listener = self.open_listener()
+        uevents = self.open_uevent_socket()
+        sockets = [listener]
+        if uevents is not None:
+            sockets.append(uevents)
+
+        worker = threading.Thread(target=self.run_jobs)
+        worker.daemon = True
+        worker.start()
+
+        self.lvmexec.log('Daemon listening on {}'.format(self.socket_path),
+                         logging.INFO)
+        while not self.lvmexec.cancelled.is_set():
+            try:
+                readable = select.select(sockets, [], [],
+                                         LvmRaidDaemon.MD_SYSFS_POLL_INTERVAL)[0]
+            except select.error:
+                # Interrupted by a signal: check whether to stop.
+                continue
+            if uevents in readable:
+                self.handle_uevent(uevents)
+            self.check_md_sysfs()
+
+            if listener in readable:
+                conn = listener.accept()[0]
+                client = threading.Thread(target=self.serve_client, args=(conn,))
+                client.daemon = True
+                client.start()
+
+        self.lvmexec.log('Daemon stopping', logging.INFO)
+        listener.close()
+        os.unlink(self.socket_path)
+        self.stop_jobs()
+
+    def open_listener(self):
+        """Create the Unix socket that clients connect to."""
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        os.chmod(self.socket_path, 0o600)
+        listener.listen(16)
+        return listener
+
+    def open_uevent_socket(self):
+        """Subscribe to kernel uevents.
+
+        If netlink isn't available, we fall back to only watching md sysfs.
+
+        """
+        try:
+            uevents = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                                    LvmRaidDaemon.NETLINK_KOBJECT_UEVENT)
+            uevents.bind((os.getpid(), 1))
+            return uevents
+        except (AttributeError, socket.error) as e:
+            self.lvmexec.log('Not listening for uevents: {}'.format(e),
+                             logging.WARNING)
+            return None
+
+    def handle_uevent(self, uevents):
+        """Mark the device a block device uevent relates to as changed."""
+        fields = uevents.recv(16384).split('\0')
+        if 'SUBSYSTEM=block' not in fields:
+            return
+        self.lvmexec.log('Block device uevent: {}'.format(fields[0]))
+        names = [field[len('DEVNAME='):] for field in fields
+                 if field.startswith('DEVNAME=')]
+        if names:
+            self.mark_changed(['/dev/' + names[0]])
+        else:
+            self.stale.set()
+
+    def check_md_sysfs(self):
+        """Mark any md array whose state has changed as changed."""
+        now = time.time()
+        if now - self.md_checked < LvmRaidDaemon.MD_SYSFS_POLL_INTERVAL:
+            return
+        self.md_checked = now
+
+        signature = {}
+        for md_dir in self.lvmexec.list_sysfs('/sys/block/md*/md'):
+            signature['/dev/' + md_dir.split('/')[3]] = [
+                self.lvmexec.read_sysfs(os.path.join(md_dir, attr))
+                for attr in LvmRaidDaemon.MD_SYSFS_ATTRS]
+        changed = [name for name in set(signature) | set(self.md_signature)
+                   if signature.get(name) != self.md_signature.get(name)]
+        self.md_signature = signature
+        if changed:
+            self.mark_changed(changed)
+
+    def mark_changed(self, names):
+        """Have the next command discard the objects for some devices."""
+        with self.changed_lock:
+            self.changed.update(names)
+
+    def discard(self, names):
+        """Forget the cached objects and queries for some block devices.
+
+        Objects which describe them go too: a partition's drive and array,
+        a drive's partitions, an array's PV and all of the LVM objects, since
+        a change to any device can change what LVM reports.
+
+        """
+        names = set(names)
+        objs = self.lvmexec.child_objs
+        for name in objs.get(Partition, {}):
+            drive = Partition.drive_name_re.match(name).group('name')
+            if name in names or drive in names:
+                names.update([name, drive])
+        for name, array in objs.get(RaidArray, {}).items():
+            if names & set(array.members):
+                names.add(name)
+        self.lvmexec.log('Discarding cached objects for {}'.format(
+            ', '.join(sorted(names))))
+        for cls in list(objs):
+            if cls in (VolumeGroup, LogicalVolume, Filesystem):
+                objs[cls] = {}
+            else:
+                for name in names:
+                    objs[cls].pop(name, None)
+        self.lvmexec.query_cache.invalidate(
+            names=names, sources=('lvdisplay', 'vgdisplay'))
+
+    def serve_client(self, conn):
+        """Client thread: answer a client, and hang up."""
+        try:
+            self.handle_client(conn)
+        finally:
+            conn.close()
+
+    def handle_client(self, conn):
+        """Read a single request from a client and send the reply."""
+        conn.settimeout(LvmRaidDaemon.CLIENT_TIMEOUT)
+        try:
+            line = conn.makefile().readline()
+        except (socket.error, IOError):
+            # Timed out, or the client went away.
+            line = ''
+        try:
+            request = json.loads(line)
+            reply = self.handle_request(request['argv'])
+        except (ValueError, KeyError, TypeError):
+            reply = {'status': 'error', 'message': 'Malformed request.'}
+        try:
+            conn.sendall(json.dumps(reply) + '\n')
+        except socket.error as e:
+            self.lvmexec.log('Could not reply to client: {}'.format(e),
+                             logging.WARNING)
+
+    def handle_request(self, argv):
+        """Answer a read-only or job command, or queue a mutating one."""
+        try:
+            args = self.lvmexec.parse_args(argv)
+        except SystemExit:
+            return {'status': 'error',
+                    'message': 'Invalid arguments: {}'.format(' '.join(argv))}
+
+        command = args.func.__name__
+        if command in LvmRaidExec.LOCAL_COMMANDS:
+            return {'status': 'error',
+                    'message': 'The {} command is not run by the daemon.'.format(command)}
+        if command in LvmRaidExec.DAEMON_COMMANDS:
+            with self.commands_lock:
+                return self.run_command(args)
+        if command in LvmRaidExec.READ_ONLY_COMMANDS:
+            with self.commands_lock:
+                return self.run_read_only(args)
+        if args.prompt:
+            return {'status': 'error',
+                    'message': 'Prompting is not supported by the daemon.'}
+        return self.queue_job(argv)
+
+    def run_read_only(self, args):
+        """Run a read-only command against the cached objects."""
+        with self.changed_lock:
+            changed, self.changed = self.changed, set()
+        if self.stale.is_set():
+            self.stale.clear()
+            self.lvmexec.log('Discarding cached objects')
+            self.lvmexec.child_objs = {}
+            self.lvmexec.query_cache.clear()
+        elif changed:
+            self.discard(changed)
+        return self.run_command(args)
+
+    def run_command(self, args):
+        """Run a command in the daemon's thread, returning its output."""
+        self.lvmexec.args = args
+        self.lvmexec.output_buffer = []
+        try:
+            args.func()
+            return {'status': 'ok',
+                    'output': '\n'.join(self.lvmexec.output_buffer)}
+        except Exception as e:
+            # Keep serving whatever goes wrong with a single request.
+            self.lvmexec.log('Request failed: {}'.format(e), logging.ERROR)
+            return {'status': 'error', 'message': str(e)}
+        finally:
+            self.lvmexec.output_buffer = None
+
+    def queue_job(self, argv):
+        """Queue a mutating command for the worker thread."""
+        with self.jobs_cond:
+            job = {'id': len(self.jobs) + 1,
+                   'argv': argv,
+                   'state': 'queued',
+                   'message': None,
+                   'cancelled': threading.Event()}
+            self.jobs.append(job)
+            self.pending.append(job)
+            self.jobs_cond.notify()
+        return {'status': 'queued', 'job': job['id']}
+
+    def run_jobs(self):
+        """Worker thread: run queued mutating commands one at a time."""
+        while True:
+            with self.jobs_cond:
+                while not self.pending:
+                    self.jobs_cond.wait()
+                job = self.pending.popleft()
+
+            job['state'] = 'running'
+            try:
+                LvmRaidExec(job['argv'], backend=self.job_backend(),
+                            cancelled=job['cancelled'])
+                job['state'] = 'done'
+            except LvmRaidCancelled:
+                job['state'] = 'cancelled'
+            except Exception as e:
+                job['state'] = 'failed'
+                job['message'] = str(e)
+
+            # Whatever happened, the topology has probably changed.
+            self.stale.set()
+
+    def job_backend(self):
+        """The backend a job runs commands through.
+
+        Each job on the real system gets a backend of its own, since a job
+        closes its backend when it finishes.  A simulation is shared, so that
+        the daemon sees what its jobs changed.
+
+        """
+        backend = TracingBackend.unwrap(self.lvmexec.backend)
+        if isinstance(backend, RealBackend):
+            return RealBackend()
+        return backend
+
+    def cancel_job(self, job_id):
+        """Cancel a queued job, or stop the running one.
+
+        A running job's current command is terminated: if it had changed
+        anything, it can be finished later with the resume command.
+
+        """
+        with self.jobs_cond:
+            check_critical(1 <= job_id <= len(self.jobs),
+                           'No such job: {}'.format(job_id))
+            job = self.jobs[job_id - 1]
+            check_critical(job['state'] in ('queued', 'running'),
+                           'Job {} is already {}.'.format(job_id, job['state']))
+            if job['state'] == 'queued':
+                self.pending.remove(job)
+                job['state'] = 'cancelled'
+            job['cancelled'].set()
+        return job
+
+    def stop_jobs(self):
+        """Cancel all jobs, and wait for the running one to stop."""
+        with self.jobs_cond:
+            for job in self.pending:
+                job['state'] = 'cancelled'
+            self.pending.clear()
+        for job in self.jobs:
+            job['cancelled'].set()
+        while any(job['state'] == 'running' for job in self.jobs):
+            time.sleep(RealBackend.POLL_INTERVAL)
+
+
+class LvmRaidExec:
+    """Represents a single invocation of the lvmraid script."""
+    # Commands which don't modify any devices.  These take a faster start-up
+    # path, which doesn't probe devices or truncate the log.
+    READ_ONLY_COMMANDS = ('examine', 'history', 'plan', 'status', 'watch')
+
+    # Commands which are always run locally, rather than by the daemon.
+    LOCAL_COMMANDS = ('daemon', 'watch')
+
+    # Commands which manage the daemon's jobs, so are only run by the daemon.
+    DAEMON_COMMANDS = ('cancel', 'jobs')
+
+    # Binaries needed by the read-only commands.
+    READ_ONLY_BINARIES = ('fdisk', 'mdadm', 'lvdisplay', 'vgdisplay', 'lvs', 'vgs',
+                          'pvs')
+
+    # Timeouts for external commands, in seconds, keyed on the binary (None
+    # for any other).  For fdisk, this is the timeout for each prompt.  These
+    # can be changed with --timeout.
+    DEFAULT_TIMEOUTS = {None: 600, 'fdisk': 5, 'partprobe': 60}
+
+    # Errors from commands run just after a partition table or array has
+    # changed, typically because udev hasn't caught up yet.  Commands which
+    # are prone to this are retried, with the delay doubling each time.
+    transient_error_re = re.compile(
+        'Device or resource busy|No such file or directory|not found \(or ignored'
+        '|unable to inform the kernel', re.IGNORECASE)
+    RETRIES = 4
+    RETRY_DELAY = 0.5
+
+    # Lines of each command's output logged as it runs.  The rest is only
+    # logged if the command fails, or with --trace.
+    LOGGED_OUTPUT_LINES = 20
+
+    # Chunk sizes in KiB tried by create --chunk=auto.
+    CHUNK_CANDIDATES = (64, 128, 256, 512, 1024)
+
+    # How many times slower than the existing drives a new drive can be,
+    # according to --probe.
+    DEFAULT_MAX_SLOWDOWN = 2.0
+
+    # Plan steps which only touch one drive's partition table, or one array,
+    # so can run alongside the same steps on other drives or arrays (see
+    # step_groups()).  Maps the action to the parameter naming what it
+    # touches.
+    CONCURRENT_ACTIONS = {'init_partitions': 'drive',
+                          'create_partition': 'drive',
+                          'remove_member': 'array'}
+
+    # Held while picking the name of a new array and creating it.
+    array_names_lock = threading.Lock()
+
+    # Held while the logger's handlers are added (see setup_logging()).
+    logging_lock = threading.Lock()
+
+    # The fields of a progress event (see progress()).
+    PROGRESS_FIELDS = ('time', 'phase', 'step', 'steps', 'array', 'percent',
+                       'speed', 'eta', 'message')
+
+    def __init__(self, args, backend=None, cancelled=None, on_progress=None,
+                 output=None):
+        """Parse the command line and run the command.
+
+        All commands are run and system state read through the backend: by
+        default the real system, or a simulation if --simulate is given.
+
+        Setting the cancelled event (eg. from a signal handler, or another
+        thread) stops the command at its next external command or wait.
+
+        Progress events are passed to on_progress, if given, rather than
+        shown on stdout (see progress()), and the command's output appended
+        to the output list, if given.
+
+        """
+        # Hash of child instances.
+        self.child_objs = {}
+        self.objs_lock = threading.RLock()
+        self.query_cache = QueryCache()
+
+        # Time spent in each phase of the command (see phase()).  Each thread
+        # has its own stack of phases.
+        self.phase_times = collections.OrderedDict()
+        self.phase_lock = threading.Lock()
+        self.thread_state = threading.local()
+
+        self.cancelled = cancelled or threading.Event()
+
+        # Where command output goes: None for stdout, or a list of lines when
+        # the daemon is answering a client or the command is run through the
+        # library API.
+        self.output_buffer = output
+        self.on_progress = on_progress
+        self.service = None
+        self.outcome = None
+
+        self.args = self.parse_args(args)
+        self.timeouts = dict(LvmRaidExec.DEFAULT_TIMEOUTS)
+        self.timeouts.update(self.args.timeout or [])
+
+        # If a daemon is running, hand the command over to it.
+        if (self.args.socket is not None and
+                self.args.func.__name__ not in LvmRaidExec.LOCAL_COMMANDS):
+            self.forward_to_daemon(strip_option(args, '--socket'))
+            return
+        check_critical(
+            self.args.func.__name__ not in LvmRaidExec.DAEMON_COMMANDS,
+            'The {} command requires a running daemon (see --socket).'.format(
+                self.args.func.__name__))
+
+        # Configure logging.
+        read_only = self.args.func.__name__ in LvmRaidExec.READ_ONLY_COMMANDS
+        self.setup_logging(truncate=not read_only)
+
+        if backend is None:
+            if self.args.simulate is not None:
+                backend = SimulatedBackend.load(self.args.simulate,
+                                                self.args.simulate_drives)
+            else:
+                backend = RealBackend()
+        simulated = not isinstance(TracingBackend.unwrap(backend), RealBackend)
+        self.tracer = Tracer(backend, self.args.trace)
+        if self.tracer.enabled():
+            backend = TracingBackend(backend, self.tracer)
+        self.backend = backend
+
+        # Operations on the real system are recorded in the history by default;
+        # simulations only if asked.
+        history_path = self.args.history_db
+        if history_path is None and not simulated:
+            history_path = OperationHistory.DEFAULT_PATH
+        self.op_history = OperationHistory(self, history_path)
+
+        # Likewise the journal, though a simulation kept in a file has its
+        # journal alongside.
+        journal_path = self.args.journal
+        if journal_path is None and not simulated:
+            journal_path = OperationJournal.DEFAULT_PATH
+        elif journal_path is None and self.args.simulate is not None:
+            journal_path = self.args.simulate + '.journal'
+        self.journal = OperationJournal(journal_path)
+
+        # And the managed section of mdadm.conf.
+        mdadm_conf_path = self.args.mdadm_conf
+        if mdadm_conf_path is None and not simulated:
+            mdadm_conf_path = MdadmConfig.default_path()
+        elif mdadm_conf_path is None and self.args.simulate is not None:
+            mdadm_conf_path = self.args.simulate + '.mdadm.conf'
+        self.mdadm_conf = MdadmConfig(mdadm_conf_path)
+        if not read_only and self.args.func.__name__ not in LvmRaidExec.LOCAL_COMMANDS:
+            self.op_history.begin_operation(self.args.func.__name__, args)
+
+        status = 'failed'
+        try:
+            with self.tracer.span(self.args.func.__name__, 'command', argv=args):
+                # Check all our dependencies are met, before we bother trying
+                # anything more complex.
+                if read_only:
+                    self.check_dependencies_fast()
+                else:
+                    self.check_dependencies()
+
+                # Call the relevant function.
+                self.args.func()
+            status = 'ok'
+        except LvmRaidDetached as e:
+            status = 'detached'
+            self.log(str(e), logging.INFO)
+        except (LvmRaidCancelled, LvmRaidTimeout) as e:
+            if isinstance(e, LvmRaidCancelled):
+                status = 'cancelled'
+            self.log(str(e), logging.ERROR)
+            raise
+        finally:
+            self.outcome = status
+            self.log(self.query_cache.summary())
+            self.op_history.end_operation(status, self.phase_times)
+            self.backend.close()
+            self.tracer.close()
+
+    def parse_args(self, args):
+        """Parse a command line, binding the command to this instance."""
+        parser = argparse.ArgumentParser(
+            description='Helper utility for lvm and mdadm.')
+        parser.add_argument('-p', '--prompt',
+                            action='store_true',
+                            help="Prompt before performing any detructive actions.")
+        parser.add_argument(
+            '--socket',
+            help="""Send the command to the lvmraid5 daemon listening on this
+            Unix socket.  For the daemon command, the socket to listen on
+            (default: {}).""".format(LvmRaidDaemon.DEFAULT_SOCKET))
+        parser.add_argument(
+            '--simulate',
+            metavar='STATE_FILE',
+            help="""Run against a simulation of the drives, md arrays and LVM,
+            kept in this file, rather than the real system.  Useful for dry
+            runs.""")
+        parser.add_argument(
+            '--simulate-drives',
+            metavar='SIZES',
+            help="""Comma-separated list of drive sizes (eg. 1TB,1TB,2TB)
+            with which to start a new simulation, if the --simulate state file
+            doesn't exist yet.  The drives are named /dev/sdb onwards.""")
+        parser.add_argument(
+            '--trace',
+            metavar='FILE',
+            help="""Write a trace of the command to this file: nested spans
+            for each phase, external command, fdisk session and wait, in
+            Chrome trace-event JSON (view with chrome://tracing or
+            https://ui.perfetto.dev).""")
+        parser.add_argument(
+            '--history-db',
+            metavar='FILE',
+            help="""SQLite database recording the history of operations and
+            their sync speeds, used for estimates and the history command
+            (default: {}, or none when simulating).""".format(
+                OperationHistory.DEFAULT_PATH))
+        parser.add_argument(
+            '--journal',
+            metavar='FILE',
+            help="""Where to journal the progress of multi-step commands, so
+            that they can be resumed if interrupted (default: {}, or
+            alongside the --simulate state file).""".format(
+                OperationJournal.DEFAULT_PATH))
+        parser.add_argument(
+            '--mdadm-conf',
+            metavar='FILE',
+            help="""The mdadm.conf in which to keep a section listing the arrays
+            of each VG, for the assemble command and mdadm at boot (default:
+            /etc/mdadm/mdadm.conf or /etc/mdadm.conf, or alongside the
+            --simulate state file).""")
+        parser.add_argument(
+            '--timeout',
+            metavar='[NAME=]SECONDS',
+            type=parse_timeout,
+            action='append',
+            help="""Kill an external command (eg. mdadm=1200) if it runs for
+            longer than this, or without a name, any other command.  For
+            fdisk, the time allowed for each prompt.  0 means no timeout.  Can
+            be given more than once (defaults: {}).""".format(', '.join(
+                '{}={}'.format(name or 'other', seconds)
+                for name, seconds in sorted(LvmRaidExec.DEFAULT_TIMEOUTS.items(),
+                                            key=lambda item: item[0] or ''))))
+        subparsers = parser.add_subparsers()
+
+        def add_probe_arguments(subparser):
+            subparser.add_argument(
+                '--probe',
+                action='store_true',
+                help="""Before making any changes, measure the sequential
+                throughput of the new drive and the existing drives with dd.
+                Only a blank new drive (no partitions, and no filesystem, RAID
+                or LVM signature) is write tested, which overwrites samples of
+                it with zeros; the existing drives are only read.""")
+            subparser.add_argument(
+                '--max-slowdown',
+                type=float,
+                default=LvmRaidExec.DEFAULT_MAX_SLOWDOWN,
+                help="""With --probe, how many times slower than the existing
+                drives the new drive may be (default: %(default)s).""")
+            subparser.add_argument(
+                '--slow-drive',
+                choices=['refuse', 'warn'],
+                default='refuse',
+                help="""What to do if the new drive is slower than
+                --max-slowdown allows (default: %(default)s).""")
+
+        def add_window_arguments(subparser):
+            subparser.add_argument(
+                '--window',
+                metavar='HH:MM-HH:MM',
+                type=MaintenanceWindow.parse,
+                help="""Only let reshapes run during this maintenance window
+                (local time, eg. 01:00-05:00, or several separated by commas):
+                outside it they're paused.  Rebuilds of degraded arrays are
+                never held back.""")
+            subparser.add_argument(
+                '--detach',
+                action='store_true',
+                help="""Rather than waiting for a reshape, exit once it's running
+                (limited to what can be done before the --window closes) or
+                paused.  Run the resume command, eg. from cron at the start of
+                each window, to carry on.""")
+
+        def add_fs_arguments(subparser):
+            subparser.add_argument(
+                '--resize-fs',
+                action='store_true',
+                help="""After extending the LV, grow its filesystem (ext2/3/4,
+                online if mounted, or XFS, which must be mounted) and update
+                its stripe geometry to match the arrays.""")
+            subparser.add_argument(
+                '--fs-geometry',
+                choices=['dominant', 'widest'],
+                default='dominant',
+                help="""With --resize-fs, which tier of arrays the stripe
+                geometry matches: the one holding most of the LV, or the one
+                with the most members (default: %(default)s).""")
+
+        def add_tune_arguments(subparser):
+            subparser.add_argument(
+                '--tune',
+                metavar='PROFILE',
+                choices=sorted(StackTuner.PROFILES),
+                help="""Once the arrays and LV have been created or grown, tune
+                the block devices beneath the LV for this workload (one of
+                %(choices)s: see the tune command).""")
+
+        # Add parse for the add command.
+        add_parser = subparsers.add_parser(
+            'add',
+            help="""Add a new drive to an existing array, increasing the array's
+            number of drives by one.  To add a new drive to the array without
+            changing the total number of drives, see the 'replace' command.
+            If the new drive is large enough to increase the array size, it
+            will do so.""")
+        add_parser.add_argument(
+            '--mdadm-backup-file',
+            default='/tmp/lvmraid5_mdadm_backup_file.txt',
+            help="""Backup file for mdadm to use.  This should be on a physical
+            drive other than the array.""")
+        add_probe_arguments(add_parser)
+        add_window_arguments(add_parser)
+        add_fs_arguments(add_parser)
+        add_tune_arguments(add_parser)
+        add_parser.add_argument(
+            'lv', help='The LVM Logical Volume to add the drive to')
+        add_parser.add_argument('drive_to_add',
+                                help='The drive to add (eg. /dev/sda)')
+        add_parser.set_defaults(func=self.add)
+
+        # Parser for the assemble command.
+        assemble_parser = subparsers.add_parser(
+            'assemble',
+            help="""Assemble the arrays of VGs listed in mdadm.conf (see
+            --mdadm-conf) and activate the VGs, with LVM looking only at their
+            arrays, and report how long it took.  For use at boot (eg. from a
+            systemd unit), in place of scanning every device.""")
+        assemble_parser.add_argument(
+            'vgs', nargs='*', metavar='vg',
+            help='The VGs to assemble (default: all those listed).')
+        assemble_parser.set_defaults(func=self.assemble)
+
+        # Parser for the cancel command.
+        cancel_parser = subparsers.add_parser(
+            'cancel',
+            help="""Cancel a job queued on a running daemon, or stop the
+            running one.  A stopped job can be finished with the resume
+            command.""")
+        cancel_parser.add_argument('job', type=int,
+                                   help='The job number (see the jobs command).')
+        cancel_parser.set_defaults(func=self.cancel)
+
+        # Parser for the create command.
+        create_parser = subparsers.add_parser(
+            'create',
+            help="""Create a new array from a set of drives.""")
+        create_parser.add_argument(
+            '--vg_name',
+            help="""The name of the LVM Volume Group to create (default:
+            /dev/lvmraid_vg<N>""")
+        create_parser.add_argument(
+            '--chunk',
+            type=parse_chunk,
+            help="""Chunk size of the arrays in KiB (a power of two, eg. 512),
+            or 'auto' to pick the best of {}K by benchmarking sequential and
+            random I/O on scratch arrays built from the new partitions
+            (default: mdadm's).  Arrays added later keep the same chunk
+            size.""".format('K, '.join(str(size) for size in
+                                         LvmRaidExec.CHUNK_CANDIDATES)))
+        add_tune_arguments(create_parser)
+        create_parser.add_argument(
+            'drives_for_create',
             nargs='*',
             help='List of 3 or more drives from which to create the array.')
         create_parser.set_defaults(func=self.create)
 
+        # Parser for the daemon command.
+        daemon_parser = subparsers.add_parser(
+            'daemon',
+            help="""Run as a long-lived service (lvmraid5d), answering
+            read-only commands from a warm cache and queueing other commands.""")
+        daemon_parser.set_defaults(func=self.daemon)
+
         # Handle the examine command.
         examine_parser = subparsers.add_parser(
             'examine',
@@ -716,6 +5737,12 @@ class LvmRaidExec:
             'filesystem', help='The filesystem to examine.')
         examine_parser.set_defaults(func=self.examine)
 
+        # Handle the jobs command.
+        jobs_parser = subparsers.add_parser(
+            'jobs',
+            help='List the commands queued on a running daemon.')
+        jobs_parser.set_defaults(func=self.jobs)
+
         # Handle the remove command.
         remove_parser = subparsers.add_parser(
             'remove',
@@ -729,6 +5756,108 @@ class LvmRaidExec:
                                    help='The drive to remove (eg. /dev/sda)')
         remove_parser.set_defaults(func=self.remove)
 
+        # Parser for the resume command.
+        resume_parser = subparsers.add_parser(
+            'resume',
+            help="""Finish a create, add, replace or remove that was
+            interrupted (eg. by a crash or a dropped SSH session) or detached,
+            carrying on from the step it had reached.""")
+        add_window_arguments(resume_parser)
+        resume_parser.set_defaults(func=self.resume)
+
+        # Parser for the scrub command.
+        scrub_parser = subparsers.add_parser(
+            'scrub',
+            help="""Check the parity of a Logical Volume's arrays a window at a
+            time, recording the mismatches found in each window in the
+            history.  Each scrub carries on from where the last one stopped.
+            Arrays sharing a drive are never checked at the same time.""")
+        scrub_parser.add_argument(
+            '--window-size',
+            type=parse_size_argument,
+            default=Scrubber.DEFAULT_WINDOW,
+            help="""How much of each member to check at a time (default:
+            {}).""".format(format_bytes(Scrubber.DEFAULT_WINDOW)))
+        scrub_parser.add_argument(
+            '--budget',
+            type=parse_size_argument,
+            help="""Stop once this much of each member has been checked, summed
+            over the arrays (default: carry on to the end of every
+            array).""")
+        scrub_parser.add_argument(
+            '--max-speed',
+            type=float,
+            help="""Limit the check to this speed per member, in MB/s (default:
+            md's sync_speed_max).""")
+        scrub_parser.add_argument(
+            '--serial',
+            action='store_true',
+            help="""Scrub one array at a time, rather than arrays on disjoint
+            drives together.""")
+        scrub_parser.add_argument(
+            '--repair',
+            action='store_true',
+            help="""Rather than checking, repair the windows in which earlier
+            scrubs found mismatches.""")
+        scrub_parser.add_argument(
+            'lv',
+            help='The Logical Volume to scrub.')
+        scrub_parser.set_defaults(func=self.scrub)
+
+        # Parser for the history command.
+        history_parser = subparsers.add_parser(
+            'history',
+            help="""Report the history of syncs: their speeds, the time spent
+            in each phase of each command, and any drives whose syncs have
+            slowed down.""")
+        history_parser.add_argument(
+            '--drive',
+            help='Only show syncs involving this drive.')
+        history_parser.add_argument(
+            '--limit',
+            type=int,
+            default=20,
+            help='Number of recent syncs to show (default: %(default)s).')
+        history_parser.add_argument(
+            '--threshold',
+            type=float,
+            default=20,
+            help="""Slowdown, as a percentage, beyond which a drive is
+            flagged as regressed (default: %(default)s).""")
+        history_parser.set_defaults(func=self.history)
+
+        # Parser for the plan command.
+        plan_parser = subparsers.add_parser(
+            'plan',
+            help="""Show the steps an add, replace or remove would take, with
+            the data each step reads and writes on each drive and an estimate
+            of how long it will take.  Nothing is changed.""")
+        plan_parser.add_argument(
+            '--speed',
+            type=float,
+            help="""Sustained speed of each drive during resync and reshape,
+            in MB/s, used to estimate timings (default: the median of recent
+            syncs in the history, or {:.0f} with no history).""".format(
+                Plan.DEFAULT_SPEED / (1000 * 1000)))
+        add_probe_arguments(plan_parser)
+        add_fs_arguments(plan_parser)
+        add_tune_arguments(plan_parser)
+        plan_parser.add_argument(
+            'operation',
+            choices=['add', 'replace', 'remove'],
+            help='The operation to plan.')
+        plan_parser.add_argument(
+            'lv',
+            help='The Logical Volume the operation applies to.')
+        plan_parser.add_argument(
+            'drives',
+            nargs='+',
+            help="""The drive to add, replace with or remove (eg. /dev/sda).
+            For add and replace, a size (eg. 4TB) plans for a drive which
+            isn't attached yet.  Several drives can be given for add, to plan
+            adding them one after the other.""")
+        plan_parser.set_defaults(func=self.plan)
+
         # Parser for the replace command.
         replace_parser = subparsers.add_parser(
             'replace',
@@ -739,6 +5868,10 @@ class LvmRaidExec:
             default='/tmp/lvmraid5_mdadm_backup_file.txt',
             help="""Backup file for mdadm to use.  This should be on a physical
             drive other than the array.""")
+        add_probe_arguments(replace_parser)
+        add_window_arguments(replace_parser)
+        add_fs_arguments(replace_parser)
+        add_tune_arguments(replace_parser)
         replace_parser.add_argument(
             'lv',
             help='The Logical Volume to add the drive to')
@@ -746,88 +5879,95 @@ class LvmRaidExec:
                                     help='The drive to add.')
         replace_parser.set_defaults(func=self.replace)
 
-        # Now parse the arguments, and call through to the appropriate function.
-        self.args = parser.parse_args(args)
+        # Parser for the status command.
+        status_parser = subparsers.add_parser(
+            'status',
+            help="""Report the status of a Logical Volume and the RAID arrays
+            and drives beneath it.""")
+        status_parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Output the status as JSON.')
+        status_parser.add_argument(
+            '--textfile',
+            help="""Write the status as Prometheus metrics to this file, for
+            the node-exporter textfile collector.  The file is replaced
+            atomically.""")
+        status_parser.add_argument(
+            'lv',
+            help='The Logical Volume to report on.')
+        status_parser.set_defaults(func=self.status)
+
+        # Parser for the tune command.
+        tune_parser = subparsers.add_parser(
+            'tune',
+            help="""Tune the block devices beneath a Logical Volume for a
+            workload: read-ahead on the LV and its arrays from their stripe
+            widths, and the I/O scheduler, nr_requests and queue depth of
+            the drives.  The settings don't persist across reboots, so rerun
+            this at boot (eg. from a systemd unit).""")
+        tune_parser.add_argument(
+            '--profile',
+            choices=sorted(StackTuner.PROFILES),
+            default=StackTuner.DEFAULT_PROFILE,
+            help="""throughput for large sequential transfers, or latency for
+            small random I/O (default: %(default)s).""")
+        tune_parser.add_argument(
+            '--show',
+            action='store_true',
+            help="""Only show the current and recommended settings, without
+            changing anything.""")
+        tune_parser.add_argument(
+            'lv',
+            help='The Logical Volume to tune.')
+        tune_parser.set_defaults(func=self.tune)
+
+        # Parser for the watch command.
+        watch_parser = subparsers.add_parser(
+            'watch',
+            help="""Show a live view of resync and reshape progress on a
+            Logical Volume's RAID arrays, with speeds and ETAs.  This can be
+            run alongside a long-running add, replace or remove.""")
+        watch_parser.add_argument(
+            '--interval',
+            type=float,
+            default=1,
+            help='Seconds between refreshes (default: 1).')
+        watch_parser.add_argument(
+            '--window',
+            type=float,
+            default=SyncMonitor.DEFAULT_WINDOW,
+            help="""Seconds over which to average speeds and ETAs (default:
+            {}).""".format(SyncMonitor.DEFAULT_WINDOW))
+        watch_parser.add_argument(
+            '--count',
+            type=int,
+            help='Stop after this many refreshes (default: run until interrupted).')
+        watch_parser.add_argument(
+            'lv',
+            help='The Logical Volume to watch.')
+        watch_parser.set_defaults(func=self.watch)
 
-        # Call the relevant function.
-        self.args.func()
+        # Now parse the arguments.
+        return parser.parse_args(args)
 
     def create(self):
         """Create a new array from a set of drives"""
         self.log("Creating new array...", logging.INFO)
-        drives = {}
-        drive_sizes = set()
-        array_sizes = []
-        pvs = {}
-
-        # Check that we've been passed at least 2 drives.  We don't currently
-        # support creating degraded arrays.
-        check_critical(len(self.args.drives_for_create) >= 2,
-                       "Must have at least 2 drives for array creation")
-
-        for drive_name in self.args.drives_for_create:
-            drives[drive_name] = self.find_or_create(HardDrive, drive_name)
-            check_critical(
-                drives[drive_name].empty,
-                """Drive {} is not empty - please remove existing partitions
-                before running create.""".format(drive_name))
-            drive_sizes.add(drives[drive_name].size())
-        self.log('Found drive sizes: {}'.format(drive_sizes))
-
-        prev_size = 0
-        for size in sorted(drive_sizes):
-            array_sizes += [size - prev_size]
-            prev_size = size
-        self.log('Creating arrays with sizes: {}'.format(array_sizes),
-                 logging.INFO)
-
-        self.log('Partitioning drives...', logging.INFO)
-        for drive in drives.values():
-            drive.init_partitions()
-            remaining = drive.size()
-            for size in array_sizes:
-                if remaining >= size:
-                    drive.create_partition(size)
-                    remaining -= size
-                else:
-                    break
-
-        # Create each of the RAID arrays in turn, with an LVM PV atop them.
-        self.log('Creating RAID arrays and Physical Volumes...', logging.INFO)
-        part_num = 5  # The first logical partition.
-        while True:  # TODO: pythonize
-            members = ([drive.partitions[part_num] for drive in drives.values()
-                        if part_num in drive.partitions])
-            if len(members) < 2:
-                # We're done.
-                break
-
-            # Create the RAID array.
-            array = self.find_or_create(RaidArray)
-            array.create(members)
-
-            # And now the LVM PV.
-            pvs[array.name] = self.find_or_create(PhysicalVolume, array.name)
-            pvs[array.name].create()
-
-            # Move onto the next partition
-            part_num += 1
-
-        # Now that we've got some PVs, create an VG from them.
-        self.log('Creating Volume Group...', logging.INFO)
-        vg = self.find_or_create(VolumeGroup, self.args.vg_name)
-        vg.create(pvs.values())
-
-        # And finally create a Logical Volume on it.
-        self.log('Creating Logical Volume...', logging.INFO)
-        lv = self.find_or_create(LogicalVolume, vg.name + '/lvol0')
-        lv.create(vg)
+        plan = Planner(self, None).plan_create(self.args.drives_for_create,
+                                               self.args.vg_name, self.args.chunk)
+        lv_name = plan.steps[-1].params['lv']
+        vgcreate = plan.steps[-2]
+        self.plan_tune(plan, lv_name)
+        refs = self.execute_plan(plan, lv_name)
 
         # Log the successful completion.
+        arrays = [refs[ref] for ref in vgcreate.params['arrays']]
         self.log(
             """Volume group {} has been successfully created.
 The following RAID arrays are resyncing in the background: {}.
-You can monitor their status by running "mdadm --detail <array_name>".""".format(vg, pvs.keys()),
+You can monitor their status by running "mdadm --detail <array_name>".""".format(
+                self.args.vg_name, arrays),
             level=logging.INFO)
 
     def examine(self):
@@ -840,7 +5980,174 @@ You can monitor their status by running "mdadm --detail <array_name>".""".format
         self.log('Examining volume {}'.format(self.args.filesystem),
                  logging.INFO)
         lv = self.find_or_create(LogicalVolume, self.args.filesystem)
-        print(lv)
+        self.output(lv)
+
+    def status(self):
+        """Report the status of a logical volume, for humans or machines."""
+        report = StatusReport(self, self.args.lv).gather()
+        if self.args.textfile is not None:
+            report.write_textfile(self.args.textfile)
+        if self.args.json:
+            self.output(report.to_json())
+        elif self.args.textfile is None:
+            self.output(report)
+
+    def watch(self):
+        """Show a live dashboard of sync progress until interrupted."""
+        report = StatusReport(self, self.args.lv).gather()
+        monitor = SyncMonitor(self, [array['name'] for array in report.arrays],
+                              window=self.args.window)
+        clear_screen = sys.stdout.isatty() and self.output_buffer is None
+        refreshes = 0
+        try:
+            while self.args.count is None or refreshes < self.args.count:
+                monitor.sample()
+                if clear_screen:
+                    sys.stdout.write('\033[H\033[2J')
+                self.output('{} at {}\n{}'.format(
+                    self.args.lv,
+                    time.strftime('%H:%M:%S', time.localtime(self.backend.time())),
+                    monitor.render()))
+                refreshes += 1
+                if self.args.count is None or refreshes < self.args.count:
+                    self.sleep(self.args.interval)
+        except (KeyboardInterrupt, LvmRaidCancelled):
+            pass
+
+    def daemon(self):
+        """Run as a daemon, serving commands over a Unix socket."""
+        self.service = LvmRaidDaemon(
+            self, self.args.socket or LvmRaidDaemon.DEFAULT_SOCKET)
+        self.service.serve()
+
+    def jobs(self):
+        """List the jobs queued on the daemon."""
+        for job in self.service.jobs:
+            line = "{} {} '{}'".format(job['id'], job['state'],
+                                       " ".join(job['argv']))
+            if job['message'] is not None:
+                line += ': {}'.format(job['message'])
+            self.output(line)
+
+    def cancel(self):
+        """Cancel a job on the daemon."""
+        job = self.service.cancel_job(self.args.job)
+        self.output('Cancelled job {}: {}'.format(job['id'], ' '.join(job['argv'])))
+
+    def forward_to_daemon(self, args):
+        """Send a command to a running daemon, and output its reply."""
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(self.args.socket)
+            client.sendall(json.dumps({'argv': args}) + '\n')
+            reply = json.loads(client.makefile().readline())
+        except (socket.error, ValueError) as e:
+            check_critical(False, 'Failed to talk to daemon at {}: {}'.format(
+                self.args.socket, e))
+        finally:
+            client.close()
+
+        check_critical(reply['status'] != 'error', reply.get('message'))
+        if reply['status'] == 'queued':
+            self.output('Queued as job {}'.format(reply['job']))
+        elif reply['output']:
+            self.output(reply['output'])
+
+    def output(self, text):
+        """Output the result of a command to the user."""
+        if self.output_buffer is not None:
+            self.output_buffer.append(str(text))
+        else:
+            print(text)
+
+    def progress(self, **fields):
+        """Report the progress of a command.
+
+        An event is a dictionary of PROGRESS_FIELDS, those not given being
+        None: the phase (a plan step's action, or 'resync' or 'reshape'
+        while waiting for one), the step number out of steps, the array being
+        waited for, its percent complete, speed (bytes/s per member) and ETA
+        (seconds), and a message describing it all.  Events go to the
+        on_progress callback, or without one, syncs are shown on stdout.
+
+        """
+        event = dict((field, None) for field in LvmRaidExec.PROGRESS_FIELDS)
+        event.update(fields, time=self.backend.time())
+        if self.on_progress is not None:
+            self.on_progress(event)
+        elif event['phase'] in ('resync', 'reshape'):
+            print(event['message'] + '...\r')
+
+    def history(self):
+        """Report the history of syncs and operations."""
+        syncs = self.op_history.syncs(self.args.drive)
+        check_critical(syncs or self.args.drive is not None,
+                       'No history recorded in {}'.format(self.op_history.path))
+        self.output('Recent syncs:')
+        for sync in syncs[-self.args.limit:]:
+            self.output('  {} {} {} of {} ({} x {}): {} in {}, {}/s ({})'.format(
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(sync['started'])),
+                sync['action'], sync['array'], sync['level'], sync['raid_devices'],
+                format_bytes(sync['member_size']), format_bytes(sync['bytes']),
+                format_duration(sync['finished'] - sync['started']),
+                format_bytes(sync['speed']), ', '.join(sync['drives'])))
+
+        phase_times = self.op_history.phase_times()
+        if phase_times:
+            self.output('Median time per phase:')
+        for command, (times, count) in sorted(phase_times.items()):
+            self.output('  {} ({} runs): {}'.format(
+                command, count, ', '.join(
+                    '{} {}'.format(phase, format_duration(seconds))
+                    for phase, seconds in sorted(times.items()))))
+
+        self.output('Sync speed by drive (earlier median -> recent median):')
+        for trend in self.op_history.drive_trends(self.args.threshold / 100.0):
+            if self.args.drive is not None and trend['drive'] != self.args.drive:
+                continue
+            line = '  {}: {} syncs, '.format(trend['drive'], trend['syncs'])
+            if trend['earlier'] is None:
+                line += '{}/s'.format(format_bytes(trend['recent']))
+            else:
+                line += '{}/s -> {}/s ({:+.0f}%)'.format(
+                    format_bytes(trend['earlier']), format_bytes(trend['recent']),
+                    trend['change'] * 100)
+            if trend['regressed']:
+                line += ' <- REGRESSION'
+            self.output(line)
+
+    def scrub(self):
+        """Check or repair the parity of an LV's arrays."""
+        if not self.op_history.connect():
+            self.log('No history to record progress in: scrubbing from the start',
+                     logging.WARNING)
+        max_speed = None
+        if self.args.max_speed is not None:
+            max_speed = long(self.args.max_speed * 1000 * 1000)
+        scrubber = Scrubber(self, self.args.lv, window=self.args.window_size,
+                            budget=self.args.budget, max_speed=max_speed,
+                            serial=self.args.serial)
+        windows = scrubber.run('repair' if self.args.repair else 'check')
+        if not windows:
+            self.output('Nothing to {}'.format(
+                'repair' if self.args.repair else 'scrub'))
+        for window in windows:
+            self.output('{} {} {} - {} of {}: {} mismatched sectors in {}'.format(
+                window['action'], window['array'], format_bytes(window['start']),
+                format_bytes(window['end']), format_bytes(window['total']),
+                window['mismatches'],
+                format_duration(window['finished'] - window['started'])))
+
+    def planning_speed(self, lv):
+        """The drive speed to base estimates on: from the history if possible."""
+        if lv.vg is None:
+            return Plan.DEFAULT_SPEED
+        speed = self.op_history.typical_speed(lv.vg.drives().keys())
+        if speed is None:
+            return Plan.DEFAULT_SPEED
+        self.log('Estimating with {}/s per drive, from the history of recent syncs'
+                 .format(format_bytes(speed)))
+        return speed
 
     def remove(self):
         """Remove a physical drive from an array.
@@ -852,195 +6159,855 @@ You can monitor their status by running "mdadm --detail <array_name>".""".format
         # Get the info for the hard drive.  This bails if there are any
         # partitions that aren't LVM raid ones.
         lv = self.find_or_create(LogicalVolume, self.args.lv)
-        drive = self.find_or_create(HardDrive, self.args.drive_to_remove)
-
-        # Wait for the arrays to complete resync (this will exit if the arrays
-        # aren't clean or resycing).
-        lv.wait_for_resync_complete()
-
-        # We're good to remove the drive.  Remove it from each array in turn.
-        for partition in drive.partitions.values():
-            for pv in lv.vg.pvs.values():
-                if partition in pv.raid_array.members.values():
-                    pv.raid_array.remove_member(partition)
+        plan = Planner(self, lv, self.planning_speed(lv)).plan_remove(self.args.drive_to_remove)
+        self.execute_plan(plan, self.args.lv)
+
+        # Other arrays weren't waited for, so may still be syncing.
+        report = StatusReport(self, None)
+        for name in sorted(lv.vg.pvs):
+            array = report.gather_array(name)
+            if array['sync_action'] not in (None, 'idle'):
+                self.log('{} is still syncing ({}{})'.format(
+                    name, array['sync_action'],
+                    '' if array['sync_completed'] is None
+                    else ', {:.1%} complete'.format(array['sync_completed'])),
+                    logging.INFO)
 
     def add(self):
         """Adds a new drive to a clean array."""
         lv = self.find_or_create(LogicalVolume, self.args.lv)
-        new_drive = self.find_or_create(HardDrive, self.args.drive_to_add)
-
-        # Call through to common subfunction.
-        self._add_replace_comn(lv, new_drive, grow=True)
+        plan = Planner(self, lv, self.planning_speed(lv)).plan_add_replace(
+            self.args.drive_to_add, grow=True)
+        if self.args.probe:
+            self.probe_new_drive(lv, plan, self.args.drive_to_add)
+        self.plan_resize_fs(plan, self.args.lv)
+        self.plan_tune(plan, self.args.lv)
+        self.execute_plan(plan, self.args.lv)
 
     def replace(self):
         """Replace is a drive in the array."""
-        # Check assumptions.
         lv = self.find_or_create(LogicalVolume, self.args.lv)
-        drive_to_add = self.find_or_create(HardDrive, self.args.drive_to_add)
+        plan = Planner(self, lv, self.planning_speed(lv)).plan_add_replace(
+            self.args.drive_to_add, grow=False)
+        if self.args.probe:
+            self.probe_new_drive(lv, plan, self.args.drive_to_add)
+        self.plan_resize_fs(plan, self.args.lv)
+        self.plan_tune(plan, self.args.lv)
+        self.execute_plan(plan, self.args.lv)
+
+    def probe_new_drive(self, lv, plan, drive_name, read_only=False):
+        """Check a new drive's throughput against the LV's existing drives.
+
+        The existing drives are in use, so can only be read: their read
+        speed stands in for their throughput.  The new drive's throughput is
+        the slower of its read and (if it's blank) write speeds, so that
+        drives which only slow down on writes, like SMR drives, are caught.
+        A drive with partitions, or a filesystem, RAID or LVM signature on
+        the whole drive, is only read.
+
+        Arrays only go as fast as their slowest member, so the plan's
+        estimate is updated with the new drive's relative speed.  If the new
+        drive is too slow (see --max-slowdown), refuses or warns (see
+        --slow-drive).  With read_only, nothing is written and the check
+        only warns.
 
-        # Call through to common subfunction.
-        self._add_replace_comn(lv, drive_to_add, grow=False)
+        """
+        new_drive = self.find_or_create(HardDrive, drive_name)
+        self.log('Probing the throughput of {} and the drives of {}'.format(
+            drive_name, lv), logging.INFO)
+        write = not read_only and new_drive.empty
+        signature = new_drive.signature() if write else None
+        if signature is not None:
+            self.log('Not write testing {}: it holds a {} signature.'.format(
+                drive_name, signature), logging.WARNING)
+            write = False
+        new = new_drive.probe_throughput(write=write)
+        new_speed = min(speed for speed in new.values() if speed is not None)
+        lines = ['Throughput (median of {} samples):'.format(
+            len(HardDrive.PROBE_OFFSETS))]
+        lines.append('  {} (new): read {}/s, write {}'.format(
+            drive_name, format_bytes(new['read']),
+            'not tested' if new['write'] is None
+            else '{}/s'.format(format_bytes(new['write']))))
+
+        existing = []
+        for name in sorted(lv.vg.drives()):
+            if name == drive_name:
+                continue
+            speed = self.find_or_create(HardDrive, name).probe_throughput()['read']
+            existing.append(speed)
+            lines.append('  {}: read {}/s'.format(name, format_bytes(speed)))
+        if not existing:
+            self.output('\n'.join(lines))
+            return
+
+        existing_speed = median(existing)
+        slowdown = existing_speed / new_speed
+        before = plan.duration()
+        plan.drive_speeds[drive_name] = plan.speed * min(1, 1 / slowdown)
+        lines.append('{} runs at {:.0%} of the speed of the existing drives: '
+                     'estimated time {} (against {} at their speed).'.format(
+                         drive_name, 1 / slowdown,
+                         format_duration(plan.duration()), format_duration(before)))
+        self.output('\n'.join(lines))
+
+        if slowdown > self.args.max_slowdown:
+            msg = """{} is {:.1f} times slower than the existing drives, beyond
+                  the maximum of {} (see --max-slowdown).""".format(
+                      drive_name, slowdown, self.args.max_slowdown)
+            if not read_only and self.args.slow_drive == 'refuse':
+                check_critical(False, msg)
+            self.log(msg, logging.WARNING)
+
+    def plan_resize_fs(self, plan, lv_name):
+        """With --resize-fs, grow the LV's filesystem once the LV is extended.
+
+        Checks up front that the filesystem can be grown, rather than finding
+        out after the arrays have been reshaped.
 
-    def _add_replace_comn(self, lv, new_drive, grow):
-        """Common function used by replace and add modes, as processing is very similar.
+        """
+        if not (self.args.resize_fs and
+                any(step.action == 'lvextend' for step in plan.steps)):
+            return
+        fs = self.find_or_create(Filesystem, lv_name)
+        check_critical(fs.fs_type in Filesystem.BINARIES,
+                       'Cannot resize the filesystem on {}: {}.'.format(
+                           lv_name, 'no filesystem found' if fs.fs_type is None
+                           else '{} is not supported'.format(fs.fs_type)))
+        for name, path in self.backend.find_binaries(
+                Filesystem.BINARIES[fs.fs_type]).items():
+            check_critical(path is not None, 'Missing dependency: {}'.format(name))
+        check_critical(fs.is_ext() or fs.mountpoint is not None,
+                       'XFS on {} can only be grown while mounted.'.format(lv_name))
+        plan.add_step('resize_fs',
+                      'Grow the {} filesystem on {} and match its stripe '
+                      'geometry to the {} tier'.format(fs.fs_type, lv_name,
+                                                       self.args.fs_geometry),
+                      geometry=self.args.fs_geometry)
+
+    def target_stripe_geometry(self, lv_name, policy):
+        """Work out the stripe geometry an LV's filesystem should have.
+
+        The LV spans tiers of arrays with different numbers of members, so no
+        one geometry fits all of it.  policy picks the tier to match: the
+        'dominant' one, holding most of the LV's extents, or the 'widest'.
+        Returns the stripe unit and width in bytes, and the array matched.
 
-        If grow is False then the array must be degraded, and the total number
-        of drives in the array doesn't change.
+        """
+        report = StatusReport(self, lv_name).gather()
+        tiers = [(pv['used'], array) for pv, array in zip(report.pvs, report.arrays)
+                 if array['raid_disks'] > 1 and array['chunk_size']]
+        check_critical(tiers, 'Could not find the arrays of {}'.format(lv_name))
+        if policy == 'widest':
+            key = lambda tier: (tier[1]['raid_disks'], tier[0])
+        else:
+            key = lambda tier: (tier[0], tier[1]['raid_disks'])
+        array = max(tiers, key=key)[1]
+        # RAID5: one member's worth of each stripe is parity.
+        return (array['chunk_size'],
+                array['chunk_size'] * (array['raid_disks'] - 1), array)
+
+    def resize_filesystem(self, lv_name, policy):
+        """Grow an LV's filesystem to fill it, and update its stripe geometry."""
+        fs = self.find_or_create(Filesystem, lv_name)
+        fs.get_info()
+        old_size = fs.size
+        fs.grow()
+        lines = ['{} filesystem on {}: grown from {} to {}'.format(
+            fs.fs_type, lv_name, format_bytes(old_size), format_bytes(fs.size))]
+
+        unit, width, array = self.target_stripe_geometry(lv_name, policy)
+        old_geometry = fs.describe_geometry()
+        new_geometry = fs.describe_geometry(unit, width)
+        matching = '{}: {} members with {}K chunks, the {} tier'.format(
+            array['name'], array['raid_disks'], unit // 1024, policy)
+        if old_geometry == new_geometry:
+            lines.append('Stripe geometry unchanged: {} (matching {})'.format(
+                old_geometry, matching))
+        else:
+            applied = fs.set_stripe_geometry(unit, width)
+            lines.append('Stripe geometry {}: {} -> {} (matching {})'.format(
+                'updated' if applied else 'needs a remount', old_geometry,
+                new_geometry, matching))
+        self.output('\n'.join(lines))
+
+    def plan_tune(self, plan, lv_name):
+        """With --tune, tune the block devices once the plan has run."""
+        if self.args.tune is None:
+            return
+        plan.add_step('tune', 'Tune the block devices beneath {} for {}'.format(
+            lv_name, self.args.tune), profile=self.args.tune)
+
+    def tune(self):
+        """Show or apply a tuning profile to the block devices under an LV."""
+        if not self.args.show:
+            self.tune_stack(self.args.lv, self.args.profile)
+            return
+        tuner = StackTuner(self, self.args.lv, self.args.profile)
+        lines = ['{:<24}{:<16}{:>16}{:>16}'.format(
+            'device', 'setting', 'current', self.args.profile)]
+        for setting in tuner.settings():
+            lines.append('{:<24}{:<16}{:>16}{:>16}{}'.format(
+                setting['device'], setting['name'], setting['current'],
+                setting['recommended'],
+                '' if setting['current'] == setting['recommended'] else ' <- differs'))
+        self.output('\n'.join(lines))
+
+    def tune_stack(self, lv_name, profile):
+        """Apply a tuning profile to the block devices under an LV."""
+        changed = StackTuner(self, lv_name, profile).apply()
+        if not changed:
+            self.output('{} is already tuned for {}'.format(lv_name, profile))
+        for setting in changed:
+            self.output('{} {}: {} -> {}'.format(
+                setting['device'], setting['name'], setting['current'],
+                setting['recommended']))
+
+    def plan(self):
+        """Work out the steps of an operation, without running them."""
+        lv = self.find_or_create(LogicalVolume, self.args.lv)
+        if self.args.speed is not None:
+            speed = self.args.speed * 1000 * 1000
+        else:
+            speed = self.planning_speed(lv)
+        planner = Planner(self, lv, speed=speed)
+        if self.args.operation == 'remove':
+            check_critical(len(self.args.drives) == 1,
+                           'Only one drive can be removed at a time.')
+            plan = planner.plan_remove(self.args.drives[0])
+        else:
+            check_critical(self.args.operation == 'add' or len(self.args.drives) == 1,
+                           'Only one drive can be replaced at a time.')
+            plan = None
+            for drive_name in self.args.drives:
+                plan = planner.plan_add_replace(
+                    drive_name, grow=(self.args.operation == 'add'), plan=plan)
+                # Drives given by size aren't attached yet, so can't be probed.
+                if self.args.probe and parse_size(drive_name) is None:
+                    self.probe_new_drive(lv, plan, drive_name, read_only=True)
+            self.plan_resize_fs(plan, self.args.lv)
+            self.plan_tune(plan, self.args.lv)
+        self.output(plan)
+
+    def execute_plan(self, plan, lv_name, start=0, refs=None, completed=()):
+        """Run the steps of a plan in order.
+
+        Partitioning steps on different drives are run concurrently (see
+        step_groups()).  Objects created along the way (partitions and
+        arrays) are recorded against the references used for them in the
+        plan, and returned.
+
+        Progress is journalled, so that an interrupted plan can be resumed.
+        Resuming passes the step to start from, any later steps which have
+        already completed, and the references so far.
 
-        If grow is True then the array must be clean, and the total number of
-        drives in the array is increased by one.
+        """
+        self.log('Running plan:\n{}'.format(plan.describe(refs or {})))
+        if refs is None:
+            check_critical(self.journal.load() is None,
+                           """An interrupted {} is recorded in {}: run the resume
+                           command to finish it first.""".format(
+                               self.journal.data and self.journal.data['command'],
+                               self.journal.path))
+            refs = {}
+            window = getattr(self.args, 'window', None)
+            self.journal.begin(self.args.func.__name__, lv_name, plan,
+                               {'mdadm_backup_file':
+                                getattr(self.args, 'mdadm_backup_file', None),
+                                'window': window and str(window),
+                                'detach': getattr(self.args, 'detach', False)})
+        # Whether anything has been changed.  A list, so that the steps run
+        # below can set it.
+        changed = [start > 0]
+
+        def run_steps(indices):
+            for index in indices:
+                step = plan.steps[index]
+                description = step.describe(refs)
+                self.log(description, logging.INFO)
+                self.progress(phase=step.action, step=index + 1,
+                              steps=len(plan.steps), message=description)
+                # Steps which pick the name of a new array hold on to it until
+                # the array exists, in case another operation in this process
+                # (see Operation) is picking one too.
+                names_lock = (LvmRaidExec.array_names_lock
+                              if step.action in ('create_array', 'choose_chunk')
+                              else threading.Lock())
+                with names_lock:
+                    checkpoint = self.checkpoint_step(step, refs)
+                    self.journal.start_step(index, refs, checkpoint)
+                    if step.action != 'wait':
+                        changed[0] = True
+                    self.run_step(step, lv_name, refs, checkpoint)
+                # Say what a step which created something called it.
+                if step.describe(refs) != description:
+                    self.log('Done: {}'.format(step.describe(refs)), logging.INFO)
+                self.journal.finish_step(index, refs)
+
+        indices = [index for index in range(start, len(plan.steps))
+                   if index not in completed]
+        try:
+            for group in self.step_groups(plan, indices):
+                self.run_parallel([functools.partial(run_steps, sequence)
+                                   for sequence in group])
+        except LvmRaidException:
+            # A check failed.  If nothing had been changed, there's nothing to
+            # resume.
+            if not changed[0]:
+                self.journal.finish()
+            raise
+        self.journal.finish()
+
+        # Steps such as grows and removals change the arrays in place.
+        vg = self.find_or_create(LogicalVolume, lv_name).vg
+        if vg is not None:
+            self.sync_mdadm_conf(vg.name)
+        return refs
+
+    def sync_mdadm_conf(self, vg_name):
+        """List the VG's arrays in the managed section of mdadm.conf."""
+        if not self.mdadm_conf.enabled():
+            return
+        vg = self.find_or_create(VolumeGroup, vg_name)
+        vg.get_info()
+        arrays = []
+        for name in sorted(vg.pvs):
+            array = vg.pvs[name].raid_array
+            array.get_info()
+            if array.uuid is not None:
+                arrays.append({'device': array.name, 'uuid': array.uuid,
+                               'name': array.md_name, 'metadata': array.metadata})
+        if self.mdadm_conf.update(vg_name, arrays):
+            self.log('Listed the arrays of {} in {}: update the initramfs (eg. '
+                     'update-initramfs -u) for them to be assembled from it at boot.'
+                     .format(vg_name, self.mdadm_conf.path), logging.INFO)
+        for line in self.mdadm_conf.conflicts(arrays):
+            self.log('{} also lists "{}" outside the lvmraid5 section: remove it, '
+                     'as mdadm may assemble the array from it instead.'.format(
+                         self.mdadm_conf.path, line), logging.WARNING)
+
+    def assemble(self):
+        """Assemble the arrays listed in mdadm.conf, and activate their VGs."""
+        check_critical(self.mdadm_conf.enabled(),
+                       'No mdadm.conf to assemble from: give --mdadm-conf.')
+        vgs = self.mdadm_conf.vgs()
+        names = [os.path.basename(name) for name in self.args.vgs] or list(vgs)
+        for name in names:
+            check_critical(name in vgs, '{} is not listed in {}'.format(
+                name, self.mdadm_conf.path))
+        check_critical(names, 'No VGs are listed in {}'.format(self.mdadm_conf.path))
+
+        total = 0
+        for name in names:
+            pvs = vgs[name]['pvs']
+            start = self.backend.time()
+            with self.phase('md'):
+                for device in pvs:
+                    if self.find_or_create(RaidArray, device).state is not None:
+                        self.log('{} is already assembled'.format(device))
+                        continue
+                    array_start = self.backend.time()
+                    self.run_cmd(['mdadm', '--assemble',
+                                  '--config={}'.format(self.mdadm_conf.path), device])
+                    self.log('Assembled {} in {:.2f}s'.format(
+                        device, self.backend.time() - array_start))
+            assembled = self.backend.time()
+
+            # Only let LVM see this VG's arrays, rather than scan everything.
+            with self.phase('lvm'):
+                self.run_cmd(['vgchange', '--activate', 'y', '--config',
+                              'devices {{ filter = [ {}, "r|.*|" ] }}'.format(
+                                  ', '.join('"a|^{}$|"'.format(pv) for pv in pvs)),
+                              name])
+            activated = self.backend.time()
+            self.output('{}: assembled {} arrays in {:.2f}s, activated in {:.2f}s'
+                        .format(name, len(pvs), assembled - start,
+                                activated - assembled))
+            total += activated - start
+        if len(names) > 1:
+            self.output('Total: {:.2f}s'.format(total))
+
+    def step_groups(self, plan, indices):
+        """Split the steps of a plan into groups which can run concurrently.
+
+        Yields a list of sequences of step indices for each group: the
+        sequences in a group can run at the same time, but the steps in each
+        sequence must run in order.  Runs of partitioning steps are split by
+        drive, and runs of removals by array; any other step is a group on
+        its own.
 
         """
-        assert(lv is not None)
-        assert(new_drive is not None)
-        other_drive_for_new_array = None
-        extend_lv = False
+        key = None
+        sequences = collections.OrderedDict()
+        for index in indices:
+            step = plan.steps[index]
+            step_key = LvmRaidExec.CONCURRENT_ACTIONS.get(step.action)
+            if sequences and step_key != key:
+                yield list(sequences.values())
+                sequences = collections.OrderedDict()
+            key = step_key
+            if key is None:
+                yield [[index]]
+            else:
+                sequences.setdefault(step.params[key], []).append(index)
+        if sequences:
+            yield list(sequences.values())
 
-        # Check that the new drive doesn't have anything on it.
-        check_critical(
-            new_drive.empty,
-            'New drive {} is not empty.'.format(self.args.drive_to_add))
-
-        # Spin through the existing arrays on the LV, creating partitions of the
-        # corresponding size on the drive.  We want to spin through the arrays
-        # in order of the number of drives in them (largest to smallest).
-        arrays = sorted([pv.raid_array for pv in lv.vg.pvs.values()],
-                        key=lambda element: len(element.members),
-                        reverse=True)
-        self.log("Existing array sizes: {}".format(
-            [array.members_size() for array in arrays]))
+    def run_parallel(self, tasks):
+        """Run independent tasks, each in its own thread, until all finish.
 
-        # Check whether the drive matches one of the existing drives.
-        size = 0
-        drive_matches = False
-        for array in arrays:
-            size += array.members_size()
-            if new_drive.size() == size:
-                drive_matches = True
+        If a task fails, the others are cancelled, and the failure re-raised.
+        Backends which can't run commands concurrently (ie. the simulator)
+        run the tasks one after another instead.
 
-        # We currently don't support adding randomly-sized drives.
-        check_critical((new_drive.size() > size) or drive_matches,
-                       """New drive capacity must either match one of the
-                       existing arrays, or be larger than all existing arrays.
-                       """)
+        """
+        if len(tasks) < 2 or not self.backend.concurrent:
+            for task in tasks:
+                task()
+            return
 
-        if grow:
-            # The LV must be clean.  It may be resyncing at the moment, so wait.
-            lv.wait_for_resync_complete()
-        else:
-            # Spin through the unclean arrays, checking that:
-            # - there's at least one unclean array
-            # - the drive being added is large enough to be added to all the
-            #   unclean arrays.
-            unclean_size = 0
-            for array in arrays:
-                if not array.is_clean():
-                    unclean_size += array.members_size()
-            check_critical(unclean_size != 0,
-                           """The LV is clean; cannot replace drive in it.""")
-            check_critical(unclean_size <= new_drive.size(),
-                           """The LV needs a drive of size at least {} to make
-                           the array clean.""".format(unclean_size))
+        failures = []
 
-        new_drive.init_partitions()
-        for array in arrays:
-            member = new_drive.create_partition(array.members_size(), allow_failure=True)
-            if not member:
-                # Couldn't create the partition, which means we're out of space
-                # on the new drive.  Drop out.
-                break
-            self.log("""Adding {} to array {}""".format(member, array),
-                     level=logging.INFO)
-
-            # Check whether this RAID array was clean before the add.  If it
-            # was then we're adding this partition as a spare, so the array
-            # can grow.
-            # TODO: shouldn't need to refresh info here, remove once this is updated
-            # to not have global state.
+        def run(task):
+            try:
+                task()
+            except BaseException as e:
+                self.log('Parallel task failed: {}'.format(e))
+                failures.append(e)
+                self.cancelled.set()
+
+        threads = [threading.Thread(target=run, args=(task,)) for task in tasks]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # Join with a timeout, so that signals are still handled.
+            while thread.is_alive():
+                thread.join(RealBackend.POLL_INTERVAL)
+        if failures:
+            # Report the failure which caused the others to be cancelled.
+            failures.sort(key=lambda e: isinstance(e, LvmRaidCancelled))
+            raise failures[0]
+
+    def choose_chunk_size(self, partitions):
+        """Benchmark each candidate chunk size, returning the best.
+
+        A scratch array is built from the partitions with each chunk size in
+        turn.  They're created without a resync, since their contents don't
+        matter, and stopped after benchmarking.  Each chunk size is scored on
+        sequential write, sequential read and random read speed, relative to
+        the best chunk size for each, and the best mean score wins.
+
+        """
+        results = collections.OrderedDict()
+        for chunk in LvmRaidExec.CHUNK_CANDIDATES:
+            array = self.find_or_create(RaidArray, RaidArray.next_free_name(self))
+            array.create(partitions, chunk=chunk, assume_clean=True, level=5)
+            try:
+                results[chunk] = array.benchmark()
+            finally:
+                array.stop()
+
+        metrics = ('write', 'read', 'random')
+        best = dict((metric, max(speeds[metric] for speeds in results.values()))
+                    for metric in metrics)
+        scores = dict((chunk, sum(speeds[metric] / best[metric]
+                                  for metric in metrics) / len(metrics))
+                      for chunk, speeds in results.items())
+        chosen = max(results, key=lambda chunk: scores[chunk])
+
+        lines = ['Chunk size benchmarks:']
+        for chunk, speeds in results.items():
+            lines.append('  {:>5}K: write {}/s, read {}/s, random read {}/s, '
+                         'score {:.2f}{}'.format(
+                             chunk, format_bytes(speeds['write']),
+                             format_bytes(speeds['read']),
+                             format_bytes(speeds['random']), scores[chunk],
+                             ' (chosen)' if chunk == chosen else ''))
+        self.log('\n'.join(lines), logging.INFO)
+        return chosen
+
+    def checkpoint_step(self, step, refs):
+        """Record what's needed to tell whether a step took effect.
+
+        See step_completed().
+
+        """
+        params = step.params
+        if step.action == 'create_partition':
+            drive = self.find_or_create(HardDrive, params['drive'])
+            return {'partitions': sorted(part.name
+                                         for part in drive.partitions.values())}
+        elif step.action in ('create_array', 'choose_chunk'):
+            return {'array': RaidArray.next_free_name(self)}
+        elif step.action == 'grow':
+            array_name = refs.get(params['array'], params['array'])
+            return {'raid_disks':
+                    StatusReport(self, None).gather_array(array_name)['raid_disks']}
+        return {}
+
+    def run_step(self, step, lv_name, refs, checkpoint):
+        """Run a single step of a plan."""
+        def resolve(name):
+            return refs.get(name, name)
+
+        params = step.params
+        if step.action == 'wait' and 'arrays' in params:
+            self.run_parallel([self.find_or_create(RaidArray, name).wait_for_resync_complete
+                               for name in params['arrays']])
+        elif step.action == 'wait':
+            self.find_or_create(LogicalVolume, lv_name).wait_for_resync_complete()
+        elif step.action == 'init_partitions':
+            self.find_or_create(HardDrive, params['drive']).init_partitions()
+        elif step.action == 'create_partition':
+            drive = self.find_or_create(HardDrive, params['drive'])
+            partition = drive.create_partition(params['size'],
+                                               allow_failure=True)
+            check_critical(partition is not None,
+                           """Ran out of space on {} for a partition of size {}:
+                           stopping here.""".format(drive, params['size']))
+            refs[params['ref']] = partition.name
+        elif step.action == 'add':
+            array = self.find_or_create(RaidArray, resolve(params['array']))
+            # Cheap unless the array has changed, when it's needed: the query
+            # cache only goes back to mdadm if so.
             array.get_info()
-            array_was_clean = array.is_clean()
-
-            # For some reason the created partition sometimes doesn't appear.
-            # Running partprobe solves it (though shouldn't be necessary).
-            self.run_cmd(["partprobe"])
-
-            # Now add the drive.
-            array.add(member)
-
-            # If we've been asked to grow the array, do so.
-            if array_was_clean:
-                array.grow(self.args.mdadm_backup_file)
-                array.pv.grow()
-                extend_lv = True
-
-        # Now check whether we can create a new array.
-        if new_drive.unallocated_size() > 0:
-            for drive in lv.vg.drives().values():
-                if ((drive is not new_drive) and (drive.unallocated_size() > 0)):
-                    self.log("""Drive {} has unallocated size {}""".format(drive.name, drive.unallocated_size()))
-                    assert(other_drive_for_new_array is None)
-                    other_drive_for_new_array = drive
-
-        if other_drive_for_new_array is not None:
-            new_array_size = min(new_drive.unallocated_size(),
-                                 other_drive_for_new_array.unallocated_size())
-            self.log("""Creating new array with element size {} on drives
-                     {}, {}""".format(new_array_size,
-                                      other_drive_for_new_array,
-                                      new_drive),
-                     level=logging.INFO)
-
-            member1 = new_drive.create_partition(new_array_size)
-            member2 = other_drive_for_new_array.create_partition(new_array_size)
 
+            # For some reason the created partition sometimes doesn't
+            # appear.  Running partprobe solves it (though shouldn't be
+            # necessary).
+            with self.phase('partitioning'):
+                self.run_cmd(["partprobe"], retry=True)
+            array.add(self.find_or_create(Partition, resolve(params['partition'])),
+                      high_priority=params.get('priority') == 'high')
+        elif step.action == 'grow':
+            array = self.find_or_create(RaidArray, resolve(params['array']))
+            array.grow(self.args.mdadm_backup_file, chunk=params.get('chunk'))
+        elif step.action == 'pvresize':
+            array = self.find_or_create(RaidArray, resolve(params['array']))
+            array.pv.grow()
+        elif step.action == 'create_array':
             # Again, run partprobe.
-            self.run_cmd(["partprobe"])
+            with self.phase('partitioning'):
+                self.run_cmd(["partprobe"], retry=True)
+            array = self.find_or_create(RaidArray, checkpoint['array'])
+            array.create([self.find_or_create(Partition, resolve(ref))
+                          for ref in params['partitions']],
+                         chunk=resolve(params.get('chunk')))
+            refs[params['array']] = array.name
+        elif step.action == 'choose_chunk':
+            with self.phase('partitioning'):
+                self.run_cmd(["partprobe"], retry=True)
+            refs[params['ref']] = self.choose_chunk_size(
+                [self.find_or_create(Partition, resolve(ref))
+                 for ref in params['partitions']])
+        elif step.action == 'pvcreate':
+            self.find_or_create(PhysicalVolume,
+                                resolve(params['array'])).create()
+        elif step.action == 'vgcreate':
+            vg = self.find_or_create(VolumeGroup, params['vg'])
+            vg.create([self.find_or_create(PhysicalVolume, resolve(ref))
+                       for ref in params['arrays']])
+            self.sync_mdadm_conf(vg.name)
+        elif step.action == 'vgextend':
+            vg = self.find_or_create(LogicalVolume, lv_name).vg
+            vg.extend(self.find_or_create(PhysicalVolume, resolve(params['array'])))
+            self.sync_mdadm_conf(vg.name)
+        elif step.action == 'lvcreate':
+            self.find_or_create(LogicalVolume, params['lv']).create(
+                self.find_or_create(VolumeGroup, params['vg']))
+        elif step.action == 'lvextend':
+            self.find_or_create(LogicalVolume, lv_name).extend()
+        elif step.action == 'resize_fs':
+            self.resize_filesystem(lv_name, params['geometry'])
+        elif step.action == 'tune':
+            self.tune_stack(lv_name, params['profile'])
+        elif step.action == 'remove_member':
+            array = self.find_or_create(RaidArray, params['array'])
+            array.remove_member(self.find_or_create(Partition,
+                                                    params['partition']))
+        elif step.action == 'vgreduce':
+            self.find_or_create(LogicalVolume, lv_name).vg.reduce(
+                self.find_or_create(PhysicalVolume, params['array']))
+        elif step.action == 'recreate_array':
+            with self.phase('partitioning'):
+                self.run_cmd(["partprobe"], retry=True)
+            array = self.find_or_create(RaidArray, params['array'])
+            if array.state is not None:
+                array.stop()
+            array.create([self.find_or_create(Partition, resolve(ref))
+                          for ref in params['partitions']],
+                         chunk=params['chunk'], assume_clean=True,
+                         level=params['level'])
+        elif step.action == 'repair':
+            self.find_or_create(RaidArray, params['array']).start_repair()
+        else:
+            assert False, 'Unknown plan step {}'.format(step.action)
 
-            # Now create the array.
-            new_array = self.find_or_create(RaidArray)
-            new_array.create([member1, member2])
+    def step_completed(self, step, lv_name, checkpoint, refs):
+        """Work out from the live state whether an interrupted step completed.
 
-            # Create a PV on the new array.
-            pv = self.find_or_create(PhysicalVolume, new_array.name)
-            pv.create()
-            lv.vg.extend(pv)
-            extend_lv = True
+        Steps which were part way through a resync or reshape wait for it to
+        finish.  Waits, and steps which are safe to repeat, are rerun.
 
-        if extend_lv:
-            # Now ask the LV to grow to consume the space.
-            lv.extend()
+        """
+        def resolve(name):
+            return refs.get(name, name)
+
+        params = step.params
+        if step.action == 'init_partitions':
+            return not self.find_or_create(HardDrive, params['drive']).empty
+        elif step.action == 'create_partition':
+            drive = self.find_or_create(HardDrive, params['drive'])
+            new = [part.name for part in drive.partitions.values()
+                   if part.name not in checkpoint['partitions']]
+            if new:
+                refs[params['ref']] = new[0]
+            return bool(new)
+        elif step.action == 'add':
+            array = self.find_or_create(RaidArray, resolve(params['array']))
+            if resolve(params['partition']) not in array.members:
+                return False
+            array.wait_for_rebuild(params.get('priority') == 'high')
+            return True
+        elif step.action == 'grow':
+            array_name = resolve(params['array'])
+            raid_disks = StatusReport(self, None).gather_array(array_name)['raid_disks']
+            if raid_disks <= checkpoint['raid_disks']:
+                return False
+            self.find_or_create(RaidArray, array_name).wait_for_resync_complete()
+            return True
+        elif step.action == 'choose_chunk':
+            # Benchmarks are rerun, but first stop any scratch array left
+            # behind.
+            array = self.find_or_create(RaidArray, checkpoint['array'])
+            if array.state is not None:
+                array.stop()
+            return False
+        elif step.action == 'create_array':
+            if self.find_or_create(RaidArray, checkpoint['array']).state is None:
+                return False
+            refs[params['array']] = checkpoint['array']
+            return True
+        elif step.action == 'pvcreate':
+            try:
+                self.run_cmd(['pvs', resolve(params['array'])])
+                return True
+            except subprocess.CalledProcessError:
+                return False
+        elif step.action == 'vgcreate':
+            return bool(self.find_or_create(VolumeGroup, params['vg']).pvs)
+        elif step.action == 'vgextend':
+            vg = self.find_or_create(LogicalVolume, lv_name).vg
+            return resolve(params['array']) in vg.pvs
+        elif step.action == 'lvcreate':
+            return self.find_or_create(LogicalVolume, params['lv']).size is not None
+        elif step.action == 'lvextend':
+            vg = StatusReport(self, None).lvm_report(
+                'vgs', ['vg_free_count'],
+                self.find_or_create(LogicalVolume, lv_name).vg.name)[0]
+            return long(vg['vg_free_count']) == 0
+        elif step.action == 'remove_member':
+            output = self.run_cmd(['mdadm', '--detail', params['array']],
+                                  full_output=True)
+            return params['partition'] not in output.split()
+        elif step.action == 'vgreduce':
+            # Done once the PV's gone; if it's only out of the VG, finish off
+            # by wiping its label.
+            pvs = dict((pv['pv_name'], pv['vg_name']) for pv in
+                       StatusReport(self, None).lvm_report('pvs', ['pv_name', 'vg_name']))
+            if params['array'] in pvs and not pvs[params['array']]:
+                self.run_cmd(['pvremove', params['array']])
+            return not pvs.get(params['array'])
+        elif step.action == 'recreate_array':
+            array = self.find_or_create(RaidArray, params['array'])
+            return (array.state is not None and
+                    set(array.members) == set(resolve(ref)
+                                              for ref in params['partitions']))
+        return False
+
+    def resume(self):
+        """Finish a multi-step command that was interrupted."""
+        journal = self.journal.load()
+        check_critical(journal is not None,
+                       'Nothing to resume: no journal in {}'.format(self.journal.path))
+        plan = Plan.from_dict(journal['plan'])
+        refs = journal['refs']
+        options = journal['options']
+        self.args.mdadm_backup_file = options['mdadm_backup_file']
+        # The maintenance window carries over, unless given again.
+        if self.args.window is None and options.get('window') is not None:
+            self.args.window = MaintenanceWindow.parse(options['window'])
+        self.args.detach = self.args.detach or options.get('detach', False)
+        self.log('Resuming {}: {}'.format(journal['command'], plan.description),
+                 logging.INFO)
+        paused = journal.get('paused')
+        if paused is not None and paused['completed'] is not None:
+            self.log('The reshape of {} was {:.1f}% complete at {}'.format(
+                paused['array'], paused['completed'] * 100,
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(paused['time']))),
+                logging.INFO)
+
+        for index in sorted(int(key) for key in journal['in_progress']):
+            step = plan.steps[index]
+            if self.step_completed(step, journal['lv'],
+                                   journal['in_progress'][str(index)], refs):
+                self.log('Step {} had completed: {}'.format(
+                    index + 1, step.describe(refs)), logging.INFO)
+                self.journal.finish_step(index, refs)
+            else:
+                self.log('Step {} had not completed, so rerunning it: {}'.format(
+                    index + 1, step.describe(refs)), logging.INFO)
+        self.execute_plan(plan, journal['lv'], start=journal['next_step'],
+                          refs=refs, completed=journal['completed'])
 
     def log(self, msg, level=logging.DEBUG):
         self.logger_adapter.log(level, msg)
 
-    def run_cmd(self, cmd):
-        # Run the command.
-        output = subprocess.check_output(cmd,
-                                         stderr=subprocess.STDOUT)
-        self.log(output)
-        return output
+    def run_cmd(self, cmd, retry=False, log=None, full_output=False):
+        """Run an external command, returning its output.
+
+        Only the end of the output is kept (see RealBackend.run()), unless
+        full_output is set: callers which parse more than the last few lines
+        must ask for it.  The output is logged (with log, if given) a line at
+        a time as it arrives, up to LOGGED_OUTPUT_LINES lines: the rest of
+        what's kept is only logged if the command fails, or with --trace.  The command is killed if it runs
+        for longer than its timeout (see --timeout) or the command is
+        cancelled.  With retry, failures which look like udev catching up with
+        a change are retried.
+
+        Raises subprocess.CalledProcessError if the command fails.
+
+        """
+        log = log or self.log
+        limit = None if self.tracer.enabled() else LvmRaidExec.LOGGED_OUTPUT_LINES
+        attempts = LvmRaidExec.RETRIES + 1 if retry else 1
+        delay = LvmRaidExec.RETRY_DELAY
+        for attempt in range(attempts):
+            log("Executing '{}'".format(' '.join(cmd)))
+            num_lines = [0]
+
+            def log_line(line):
+                num_lines[0] += 1
+                if limit is None or num_lines[0] <= limit:
+                    log('> ' + line.rstrip('\n'))
 
-    def setup_logging(self):
-        """Configure loggers for the program at start of day."""
-        # The main handler writes DEBUG or higher messages to file.
-        logging.basicConfig(
-            filename='/tmp/lvmraid5.log',
-            filemode='w',
-            format='[%(asctime)s] %(class_name)s(%(instance_name)s) %(message)s',
-            # format='[%(asctime)s] %(message)s',
-            level=logging.DEBUG)
-
-        # Define a Handler which writes INFO messages or higher to stderr.
-        console = logging.StreamHandler()
-        console.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(message)s')
-        console.setFormatter(formatter)
-        logging.getLogger('').addHandler(console)
+            try:
+                output = self.backend.run(
+                    cmd, timeout=self.timeout_for(cmd[0]), cancel=self.cancelled,
+                    on_output=log_line, full_output=full_output)
+                if limit is not None and num_lines[0] > limit:
+                    log('> ({} more lines not logged)'.format(num_lines[0] - limit))
+                return output
+            except subprocess.CalledProcessError as e:
+                if limit is not None:
+                    for line in (e.output or '').splitlines()[limit:]:
+                        log('> ' + line)
+                log("Command failed with exit status {}".format(e.returncode))
+                if (attempt + 1 == attempts or
+                        not LvmRaidExec.transient_error_re.search(e.output or '')):
+                    raise
+            log("Retrying '{}' in {:g}s".format(' '.join(cmd), delay),
+                logging.WARNING)
+            self.sleep(delay)
+            delay *= 2
+
+    def timeout_for(self, binary):
+        """The timeout for a command, in seconds (or None)."""
+        return self.timeouts.get(os.path.basename(binary), self.timeouts[None])
+
+    def sleep(self, seconds):
+        """Sleep, raising LvmRaidCancelled if the command is cancelled."""
+        self.backend.sleep(seconds, cancel=self.cancelled)
+
+    def read_sysfs(self, path):
+        """Read a sysfs attribute, returning None if it doesn't exist."""
+        contents = self.backend.read_file(path)
+        if contents is None:
+            return None
+        return contents.strip()
+
+    def write_sysfs(self, path, value):
+        """Write a sysfs attribute."""
+        self.log("Writing '{}' to {}".format(value, path))
+        self.backend.write_file(path, '{}\n'.format(value))
+
+    def list_sysfs(self, pattern):
+        """List the sysfs paths matching a glob pattern."""
+        return self.backend.glob(pattern)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Attribute the time spent in a block to a phase of the command.
+
+        The phases are discovery, partitioning, md, sync_wait and lvm, and
+        the totals are kept in phase_times.  Phases nest, with time going to
+        the innermost one: eg. refreshing a drive's info part way through
+        creating a partition counts as discovery.  Time in tasks run in
+        parallel is counted for each task.
 
+        """
+        stack = getattr(self.thread_state, 'phases', None)
+        if stack is None:
+            stack = self.thread_state.phases = []
+        span = self.tracer.begin(name, 'phase')
+        now = self.backend.time()
+        if stack:
+            self.add_phase_time(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = self.backend.time()
+            name, start = stack.pop()
+            self.add_phase_time(name, now - start)
+            if stack:
+                stack[-1][1] = now
+            self.tracer.end(span)
+
+    def add_phase_time(self, name, seconds):
+        with self.phase_lock:
+            self.phase_times[name] = self.phase_times.get(name, 0) + seconds
+
+    def setup_logging(self, truncate=True):
+        """Configure loggers for the program at start of day.
+
+        Commands which change things start a new log, so that it describes
+        just the last change made (the logs of earlier changes are kept, see
+        LOG_BACKUP_COUNT).  Read-only commands append to it.
+
+        """
         # Set up a global logger adapter.
+        logger = logging.getLogger(LOGGER_NAME)
         self.logger_adapter = logging.LoggerAdapter(
-            logging.getLogger(''),
-            {'class_name': self.__class__.__name__, 'instance_name': ''})
+            logger, {'class_name': self.__class__.__name__, 'instance_name': ''})
+
+        # Only configure the handlers once per process: the daemon, and the
+        # library API, run many commands.
+        with LvmRaidExec.logging_lock:
+            if logger.handlers:
+                return
+            logger.propagate = False
+
+            # The main handler writes DEBUG or higher messages to file, from a
+            # background thread.  Rather than truncating, the previous log is
+            # rotated out of the way.
+            log_file = logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                delay=True)
+            if truncate and os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > 0:
+                log_file.doRollover()
+            log_file.setFormatter(logging.Formatter(
+                '[%(asctime)s] %(class_name)s(%(instance_name)s) %(message)s'))
+            logger.addHandler(BackgroundLogHandler(log_file))
+            logger.setLevel(logging.DEBUG)
+
+            # Define a Handler which writes INFO messages or higher to stderr.
+            console = logging.StreamHandler()
+            console.setLevel(logging.INFO)
+            formatter = logging.Formatter('%(message)s')
+            console.setFormatter(formatter)
+            logger.addHandler(console)
 
     def check_dependencies(self):
 
@@ -1057,23 +7024,278 @@ You can monitor their status by running "mdadm --detail <array_name>".""".format
         check_dependency(["pvcreate", "--version"])
         check_dependency(["partprobe"])
 
+    def check_dependencies_fast(self):
+        """Check the dependencies of the read-only commands.
+
+        This just looks the binaries up on the PATH, rather than running them.
+
+        """
+        for name, path in self.backend.find_binaries(
+                LvmRaidExec.READ_ONLY_BINARIES).items():
+            check_critical(path is not None, 'Missing dependency: {}'.format(name))
+
     def find_or_create(self, class_name, element_name=None):
         """Find or create an instance of a child class"""
         # If no name is given, call the class method to get one.
         if element_name is None:
-            element_name = class_name.next_free_name()
+            element_name = class_name.next_free_name(self)
+
+        # Find or create the element.  Parallel tasks may both look for the
+        # same object, so only one thread creates objects at a time.
+        with self.objs_lock:
+            if not class_name in self.child_objs:
+                self.child_objs[class_name] = {}
+            if not element_name in self.child_objs[class_name]:
+                self.child_objs[class_name][element_name] = class_name(self, element_name)
+                self.child_objs[class_name][element_name].get_info()
+            return self.child_objs[class_name][element_name]
+
+
+#
+# Library API.  Each function starts a command in the background, returning
+# an Operation to follow and control it.  The commands are run just as from
+# the command line, so take the same options, named with underscores (eg.
+# resize_fs=True for --resize-fs).  Every function also takes:
+#
+# - backend: the system to run against (default: the real one).
+# - on_progress: called with each progress event (see LvmRaidExec.progress()).
+# - journal, history_db, trace: as for --journal, --history-db and --trace.
+# - timeouts: a dictionary of seconds, keyed on command name or None for any
+#   other command (as for --timeout).
+#
+# On the real system, each VG has its own journal (see
+# OperationJournal.path_for()) and mdadm backup file, so that operations on
+# different VGs can run at the same time.
+#
+
+class Operation(object):
+    """A command running in the background, started by the library API.
+
+    Works like a future: result() waits for the command to finish and
+    returns its output, or raises the exception it failed with.  cancel()
+    stops it at its next external command or wait, leaving its journal for
+    resume() if it had changed anything.  Progress events are kept in
+    events, and passed to on_progress from the operation's thread as they
+    happen.
+
+    Operations on different VGs and drives can run at the same time, but one
+    which would use a VG or drive that a running operation is using is
+    refused.  Backends which can't run commands concurrently (ie. the
+    simulator) run one operation at a time.
+
+    """
+    busy = set()  # The VGs and drives used by running operations.
+    busy_lock = threading.Lock()
+    serial_lock = threading.Lock()
+
+    def __init__(self, argv, uses=(), backend=None, on_progress=None):
+        self.argv = argv
+        self.uses = set(uses)
+        self.backend = backend
+        self.on_progress = on_progress
+        self.events = []
+        self.output = []
+        self.status = 'running'
+        self.error = None
+        self.cancelled = threading.Event()
+        self.finished = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        return ' '.join(self.argv)
+
+    def start(self):
+        """Start running the command in its own thread."""
+        with Operation.busy_lock:
+            clash = Operation.busy & self.uses
+            check_critical(not clash, 'Already in use by another operation: {}'.format(
+                ', '.join(sorted(clash))))
+            Operation.busy |= self.uses
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def run(self):
+        serial = self.backend is not None and not self.backend.concurrent
+        try:
+            with Operation.serial_lock if serial else threading.Lock():
+                lvmexec = LvmRaidExec(self.argv, backend=self.backend,
+                                      cancelled=self.cancelled,
+                                      on_progress=self.record, output=self.output)
+            self.status = lvmexec.outcome
+        except BaseException as e:
+            self.error = e
+            self.status = 'cancelled' if isinstance(e, LvmRaidCancelled) else 'failed'
+        finally:
+            with Operation.busy_lock:
+                Operation.busy -= self.uses
+            with self.lock:
+                self.finished.set()
+                callbacks = list(self.callbacks)
+            for callback in callbacks:
+                callback(self)
+
+    def record(self, event):
+        self.events.append(event)
+        if self.on_progress is not None:
+            self.on_progress(event)
+
+    def done(self):
+        return self.finished.is_set()
+
+    def cancel(self):
+        """Stop the operation.  Returns False if it had already finished."""
+        if self.done():
+            return False
+        self.cancelled.set()
+        return True
+
+    def wait(self, timeout=None):
+        """Wait for the operation to finish.
+
+        Raises LvmRaidTimeout if it's still running after timeout seconds.
+
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        # Wait a little at a time, so that signals are still handled.
+        while not self.finished.wait(RealBackend.POLL_INTERVAL):
+            if deadline is not None and time.time() > deadline:
+                raise LvmRaidTimeout('Still running: {}'.format(self))
+
+    def result(self, timeout=None):
+        """The command's output, once it has finished."""
+        self.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return '\n'.join(self.output)
+
+    def exception(self, timeout=None):
+        """The exception the command failed with, or None."""
+        self.wait(timeout)
+        return self.error
 
-        # Find or create the element.
-        if not class_name in self.child_objs:
-            self.child_objs[class_name] = {}
-        if not element_name in self.child_objs[class_name]:
-            self.child_objs[class_name][element_name] = class_name(self, element_name)
-            self.child_objs[class_name][element_name].get_info()
-        return self.child_objs[class_name][element_name]
+    def add_done_callback(self, callback):
+        """Call callback with the operation once it has finished."""
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+
+API_SETTINGS = ('journal', 'history_db', 'mdadm_conf', 'trace', 'timeouts')
+
+
+def start_operation(command, positional, options, vg_name=None, drives=(),
+                    backend=None, on_progress=None, **settings):
+    """Start a command for the library API, returning its Operation.
+
+    vg_name and drives are what the command uses, so that it isn't run at
+    the same time as another operation using them.
+
+    """
+    unknown = set(settings) - set(API_SETTINGS)
+    if unknown:
+        raise TypeError('Unexpected arguments: {}'.format(', '.join(sorted(unknown))))
+    uses = list(drives)
+    if vg_name is not None:
+        if not vg_name.startswith('/dev/'):
+            vg_name = '/dev/' + vg_name
+        uses.append(vg_name)
+        if backend is None or isinstance(TracingBackend.unwrap(backend),
+                                         RealBackend):
+            settings.setdefault('journal', OperationJournal.path_for(vg_name))
+            if 'mdadm_backup_file' in options:
+                options['mdadm_backup_file'] = (
+                    options['mdadm_backup_file'] or
+                    '/tmp/lvmraid5_mdadm_backup_file-{}.txt'.format(
+                        os.path.basename(vg_name)))
+
+    def flags(items):
+        argv = []
+        for name, value in sorted(items):
+            if value is None or value is False:
+                continue
+            flag = '--' + name.replace('_', '-')
+            argv += [flag] if value is True else [flag, str(value)]
+        return argv
+
+    timeouts = settings.pop('timeouts', None) or {}
+    argv = flags(settings.items())
+    for name, seconds in sorted(timeouts.items(), key=lambda item: item[0] or ''):
+        argv += ['--timeout', '{}={}'.format(name, seconds) if name else str(seconds)]
+    argv += [command] + flags(options.items()) + list(positional)
+    return Operation(argv, uses=uses, backend=backend,
+                     on_progress=on_progress).start()
+
+
+def lv_vg_name(lv):
+    """The VG of an LV, eg. /dev/vg for /dev/vg/lvol0."""
+    return os.path.dirname(lv if lv.startswith('/dev/') else '/dev/' + lv)
+
+
+def create(vg_name, drives, chunk=None, tune=None, **settings):
+    """Create a VG, with an LV filling it, from drives."""
+    return start_operation('create', ['--vg_name', vg_name] + list(drives),
+                           {'chunk': chunk, 'tune': tune},
+                           vg_name=vg_name, drives=drives, **settings)
+
+
+def add(lv, drive, mdadm_backup_file=None, probe=False, max_slowdown=None,
+        slow_drive=None, window=None, detach=False, resize_fs=False,
+        fs_geometry=None, tune=None, **settings):
+    """Add a drive to an LV, growing it if the drive allows."""
+    return start_operation('add', [lv, drive],
+                           {'mdadm_backup_file': mdadm_backup_file, 'probe': probe,
+                            'max_slowdown': max_slowdown, 'slow_drive': slow_drive,
+                            'window': window, 'detach': detach,
+                            'resize_fs': resize_fs, 'fs_geometry': fs_geometry,
+                            'tune': tune},
+                           vg_name=lv_vg_name(lv), drives=[drive], **settings)
+
+
+def replace(lv, drive, mdadm_backup_file=None, probe=False, max_slowdown=None,
+            slow_drive=None, window=None, detach=False, resize_fs=False,
+            fs_geometry=None, tune=None, **settings):
+    """Replace a failed or removed drive of an LV with a new one."""
+    return start_operation('replace', [lv, drive],
+                           {'mdadm_backup_file': mdadm_backup_file, 'probe': probe,
+                            'max_slowdown': max_slowdown, 'slow_drive': slow_drive,
+                            'window': window, 'detach': detach,
+                            'resize_fs': resize_fs, 'fs_geometry': fs_geometry,
+                            'tune': tune},
+                           vg_name=lv_vg_name(lv), drives=[drive], **settings)
+
+
+def remove(lv, drive, **settings):
+    """Remove a drive from an LV, leaving its arrays degraded."""
+    return start_operation('remove', [lv, drive], {},
+                           vg_name=lv_vg_name(lv), drives=[drive], **settings)
+
+
+def resume(vg_name, window=None, detach=False, **settings):
+    """Finish an interrupted or detached operation on a VG."""
+    return start_operation('resume', [], {'window': window, 'detach': detach},
+                           vg_name=vg_name, **settings)
+
+
+def examine(lv, **settings):
+    """Describe an LV and everything beneath it."""
+    return start_operation('examine', [lv], {}, **settings)
 
 
 if __name__ == "__main__":
+    argv = sys.argv[1:]
+    # Installed (or symlinked) as lvmraid5d, run as the daemon.
+    if os.path.basename(sys.argv[0]) == 'lvmraid5d':
+        argv.append('daemon')
+    # Stop cleanly on SIGTERM: the running command is terminated, and the
+    # journal left for the resume command.
+    cancelled = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: cancelled.set())
     try:
-        LvmRaidExec(sys.argv[1:])
+        LvmRaidExec(argv, cancelled=cancelled)
     except LvmRaidException:
         exit(1)
@@ -0,0 +1,327 @@
+#!/usr/bin/python
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+lvmraid5_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, lvmraid5_dir)
+
+# Benchmarks for lvmraid5.  Unlike the tests, the startup benchmark doesn't
+# touch any drives, so can be run anywhere the dependencies are installed.
+#
+# The operations benchmark runs create, add, remove and replace against loop
+# devices backed by sparse files, so it needs root but no spare drives.  It
+# can also be run against the simulator (--simulate), which gives modelled
+# rather than measured times but is handy for checking the benchmark itself.
+#
+# The layout benchmark only does arithmetic, so can also be run anywhere.
+
+startup_target = 0.1  # Seconds.
+
+# Run in a fresh interpreter, so that this measures a real cold start: import,
+# argument parsing, logging setup and dependency checks, up to the point where
+# the examine command would begin.  The examine command itself is replaced by
+# a no-op, so the figure doesn't include its discovery (fdisk and mdadm
+# --examine of each drive), which depends on the drives attached.
+startup_script = """
+import sys
+sys.path.insert(0, %r)
+import lvmraid5
+def examine(self):
+    pass
+lvmraid5.LvmRaidExec.examine = examine
+lvmraid5.LvmRaidExec(['examine', 'benchmark_vg/lvol0'])
+"""
+
+
+def time_cmd(cmd):
+    """Run a command, returning its wall time in seconds."""
+    start = time.time()
+    subprocess.check_call(cmd)
+    return time.time() - start
+
+
+def benchmark_startup(args):
+    """Time the start-up path for read-only commands."""
+    cmd = [sys.executable, '-c', startup_script % lvmraid5_dir]
+    # The first run populates the binary cache.
+    time_cmd(cmd)
+    times = sorted(time_cmd(cmd) for _ in range(args.iterations))
+    median = times[len(times) // 2]
+    print("Read-only startup: min {:.1f} ms, median {:.1f} ms (target {:.0f} ms)"
+          .format(times[0] * 1000, median * 1000, startup_target * 1000))
+    print("(Up to the start of the command: excludes examine's own discovery.)")
+    if median > startup_target:
+        print("FAILED: startup is slower than target")
+        return 1
+    return 0
+
+
+# The phases each operation's time is split into (see LvmRaidExec.phase()).
+# Time not in any phase (eg. planning) is reported as "other".
+phases = ['discovery', 'partitioning', 'md', 'sync_wait', 'lvm']
+
+bench_vg_name = '/dev/lvmraid5_bench_vg'
+bench_lv_name = bench_vg_name + '/lvol0'
+
+# The operations run, in order, as (operation, indices of the drives used)
+# where the drives are sorted by size.  This mirrors the regression tests:
+# create from mixed sizes, add a larger drive, remove the smallest and replace
+# it with a larger one.
+operations_scenario = [('create', [0, 2, 3]),
+                       ('add', [4]),
+                       ('remove', [0]),
+                       ('replace', [5])]
+
+
+def create_loop_devices(sizes, directory):
+    """Create a loop device backed by a sparse file of each size.
+
+    Returns a list of (device name, backing file).
+
+    """
+    devices = []
+    try:
+        for ii, size in enumerate(sizes):
+            path = os.path.join(directory, 'lvmraid5_bench{}.img'.format(ii))
+            with open(path, 'w') as f:
+                f.truncate(size)
+            name = subprocess.check_output(
+                ['losetup', '--find', '--show', '--partscan', path]).strip()
+            devices.append((name, path))
+    except:
+        destroy_loop_devices(devices)
+        raise
+    return devices
+
+
+def destroy_loop_devices(devices):
+    """Tear down the benchmark VG and arrays, then the loop devices."""
+    def run(cmd):
+        try:
+            return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            return ''
+
+    arrays = run(['vgs', '--noheadings', '-o', 'pv_name', bench_vg_name]).split()
+    run(['lvremove', '--force', bench_lv_name])
+    run(['vgremove', '--force', bench_vg_name])
+    for array in arrays:
+        run(['pvremove', '--force', array])
+        run(['mdadm', '--stop', array])
+    for name, path in devices:
+        run(['losetup', '--detach', name])
+        os.unlink(path)
+
+
+def run_operations(backend, drive_names):
+    """Run the operations scenario, returning the timings of each operation."""
+    from lvmraid5 import LvmRaidExec
+
+    results = []
+    for operation, indices in operations_scenario:
+        args = [operation]
+        if operation == 'create':
+            args += ['--vg_name', bench_vg_name]
+        else:
+            args += [bench_lv_name]
+        args += [drive_names[ii] for ii in indices]
+
+        start = backend.time()
+        lvmexec = LvmRaidExec(args, backend=backend)
+        total = backend.time() - start
+
+        times = dict((phase, lvmexec.phase_times.get(phase, 0)) for phase in phases)
+        times['other'] = max(0, total - sum(times.values()))
+        cache = lvmexec.query_cache
+        results.append({'operation': operation,
+                        'args': args,
+                        'total': total,
+                        'phases': times,
+                        'queries': {'hits': cache.hits,
+                                    'misses': cache.misses,
+                                    'spawns_avoided': cache.spawns_avoided}})
+    return results
+
+
+def git_version():
+    """Describe the version of lvmraid5 being benchmarked."""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=lvmraid5_dir,
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_operations(results, baseline=None):
+    """Print a table of timings, with changes against a baseline if given."""
+    baseline_ops = {}
+    if baseline is not None:
+        print("Compared with {} ({})".format(baseline['version'],
+                                             time.ctime(baseline['time'])))
+        baseline_ops = dict((result['operation'], result)
+                            for result in baseline['operations'])
+
+    columns = phases + ['other', 'total']
+    print('{:<10}'.format('operation') +
+          ''.join('{:>14}'.format(column) for column in columns))
+    for result in results:
+        times = dict(result['phases'], total=result['total'])
+        old = baseline_ops.get(result['operation'])
+        row = '{:<10}'.format(result['operation'])
+        for column in columns:
+            cell = '{:.2f}s'.format(times[column])
+            if old is not None:
+                old_time = dict(old['phases'], total=old['total'])[column]
+                if old_time > 0:
+                    cell += ' {:+.0f}%'.format((times[column] - old_time) * 100 / old_time)
+            row += '{:>14}'.format(cell)
+        print(row)
+    # Results saved before the query cache have no counts.
+    for result in results:
+        if 'queries' in result:
+            print('{:<10}query cache: {hits} hits, {misses} misses, '
+                  '{spawns_avoided} process spawns avoided'.format(
+                      result['operation'], **result['queries']))
+
+
+def benchmark_operations(args):
+    """Time each operation end to end, split into phases."""
+    from lvmraid5 import RealBackend, SimulatedBackend, parse_size
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    if None in sizes:
+        print("Invalid sizes: {}".format(args.sizes))
+        return 1
+    if len(sizes) <= max(max(indices) for _, indices in operations_scenario):
+        print("Need at least {} drives".format(
+            max(max(indices) for _, indices in operations_scenario) + 1))
+        return 1
+    sizes.sort()
+
+    if args.simulate:
+        backend = SimulatedBackend(sizes)
+        results = run_operations(backend, ['/dev/sd' + chr(ord('b') + ii)
+                                           for ii in range(len(sizes))])
+    else:
+        devices = create_loop_devices(sizes, args.dir)
+        try:
+            results = run_operations(RealBackend(),
+                                     [name for name, _ in devices])
+        finally:
+            destroy_loop_devices(devices)
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_operations(results, baseline)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'version': git_version(),
+                       'time': time.time(),
+                       'simulated': args.simulate,
+                       'sizes': sizes,
+                       'operations': results},
+                      f, indent=2, sort_keys=True)
+    return 0
+
+
+# The layout benchmark lays out shelves of drives of these sizes (TB) picked
+# at random, as a shelf accumulates drives over the years: half are used to
+# create the LV, and the rest are added.
+layout_sizes = [1, 2, 3, 4, 6, 8, 10, 12, 14, 16, 18, 20]
+layout_target = 1.0  # Seconds, for each shelf.
+
+
+def benchmark_layout(args):
+    """Time the layout engine on growing numbers of drives."""
+    from lvmraid5 import compute_layout
+
+    rng = random.Random(args.seed)
+    print('{:>8}{:>8}{:>12}{:>14}{:>10}'.format(
+        'drives', 'tiers', 'time', 'capacity', 'of bound'))
+    failed = False
+    for num_drives in [int(num) for num in args.drives.split(',')]:
+        sizes = [rng.choice(layout_sizes) * 1000 ** 4 for _ in range(num_drives)]
+        drives = [{'name': 'drive{}'.format(ii), 'free': size}
+                  for ii, size in enumerate(sizes)]
+        half = num_drives // 2
+
+        start = time.time()
+        created = compute_layout([], drives[:half])
+        tiers = [dict(tier, clean=True) for tier in created['new_tiers']]
+        added = compute_layout(tiers, drives[half:] +
+                               [{'name': name, 'free': free}
+                                for name, free in created['leftover'].items()
+                                if free > 0])
+        elapsed = time.time() - start
+
+        # No layout can use more than all but the largest drive.
+        capacity = created['capacity'] + added['capacity']
+        bound = sum(sizes) - max(sizes)
+        print('{:>8}{:>8}{:>10.1f}ms{:>11.0f} TB{:>9.1f}%'.format(
+            num_drives, len(tiers) + len(added['new_tiers']), elapsed * 1000,
+            capacity / 1e12, capacity * 100.0 / bound))
+        failed = failed or elapsed > layout_target
+    if failed:
+        print('FAILED: layout is slower than target ({:.0f} ms)'.format(
+            layout_target * 1000))
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for lvmraid5.')
+    subparsers = parser.add_subparsers()
+
+    startup_parser = subparsers.add_parser(
+        'startup', help='Time the start-up path of read-only commands.')
+    startup_parser.add_argument('--iterations', type=int, default=20)
+    startup_parser.set_defaults(func=benchmark_startup)
+
+    operations_parser = subparsers.add_parser(
+        'operations',
+        help="""Time create, add, remove and replace on loop devices, split
+        into phases.  Needs root.""")
+    operations_parser.add_argument(
+        '--sizes',
+        default='256M,256M,512M,512M,1G,1G',
+        help="""Comma-separated sizes of the loop devices to create (at least
+        six).  The backing files are sparse.""")
+    operations_parser.add_argument(
+        '--dir', default='/var/tmp',
+        help='Directory for the backing files.')
+    operations_parser.add_argument(
+        '--output', help='Save the results to this JSON file.')
+    operations_parser.add_argument(
+        '--compare', help='Compare against results saved with --output.')
+    operations_parser.add_argument(
+        '--simulate', action='store_true',
+        help='Run against the simulator rather than loop devices.')
+    operations_parser.set_defaults(func=benchmark_operations)
+
+    layout_parser = subparsers.add_parser(
+        'layout',
+        help='Time the layout engine on shelves of up to hundreds of drives.')
+    layout_parser.add_argument(
+        '--drives', default='10,25,50,100,200,400',
+        help='Comma-separated numbers of drives to lay out.')
+    layout_parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed for picking the drive sizes.')
+    layout_parser.set_defaults(func=benchmark_layout)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,21 @@
 #!/usr/bin/python
 
+import argparse
+import json
+import logging
 import os
+import shutil
+import socket
 import sys
+import tempfile
+import threading
+import time
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-from lvmraid5 import HardDrive, LvmRaidExec, LvmRaidException
+from lvmraid5 import BackgroundLogHandler, HardDrive, LvmRaidExec, LvmRaidException
+from lvmraid5 import SimulatedBackend, best_subset_sum, compute_layout
+from lvmraid5 import LvmRaidCancelled, LvmRaidTimeout, OperationHistory, RealBackend
+from lvmraid5 import MaintenanceWindow, MdadmConfig, QueryCache, RaidArray, Scrubber, StackTuner
+import lvmraid5
 import pexpect
 import subprocess
 import unittest
@@ -27,7 +39,7 @@ drive_names = ['/dev/sdf',
                '/dev/sdk',
                '/dev/sde',
                '/dev/sdi']
-num_arrays = 3 # The maximum number of arrays created by any one test.
+num_arrays = 4 # The maximum number of arrays created by any one test.
 vg_name = '/dev/jjl_vg1'
 lv_name = '/dev/jjl_vg1/lvol0'
 
@@ -275,5 +287,1199 @@ class LvmRaid5Test3(LvmRaid5Test):
                      drive_names[6]])
 
 
+# The simulation tests run the same scenarios against SimulatedBackend, so
+# need neither root nor a virtual machine.  The simulated drives match the
+# sizes of the virtual machine's drives (see vagrant/Vagrantfile), and are
+# named in increasing size order.
+sim_drive_sizes = [size * 1024 * 1024 for size in
+                   (160, 160, 320, 320, 750, 750, 1500, 1500, 2000, 2000)]
+sim_drive_names = ['/dev/sd' + chr(ord('b') + ii)
+                   for ii in range(len(sim_drive_sizes))]
+
+class LvmRaid5SimTest(unittest.TestCase):
+    """Parent class for tests against a simulation of the drives."""
+
+    def setUp(self):
+        self.backend = SimulatedBackend(sim_drive_sizes)
+
+    def run_lvmraid5(self, args):
+        return LvmRaidExec(args, backend=self.backend)
+
+    def lv_size(self):
+        return self.backend.state['lvs'][lv_name[len('/dev/'):]]['extents']
+
+    def array_states(self):
+        return dict((name, self.backend.array_state(array))
+                    for name, array in self.backend.state['arrays'].items())
+
+    def create(self, drives):
+        self.run_lvmraid5(['create', '--vg_name', vg_name] + drives)
+        self.assertIn(lv_name[len('/dev/'):], self.backend.state['lvs'])
+
+
+class LvmRaid5SimTest1(LvmRaid5SimTest):
+
+    def test(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        size = self.lv_size()
+
+        # Each add grows the LV, and leaves every array clean.
+        for drive in sim_drive_names[6:8]:
+            self.run_lvmraid5(['add', lv_name, drive])
+            self.assertGreater(self.lv_size(), size)
+            size = self.lv_size()
+
+        self.backend.sleep(3600)
+        self.assertEqual(set(self.array_states().values()), set(['clean']))
+
+
+class LvmRaid5SimTest2(LvmRaid5SimTest):
+
+    def test(self):
+        self.create(sim_drive_names[0:1] + sim_drive_names[2:4])
+        size = self.lv_size()
+
+        self.run_lvmraid5(['remove', lv_name, sim_drive_names[0]])
+        self.assertIn('clean, degraded', self.array_states().values())
+
+        self.run_lvmraid5(['replace', lv_name, sim_drive_names[4]])
+        self.assertEqual(set(self.array_states().values()), set(['clean']))
+        self.assertGreaterEqual(self.lv_size(), size)
+
+
+class LvmRaid5SimTest3(LvmRaid5SimTest):
+    """Failure cases for remove/replace, as in LvmRaid5Test3."""
+
+    def test(self):
+        self.create([sim_drive_names[0], sim_drive_names[4], sim_drive_names[8]])
+
+        with self.assertRaises(LvmRaidException):
+            self.run_lvmraid5(['replace', lv_name, sim_drive_names[3]])
+
+        self.run_lvmraid5(['remove', lv_name, sim_drive_names[4]])
+
+        with self.assertRaises(LvmRaidException):
+            self.run_lvmraid5(['remove', lv_name, sim_drive_names[0]])
+
+        with self.assertRaises(LvmRaidException):
+            self.run_lvmraid5(['replace', lv_name, sim_drive_names[1]])
+
+        self.run_lvmraid5(['replace', lv_name, sim_drive_names[6]])
+
+
+class LvmRaid5SimRemoveTest(LvmRaid5SimTest):
+    """remove only waits for the arrays with a member on the drive."""
+
+    def test(self):
+        # Slow syncs down, so that the large array is still resyncing when
+        # the small one finishes.
+        self.backend.state['rate'] //= 10
+        self.create([sim_drive_names[0], sim_drive_names[6], sim_drive_names[7]])
+        self.run_lvmraid5(['remove', lv_name, sim_drive_names[0]])
+        self.assertEqual(self.array_states(),
+                         {'/dev/md0': 'clean, degraded',
+                          '/dev/md1': 'clean, resyncing'})
+
+
+class LvmRaid5SimPlanTest(LvmRaid5SimTest):
+    """Plans and status reports don't change anything."""
+
+    def test(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.backend.sleep(3600)
+        before = repr(self.backend.state['arrays'])
+
+        self.run_lvmraid5(['plan', 'add', lv_name, sim_drive_names[6]])
+        self.run_lvmraid5(['plan', 'add', lv_name, '2TB'])
+        self.run_lvmraid5(['status', '--json', lv_name])
+        self.assertEqual(repr(self.backend.state['arrays']), before)
+
+    def test_descriptions(self):
+        # Steps are described with the partitions and arrays they made, once
+        # they exist, rather than the plan's references to them.
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.backend.sleep(3600)
+        events = []
+        LvmRaidExec(['add', lv_name, sim_drive_names[6]], backend=self.backend,
+                    on_progress=events.append)
+        messages = [event['message'] for event in events if event['step'] is not None]
+        self.assertIn('Add {}5 to /dev/md0'.format(sim_drive_names[6]), messages)
+        for message in messages:
+            if message.startswith('Create'):
+                continue
+            self.assertNotRegexpMatches(message, r'\b(partition|array)[0-9]+\b')
+
+    def test_prometheus(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.backend.sleep(3600)
+        textfile = tempfile.NamedTemporaryFile(suffix='.prom')
+        self.run_lvmraid5(['status', '--textfile', textfile.name, lv_name])
+        lines = open(textfile.name).read().splitlines()
+
+        # Changes of state flip the value of a fixed set of series.
+        states = [line for line in lines
+                  if line.startswith('lvmraid5_array_state{array="/dev/md0"')]
+        self.assertEqual(len(states), len(lvmraid5.StatusReport.ARRAY_STATES))
+        self.assertIn('lvmraid5_array_state{array="/dev/md0",state="clean"} 1',
+                      states)
+        self.assertEqual(len([line for line in states if line.endswith(' 1')]), 1)
+        for line in lines:
+            if line.startswith('lvmraid5_member_healthy{'):
+                self.assertNotIn('state=', line)
+
+        report = lvmraid5.StatusReport(None, 'odd')
+        report.lv = {'name': 'a"b\\c\nd', 'size': 1}
+        report.vg = {'name': 'vg', 'size': 1, 'free': 0}
+        self.assertIn('lvmraid5_lv_size_bytes{lv="a\\"b\\\\c\\nd",vg="vg"} 1',
+                      report.to_prometheus())
+
+
+class LvmRaid5SimDaemonTest(LvmRaid5SimTest):
+    """The daemon answers reads from its cache, and queues everything else."""
+
+    def setUp(self):
+        super(LvmRaid5SimDaemonTest, self).setUp()
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.lvmexec = self.run_lvmraid5(['status', lv_name])
+        self.daemon = lvmraid5.LvmRaidDaemon(self.lvmexec, '/tmp/lvmraid5_test.sock')
+        self.lvmexec.service = self.daemon
+
+    def test_read(self):
+        reply = self.daemon.handle_request(['status', lv_name])
+        self.assertEqual(reply['status'], 'ok')
+        self.assertIn('/dev/md0', reply['output'])
+
+        # Cached objects are kept until something changes, then rebuilt.
+        array = self.lvmexec.find_or_create(RaidArray, '/dev/md0')
+        self.daemon.handle_request(['status', lv_name])
+        self.assertIs(self.lvmexec.find_or_create(RaidArray, '/dev/md0'), array)
+        self.daemon.stale.set()
+        self.daemon.handle_request(['status', lv_name])
+        self.assertFalse(self.daemon.stale.is_set())
+        self.assertIsNot(self.lvmexec.find_or_create(RaidArray, '/dev/md0'), array)
+
+    def test_uevent(self):
+        # Only the objects for the device which changed are discarded, along
+        # with those describing it.
+        class Uevents(object):
+            def recv(self, size):
+                return '\0'.join(['change@/devices/virtual/block/md1', 'ACTION=change',
+                                  'DEVPATH=/devices/virtual/block/md1',
+                                  'SUBSYSTEM=block', 'DEVNAME=md1', ''])
+        self.daemon.handle_request(['status', lv_name])
+        md0 = self.lvmexec.find_or_create(RaidArray, '/dev/md0')
+        md1 = self.lvmexec.find_or_create(RaidArray, '/dev/md1')
+        self.daemon.handle_uevent(Uevents())
+        self.daemon.handle_request(['status', lv_name])
+        self.assertIs(self.lvmexec.find_or_create(RaidArray, '/dev/md0'), md0)
+        self.assertIsNot(self.lvmexec.find_or_create(RaidArray, '/dev/md1'), md1)
+
+        # Likewise for arrays whose state changes in sysfs: here both finish
+        # their initial syncs.
+        self.daemon.check_md_sysfs()
+        self.daemon.handle_request(['status', lv_name])
+        self.assertEqual(self.daemon.changed, set())
+        self.backend.sleep(3600)
+        self.daemon.md_checked = 0
+        self.daemon.check_md_sysfs()
+        self.assertEqual(self.daemon.changed, set(['/dev/md0', '/dev/md1']))
+
+    def test_refused(self):
+        for argv in (['watch', lv_name], ['--prompt', 'add', lv_name, sim_drive_names[6]],
+                     ['add', '--no_such_option']):
+            self.assertEqual(self.daemon.handle_request(argv)['status'], 'error')
+        self.assertEqual(self.daemon.jobs, [])
+
+        # Without a daemon, the job commands fail before doing anything.
+        for argv in (['jobs'], ['cancel', '1']):
+            with self.assertRaises(LvmRaidException):
+                self.run_lvmraid5(argv)
+
+    def test_queue(self):
+        self.assertEqual(self.daemon.handle_request(['add', lv_name, sim_drive_names[6]]),
+                         {'status': 'queued', 'job': 1})
+        self.assertEqual(self.daemon.handle_request(['add', lv_name, sim_drive_names[7]]),
+                         {'status': 'queued', 'job': 2})
+        reply = self.daemon.handle_request(['cancel', '2'])
+        self.assertEqual(reply['status'], 'ok')
+        self.assertEqual(self.daemon.handle_request(['cancel', '2'])['status'], 'error')
+        self.assertEqual(self.daemon.handle_request(['cancel', '3'])['status'], 'error')
+        self.assertIn("1 queued 'add", self.daemon.handle_request(['jobs'])['output'])
+
+        # The worker runs the remaining job, and the cache is then stale.
+        size = self.lv_size()
+        worker = threading.Thread(target=self.daemon.run_jobs)
+        worker.daemon = True
+        worker.start()
+        while self.daemon.jobs[0]['state'] in ('queued', 'running'):
+            time.sleep(0.01)
+        self.assertEqual([job['state'] for job in self.daemon.jobs], ['done', 'cancelled'])
+        self.assertGreater(self.lv_size(), size)
+        self.assertTrue(self.daemon.stale.is_set())
+
+    def test_stop_jobs(self):
+        self.daemon.handle_request(['add', lv_name, sim_drive_names[6]])
+        self.daemon.stop_jobs()
+        self.assertEqual(self.daemon.jobs[0]['state'], 'cancelled')
+        self.assertTrue(self.daemon.jobs[0]['cancelled'].is_set())
+
+    def test_slow_client(self):
+        # A client which never finishes its request gets an error, rather than
+        # holding up the daemon.
+        server, client = socket.socketpair()
+        timeout = lvmraid5.LvmRaidDaemon.CLIENT_TIMEOUT
+        lvmraid5.LvmRaidDaemon.CLIENT_TIMEOUT = 0.1
+        try:
+            client.sendall('{"argv": ["status"')
+            self.daemon.handle_client(server)
+        finally:
+            lvmraid5.LvmRaidDaemon.CLIENT_TIMEOUT = timeout
+        self.assertEqual(json.loads(client.makefile().readline()),
+                         {'status': 'error', 'message': 'Malformed request.'})
+
+
+class LvmRaid5SimTraceTest(LvmRaid5SimTest):
+    """--trace records each command, fdisk session, phase and wait."""
+
+    def test(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        trace_file = tempfile.NamedTemporaryFile(suffix='.json')
+        self.run_lvmraid5(['--trace', trace_file.name,
+                           'add', lv_name, sim_drive_names[6]])
+
+        events = json.load(open(trace_file.name))['traceEvents']
+        categories = set(event['cat'] for event in events)
+        self.assertEqual(categories, set(['command', 'phase', 'cmd', 'pexpect',
+                                          'wait', 'sleep']))
+        command = [event for event in events if event['cat'] == 'command'][0]
+        for event in events:
+            self.assertGreaterEqual(event['ts'], command['ts'])
+            self.assertLessEqual(event['ts'] + event['dur'],
+                                 command['ts'] + command['dur'])
+
+
+class LvmRaid5SimHistoryTest(LvmRaid5SimTest):
+    """Syncs are recorded in the history, and slowdowns flagged."""
+
+    def test(self):
+        history_file = tempfile.NamedTemporaryFile(suffix='.db')
+        history_args = ['--history-db', history_file.name]
+        self.run_lvmraid5(history_args + ['create', '--vg_name', vg_name,
+                                          sim_drive_names[0], sim_drive_names[2],
+                                          sim_drive_names[4]])
+        self.run_lvmraid5(history_args + ['add', lv_name, sim_drive_names[6]])
+        self.backend.state['rate'] //= 2
+        self.run_lvmraid5(history_args + ['add', lv_name, sim_drive_names[7]])
+
+        history = OperationHistory(None, history_file.name)
+        speeds = [sync['speed'] for sync in history.syncs()]
+        # Speeds are read from sysfs in KiB/s, so aren't exact.
+        rate = SimulatedBackend.DEFAULT_RATE
+        self.assertAlmostEqual(speeds[0], rate, delta=1024)
+        self.assertAlmostEqual(speeds[-1], rate / 2, delta=1024)
+        self.assertAlmostEqual(history.typical_speed(), rate / 2, delta=1024)
+        regressed = [trend['drive'] for trend in history.drive_trends(0.2)
+                     if trend['regressed']]
+        self.assertIn(sim_drive_names[2], regressed)
+        self.run_lvmraid5(history_args + ['history'])
+
+
+class CrashingBackend(object):
+    """Wraps a simulation, dying just after a given command has run."""
+
+    def __init__(self, backend, crash_after):
+        self.backend = backend
+        self.crash_after = crash_after
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def run(self, cmd, **kwargs):
+        output = self.backend.run(cmd, **kwargs)
+        if all(arg in cmd for arg in self.crash_after):
+            raise KeyboardInterrupt()
+        return output
+
+
+class LvmRaid5SimResumeTest(LvmRaid5SimTest):
+    """Interrupted commands are finished by resume, without redoing steps."""
+
+    def setUp(self):
+        super(LvmRaid5SimResumeTest, self).setUp()
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        self.journal = os.path.join(journal_dir, 'journal.json')
+        self.journal_args = ['--journal', self.journal]
+        self.commands = []
+        run = self.backend.run
+        self.backend.run = lambda cmd, **kwargs: (self.commands.append(cmd) or
+                                                  run(cmd, **kwargs))
+
+    def interrupt(self, args, crash_after):
+        with self.assertRaises(KeyboardInterrupt):
+            LvmRaidExec(self.journal_args + args,
+                        backend=CrashingBackend(self.backend, crash_after))
+        self.assertTrue(os.path.exists(self.journal))
+
+    def resume(self):
+        self.run_lvmraid5(self.journal_args + ['resume'])
+        self.assertFalse(os.path.exists(self.journal))
+
+    def count(self, *args):
+        return len([cmd for cmd in self.commands
+                    if all(arg in cmd for arg in args)])
+
+    def test_create(self):
+        self.interrupt(['create', '--vg_name', vg_name, sim_drive_names[0],
+                        sim_drive_names[2], sim_drive_names[4]],
+                       ['--create', '/dev/md1'])
+        self.resume()
+        self.assertEqual(self.count('--create', '/dev/md1'), 1)
+        self.assertEqual(self.count('mdadm', '--create'), 2)
+        self.assertIn(lv_name[len('/dev/'):], self.backend.state['lvs'])
+
+    def test_add(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        size = self.lv_size()
+        self.interrupt(['add', lv_name, sim_drive_names[6]], ['--grow'])
+
+        # Nothing else can be started until the interrupted add is finished.
+        with self.assertRaises(LvmRaidException):
+            self.run_lvmraid5(self.journal_args + ['add', lv_name,
+                                                   sim_drive_names[7]])
+
+        self.resume()
+        # Each array was reshaped once, the mirror after converting to RAID5.
+        self.assertEqual(self.count('--grow', '/dev/md0'), 1)
+        self.assertEqual(self.count('--grow', '/dev/md1', '--level=5'), 1)
+        self.assertEqual(self.count('--grow', '/dev/md1'), 2)
+        self.assertGreater(self.lv_size(), size)
+        # The new array from the space left over resyncs in the background.
+        self.backend.sleep(3600)
+        self.assertEqual(set(self.array_states().values()), set(['clean']))
+
+    def test_nothing_to_resume(self):
+        with self.assertRaises(LvmRaidException):
+            self.run_lvmraid5(self.journal_args + ['resume'])
+
+
+class LvmRaid5SimWindowTest(LvmRaid5SimTest):
+    """Reshapes only run in the maintenance window, and can be left to it."""
+
+    def setUp(self):
+        super(LvmRaid5SimWindowTest, self).setUp()
+        journal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, journal_dir)
+        self.journal = os.path.join(journal_dir, 'journal.json')
+        self.journal_args = ['--journal', self.journal]
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.backend.sleep(3600)
+        # A window opening in an hour (of simulated local time), for an hour.
+        opens = time.localtime(self.backend.time() + 3600)
+        self.window = '{0:02}:{1:02}-{2:02}:{1:02}'.format(
+            opens.tm_hour, opens.tm_min, (opens.tm_hour + 1) % 24)
+        self.opens = self.backend.time() + 3600 - opens.tm_sec
+
+    def reshapes(self):
+        return [array['op'] for array in self.backend.state['arrays'].values()
+                if array['op'] is not None and array['op']['action'] == 'reshape']
+
+    def test_parse(self):
+        window = MaintenanceWindow.parse('22:00-06:00,12:30-13:00')
+        self.assertEqual(str(window), '22:00-06:00,12:30-13:00')
+        at = lambda hour, minute: time.mktime((2020, 1, 1, hour, minute, 0, 0, 0, -1))
+        self.assertTrue(window.contains(at(23, 0)))
+        self.assertTrue(window.contains(at(5, 59)))
+        self.assertFalse(window.contains(at(6, 0)))
+        self.assertEqual(window.until_change(at(12, 0)), 30 * 60)
+        for text in ('22:00', '25:00-06:00', '06:00-06:00'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                MaintenanceWindow.parse(text)
+
+    def test_wait(self):
+        size = self.lv_size()
+        self.run_lvmraid5(['add', '--window', self.window, lv_name,
+                           sim_drive_names[6]])
+        self.assertGreater(self.lv_size(), size)
+        self.assertGreaterEqual(self.backend.time(), self.opens)
+
+    def test_detach(self):
+        size = self.lv_size()
+        self.run_lvmraid5(self.journal_args + ['add', '--window', self.window,
+                                               '--detach', lv_name,
+                                               sim_drive_names[6]])
+        self.assertTrue(os.path.exists(self.journal))
+        self.assertTrue(all(op['frozen'] for op in self.reshapes()))
+        self.assertEqual(self.lv_size(), size)
+
+        # Resuming (say, from cron) every half hour lets the reshapes run in
+        # the window, and pauses them outside it, until the add is finished.
+        window = MaintenanceWindow.parse(self.window)
+        for _ in range(48):
+            if not os.path.exists(self.journal):
+                break
+            self.backend.sleep(1800)
+            self.run_lvmraid5(self.journal_args + ['resume'])
+            for op in self.reshapes():
+                self.assertEqual(op.get('frozen', False), not window.contains(self.backend.time()))
+        self.assertFalse(os.path.exists(self.journal))
+        self.assertGreater(self.lv_size(), size)
+
+
+class FlakyBackend(object):
+    """Wraps a simulation, failing a given command as if udev were slow."""
+
+    def __init__(self, backend, fail_on, failures):
+        self.backend = backend
+        self.fail_on = fail_on
+        self.failures = failures
+        self.attempts = 0
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def run(self, cmd, **kwargs):
+        if all(arg in cmd for arg in self.fail_on):
+            self.attempts += 1
+            if self.attempts <= self.failures:
+                raise subprocess.CalledProcessError(
+                    1, cmd, 'mdadm: Cannot open {}: Device or resource busy\n'
+                    .format(cmd[-1]))
+        return self.backend.run(cmd, **kwargs)
+
+
+class LvmRaid5SimRetryTest(LvmRaid5SimTest):
+    """Transient failures are retried; others aren't."""
+
+    def test_retried(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        backend = FlakyBackend(self.backend, ['--add'], failures=2)
+        LvmRaidExec(['add', lv_name, sim_drive_names[6]], backend=backend)
+        self.assertEqual(backend.attempts, 3 + 1)  # Two arrays, one retried twice.
+        self.backend.sleep(3600)
+        self.assertEqual(set(self.array_states().values()), set(['clean']))
+
+    def test_gives_up(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        backend = FlakyBackend(self.backend, ['--add'], failures=100)
+        with self.assertRaises(subprocess.CalledProcessError):
+            LvmRaidExec(['add', lv_name, sim_drive_names[6]], backend=backend)
+        self.assertEqual(backend.attempts, LvmRaidExec.RETRIES + 1)
+
+
+class LvmRaid5SimProbeTest(LvmRaid5SimTest):
+    """--probe refuses drives much slower than the existing ones."""
+
+    def setUp(self):
+        super(LvmRaid5SimProbeTest, self).setUp()
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.backend.sleep(3600)
+        self.commands = []
+        run = self.backend.run
+        self.backend.run = lambda cmd, **kwargs: (self.commands.append(cmd) or
+                                                  run(cmd, **kwargs))
+
+    def slow_down(self, drive, factor):
+        self.backend.state['drives'][drive]['write_speed'] = (
+            self.backend.state['rate'] / factor)
+
+    def test_fast_drive(self):
+        self.run_lvmraid5(['add', '--probe', lv_name, sim_drive_names[6]])
+        # The new drive is write tested, the existing ones only read.
+        writes = [cmd for cmd in self.commands
+                  if cmd[0] == 'dd' and 'if=/dev/zero' in cmd]
+        self.assertEqual(set(arg for cmd in writes for arg in cmd
+                             if arg.startswith('of=')),
+                         set(['of=' + sim_drive_names[6]]))
+        self.assertEqual(len(self.array_states()), 3)
+
+    def test_slow_drive(self):
+        self.slow_down(sim_drive_names[6], 4)
+        before = repr(self.backend.state['arrays'])
+        with self.assertRaises(LvmRaidException):
+            self.run_lvmraid5(['add', '--probe', lv_name, sim_drive_names[6]])
+        self.assertEqual(repr(self.backend.state['arrays']), before)
+
+        self.run_lvmraid5(['add', '--probe', '--max-slowdown', '5', lv_name,
+                           sim_drive_names[6]])
+        self.assertNotEqual(repr(self.backend.state['arrays']), before)
+
+    def test_signature(self):
+        # A drive with no partitions but a whole-drive signature is only read.
+        self.backend.state['drives'][sim_drive_names[6]]['signature'] = 'linux_raid_member'
+        self.run_lvmraid5(['add', '--probe', lv_name, sim_drive_names[6]])
+        self.assertFalse([cmd for cmd in self.commands if 'if=/dev/zero' in cmd])
+        self.assertEqual(len(self.array_states()), 3)
+
+    def test_plan(self):
+        # Planning doesn't write to the drive, so doesn't notice.
+        self.slow_down(sim_drive_names[6], 4)
+        self.run_lvmraid5(['plan', '--probe', 'add', lv_name, sim_drive_names[6]])
+        self.assertFalse([cmd for cmd in self.commands if 'if=/dev/zero' in cmd])
+
+
+class LvmRaid5SimChunkTest(LvmRaid5SimTest):
+    """--chunk sets the chunk size, which arrays added later keep."""
+
+    def chunks(self):
+        # Mirrors have no chunk size.
+        return set(array['chunk'] for array in self.backend.state['arrays'].values()
+                   if array['level'] == 5)
+
+    def test_fixed(self):
+        self.run_lvmraid5(['create', '--chunk', '256', '--vg_name', vg_name,
+                           sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.assertEqual(self.chunks(), set([256]))
+        self.run_lvmraid5(['add', lv_name, sim_drive_names[6]])
+        self.run_lvmraid5(['add', lv_name, sim_drive_names[7]])
+        self.assertEqual(len(self.array_states()), 4)
+        # Mirrors converted to RAID5 only take the chunk size if it divides
+        # their size, otherwise keeping the 64K md gives them.
+        self.assertTrue(self.chunks() <= set([256, 64]))
+
+    def test_auto(self):
+        self.run_lvmraid5(['create', '--chunk', 'auto', '--vg_name', vg_name,
+                           sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        # Only the real arrays are left, not the scratch ones.
+        self.assertEqual(len(self.array_states()), 2)
+        chunks = self.chunks()
+        self.assertEqual(len(chunks), 1)
+        self.assertIn(chunks.pop(), LvmRaidExec.CHUNK_CANDIDATES)
+
+    def test_invalid(self):
+        with self.assertRaises(SystemExit):
+            self.run_lvmraid5(['create', '--chunk', '100', '--vg_name', vg_name,
+                               sim_drive_names[0], sim_drive_names[2]])
+
+
+class LvmRaid5SimMirrorTest(LvmRaid5SimTest):
+    """Two member arrays are mirrors, converted to RAID5 when they grow."""
+
+    def test(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        arrays = self.backend.state['arrays']
+        self.assertEqual([(array['level'], array['raid_devices'])
+                          for _, array in sorted(arrays.items())],
+                         [(5, 3), (1, 2)])
+        size = self.lv_size()
+
+        self.run_lvmraid5(['add', lv_name, sim_drive_names[6]])
+        self.assertEqual((arrays['/dev/md1']['level'],
+                          arrays['/dev/md1']['raid_devices']), (5, 3))
+        self.assertGreater(self.lv_size(), size)
+
+
+class LvmRaid5SimFilesystemTest(LvmRaid5SimTest):
+    """--resize-fs grows the filesystem and updates its stripe geometry."""
+
+    def setUp(self):
+        super(LvmRaid5SimFilesystemTest, self).setUp()
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.backend.sleep(3600)
+
+    def fs(self):
+        return self.backend.state['lvs'][lv_name[len('/dev/'):]]['fs']
+
+    def add(self, *args):
+        # Adding both large drives leaves a three-member tier holding the
+        # most data, while the original tier is the widest.
+        for drive_name in sim_drive_names[6:8]:
+            self.run_lvmraid5(['add', '--resize-fs'] + list(args) +
+                              [lv_name, drive_name])
+            self.backend.sleep(3600)
+
+    def test_dominant(self):
+        self.backend.make_filesystem(lv_name, 'ext4', '/mnt/data')
+        self.add()
+        self.assertEqual(self.fs()['blocks'] * 4096,
+                         self.lv_size() * SimulatedBackend.EXTENT_SIZE)
+        # The dominant tier started as a mirror, so has the 64K chunks md
+        # gave it on conversion: 16 4K blocks, with two data members.
+        self.assertEqual((self.fs()['stripe_unit'], self.fs()['stripe_width']),
+                         (16, 2 * 16))
+
+    def test_widest(self):
+        self.backend.make_filesystem(lv_name, 'ext4')
+        self.add('--fs-geometry', 'widest')
+        self.assertEqual((self.fs()['stripe_unit'], self.fs()['stripe_width']),
+                         (128, 4 * 128))
+
+    def test_xfs(self):
+        # XFS is grown, but only takes a new geometry when mounted.
+        self.backend.make_filesystem(lv_name, 'xfs', '/mnt/data')
+        self.add()
+        self.assertEqual(self.fs()['blocks'] * 4096,
+                         self.lv_size() * SimulatedBackend.EXTENT_SIZE)
+        self.assertEqual(self.fs()['stripe_unit'], 0)
+
+    def test_unsupported(self):
+        # Nothing is changed if the filesystem can't be resized.
+        before = repr(self.backend.state['arrays'])
+        with self.assertRaises(LvmRaidException):
+            self.run_lvmraid5(['add', '--resize-fs', lv_name, sim_drive_names[6]])
+        self.backend.make_filesystem(lv_name, 'xfs')
+        with self.assertRaises(LvmRaidException):
+            self.run_lvmraid5(['add', '--resize-fs', lv_name, sim_drive_names[6]])
+        self.assertEqual(repr(self.backend.state['arrays']), before)
+
+
+class LvmRaid5SimScrubTest(LvmRaid5SimTest):
+    """Scrubs carry on where the last one stopped, and record mismatches."""
+
+    def setUp(self):
+        super(LvmRaid5SimScrubTest, self).setUp()
+        self.history_file = tempfile.NamedTemporaryFile(suffix='.db')
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.backend.sleep(3600)
+
+    def scrub(self, *args):
+        self.run_lvmraid5(['--history-db', self.history_file.name, 'scrub',
+                           '--window-size', '50M'] + list(args) + [lv_name])
+        return OperationHistory(None, self.history_file.name).scrubs()
+
+    def test_resume(self):
+        self.backend.state['arrays']['/dev/md1']['bad'] = [100 * 1000 * 1000]
+        first = self.scrub('--budget', '200M')
+        self.assertLessEqual(sum(window['end'] - window['start']
+                                 for window in first), 200 * 1000 * 1000)
+
+        # The second scrub carries on from there, so the first pass over every
+        # array checks it end to end without gaps or overlaps.
+        windows = self.scrub()
+        for name, array in self.backend.state['arrays'].items():
+            ranges = [(window['start'], window['end']) for window in windows
+                      if window['array'] == name]
+            self.assertEqual(ranges[0][0], 0)
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                if end == array['component_size']:
+                    break
+                self.assertEqual(end, start)
+            else:
+                self.assertEqual(ranges[-1][1], array['component_size'])
+        for name, array in self.backend.state['arrays'].items():
+            self.assertIsNone(array['op'])
+            self.assertIsNone(array['sync_max'])
+
+        # Only the window with the mismatch is repaired.
+        bad = [window for window in windows if window['mismatches']]
+        self.assertEqual(len(bad), 1)
+        self.assertEqual(bad[0]['array'], '/dev/md1')
+        repairs = self.scrub('--repair')[len(windows):]
+        self.assertEqual([(window['start'], window['end']) for window in repairs],
+                         [(bad[0]['start'], bad[0]['end'])])
+        self.assertEqual(self.backend.state['arrays']['/dev/md1']['bad'], [])
+        self.assertEqual(len(self.scrub('--repair')), len(windows) + 1)
+
+    def test_add(self):
+        # An add pauses a check it finds running, rather than failing on it.
+        self.backend.write_file('/sys/block/md0/md/sync_action', 'check\n')
+        self.backend.sleep(1)
+        self.run_lvmraid5(['add', lv_name, sim_drive_names[6]])
+        self.assertEqual(len(self.backend.state['arrays']['/dev/md0']['members']), 4)
+        self.assertGreater(self.backend.state['arrays']['/dev/md0']['sync_min'], 0)
+
+    def test_paused(self):
+        # Another operation pauses the scrub part way through its first window.
+        sleep = self.backend.sleep
+
+        def pause(seconds, **kwargs):
+            sleep(seconds, **kwargs)
+            if self.backend.state['arrays']['/dev/md0']['op'] is not None:
+                self.backend.write_file('/sys/block/md0/md/sync_action', 'idle\n')
+        self.backend.sleep = pause
+        paused = [window for window in self.scrub('--max-speed', '1')
+                  if window['array'] == '/dev/md0']
+        self.backend.sleep = sleep
+        self.assertEqual(len(paused), 1)
+        self.assertEqual(paused[0]['start'], 0)
+        self.assertLess(paused[0]['end'], 50 * 1000 * 1000)
+        self.assertGreater(paused[0]['end'], 0)
+
+        # The next scrub carries on from there.
+        windows = [window for window in self.scrub() if window['array'] == '/dev/md0']
+        self.assertEqual(windows[1]['start'], paused[0]['end'])
+
+    def test_groups(self):
+        def array(name, *drives):
+            return {'name': name, 'members': [{'drive': drive} for drive in drives]}
+        arrays = [array('/dev/md0', 'a', 'b', 'c'), array('/dev/md1', 'c', 'd', 'e'),
+                  array('/dev/md2', 'd', 'e', 'f'), array('/dev/md3', 'f', 'g', 'h')]
+        names = lambda groups: [[array['name'] for array in group] for group in groups]
+        self.assertEqual(names(Scrubber(None, lv_name).groups(arrays)),
+                         [['/dev/md0', '/dev/md2'], ['/dev/md1', '/dev/md3']])
+        self.assertEqual(names(Scrubber(None, lv_name, serial=True).groups(arrays)),
+                         [[array['name']] for array in arrays])
+
+
+class LvmRaid5SimTuneTest(LvmRaid5SimTest):
+    """Tuning profiles set read-ahead from stripe widths, and the drives' queues."""
+
+    def queue(self, device, attr):
+        return self.backend.queue_attrs()[os.path.basename(device)][attr]
+
+    def test_grow(self):
+        self.run_lvmraid5(['create', '--tune', 'throughput', '--vg_name', vg_name,
+                           sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        # Four stripes of two 512K data chunks.  The mirror has no stripes,
+        # so gets the minimum, and the LV reads ahead as far as either.
+        self.assertEqual(self.queue('/dev/md0', 'queue/read_ahead_kb'), 4 * 2 * 512)
+        self.assertEqual(self.queue('/dev/md1', 'queue/read_ahead_kb'), 1024)
+        self.assertEqual(self.queue('/dev/dm-0', 'queue/read_ahead_kb'), 4 * 2 * 512)
+        self.assertEqual(self.queue(sim_drive_names[0], 'queue/nr_requests'), 256)
+
+        # Growing md0 widens its stripes, and the LV follows.
+        self.run_lvmraid5(['add', '--tune', 'throughput', lv_name, sim_drive_names[6]])
+        self.assertEqual(self.queue('/dev/md0', 'queue/read_ahead_kb'), 4 * 3 * 512)
+        self.assertEqual(self.queue('/dev/dm-0', 'queue/read_ahead_kb'), 4 * 3 * 512)
+        self.assertEqual(self.queue(sim_drive_names[6], 'queue/nr_requests'), 256)
+
+    def test_show(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.run_lvmraid5(['tune', '--show', '--profile', 'latency', lv_name])
+        self.assertNotIn('queues', self.backend.state)
+
+        self.run_lvmraid5(['tune', '--profile', 'latency', lv_name])
+        self.assertEqual(self.queue(sim_drive_names[0], 'queue/scheduler'), 'bfq')
+        self.assertEqual(self.queue(sim_drive_names[0], 'device/queue_depth'), 8)
+        self.assertEqual(self.queue('/dev/md0', 'queue/read_ahead_kb'), 2 * 512)
+        settings = StackTuner(self.run_lvmraid5(['status', lv_name]), lv_name,
+                              'latency').settings()
+        self.assertEqual([setting for setting in settings
+                          if setting['current'] != setting['recommended']], [])
+
+
+class LvmRaid5SimCacheTest(LvmRaid5SimTest):
+    """Discovery is cached until something changes it, and never goes stale."""
+
+    def test_add(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        lvmexec = self.run_lvmraid5(['add', lv_name, sim_drive_names[6]])
+        cache = lvmexec.query_cache
+        self.assertGreater(cache.hits, 0)
+        self.assertEqual(cache.spawns_avoided, cache.hits)
+
+        # The objects built up during the add match a fresh look.
+        fresh = self.run_lvmraid5(['status', lv_name])
+        for name in self.backend.state['arrays']:
+            self.assertEqual(sorted(lvmexec.find_or_create(RaidArray, name).members),
+                             sorted(fresh.find_or_create(RaidArray, name).members))
+        self.assertEqual(
+            sorted(lvmexec.find_or_create(HardDrive, sim_drive_names[6]).partitions),
+            sorted(fresh.find_or_create(HardDrive, sim_drive_names[6]).partitions))
+
+    def test_invalidate(self):
+        cache = QueryCache()
+        queries = []
+
+        def query(result):
+            return lambda: queries.append(result) or result
+
+        self.assertEqual(cache.get('/dev/sdb', 'fdisk', query(1)), 1)
+        self.assertEqual(cache.get('/dev/sdb', 'fdisk', query(2)), 1)
+        cache.invalidate(names=['/dev/sdb'])
+        self.assertEqual(cache.get('/dev/sdb', 'fdisk', query(3)), 3)
+        self.assertEqual(queries, [1, 3])
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # A query which was running when its object changed isn't kept.
+        cache.get('vg', 'vgdisplay', lambda: cache.invalidate(sources=['vgdisplay']))
+        self.assertEqual(cache.get('vg', 'vgdisplay', query(4)), 4)
+
+
+class LvmRaid5SimApiTest(LvmRaid5SimTest):
+    """The library API runs commands in the background, reporting progress."""
+
+    def test_add(self):
+        lvmraid5.create(vg_name, [sim_drive_names[0], sim_drive_names[2],
+                                  sim_drive_names[4]],
+                        backend=self.backend).result()
+        size = self.lv_size()
+        events = []
+        operation = lvmraid5.add(lv_name, sim_drive_names[6], backend=self.backend,
+                                 on_progress=events.append)
+        operation.result()
+        self.assertTrue(operation.done())
+        self.assertEqual(operation.status, 'ok')
+        self.assertGreater(self.lv_size(), size)
+
+        # A step event for each step, in order, and progress while reshaping.
+        steps = [event['step'] for event in events if event['step'] is not None]
+        self.assertEqual(steps, list(range(1, events[0]['steps'] + 1)))
+        reshapes = [event for event in events if event['phase'] == 'reshape']
+        self.assertTrue(reshapes)
+        for event in reshapes:
+            self.assertIn(event['array'], self.backend.state['arrays'])
+            self.assertTrue(0 <= event['percent'] <= 100)
+        self.assertEqual(operation.events, events)
+
+    def test_concurrent(self):
+        # Creating VGs on different drives can go ahead together.
+        operations = [
+            lvmraid5.create(vg_name, [sim_drive_names[0], sim_drive_names[2],
+                                      sim_drive_names[4]], backend=self.backend),
+            lvmraid5.create('/dev/jjl_vg2', [sim_drive_names[1], sim_drive_names[3],
+                                             sim_drive_names[5]], backend=self.backend)]
+        for operation in operations:
+            operation.result()
+        self.assertEqual(sorted(self.backend.state['vgs']), ['jjl_vg1', 'jjl_vg2'])
+
+        # But not two operations on one VG.  The first is held up at its first
+        # event until the second has been tried.
+        release = threading.Event()
+        first = lvmraid5.add(lv_name, sim_drive_names[6], backend=self.backend,
+                             on_progress=lambda event: release.wait())
+        with self.assertRaises(LvmRaidException):
+            lvmraid5.add(lv_name, sim_drive_names[7], backend=self.backend)
+        release.set()
+        first.result()
+
+    def test_cancel(self):
+        lvmraid5.create(vg_name, [sim_drive_names[0], sim_drive_names[2],
+                                  sim_drive_names[4]], backend=self.backend).result()
+
+        def on_progress(event):
+            if event['phase'] == 'reshape':
+                operation.cancel()
+
+        operation = lvmraid5.add(lv_name, sim_drive_names[6], backend=self.backend,
+                                 on_progress=on_progress)
+        with self.assertRaises(LvmRaidCancelled):
+            operation.result()
+        self.assertEqual(operation.status, 'cancelled')
+        self.assertIsInstance(operation.exception(), LvmRaidCancelled)
+        self.assertFalse(operation.cancel())
+
+
+class LvmRaid5SimAssembleTest(LvmRaid5SimTest):
+    """Arrays are listed in mdadm.conf, and assembled from it."""
+
+    def setUp(self):
+        super(LvmRaid5SimAssembleTest, self).setUp()
+        conf_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, conf_dir)
+        self.conf = os.path.join(conf_dir, 'mdadm.conf')
+        with open(self.conf, 'w') as f:
+            f.write('DEVICE partitions\nMAILADDR root\n')
+
+    def run_lvmraid5(self, args):
+        return LvmRaidExec(['--mdadm-conf', self.conf] + args, backend=self.backend)
+
+    def listed(self):
+        """The arrays listed for the VG, and their UUIDs."""
+        vgs = MdadmConfig(self.conf).vgs()
+        self.assertEqual(list(vgs), ['jjl_vg1'])
+        return dict((device, MdadmConfig(self.conf).uuid_of(device))
+                    for device in vgs['jjl_vg1']['pvs'])
+
+    def test_sync(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        arrays = self.backend.state['arrays']
+        self.assertEqual(self.listed(), dict((name, array['uuid'])
+                                             for name, array in arrays.items()))
+
+        # A new array from a larger drive is listed too, and the rest of the
+        # file is left alone.
+        before = len(arrays)
+        self.run_lvmraid5(['add', lv_name, sim_drive_names[6]])
+        self.assertGreater(len(arrays), before)
+        self.assertEqual(self.listed(), dict((name, array['uuid'])
+                                             for name, array in arrays.items()))
+        with open(self.conf) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[:2], ['DEVICE partitions', 'MAILADDR root'])
+        self.assertEqual(len([line for line in lines if line.startswith('ARRAY')]),
+                         len(self.listed()))
+
+    def test_conflicts(self):
+        # An old line from mdadm --detail --scan, left outside the section.
+        stale = 'ARRAY /dev/md0 metadata=1.2 name=old:0 UUID=01234567:89abcdef:01234567:89abcdef'
+        with open(self.conf, 'a') as f:
+            f.write(stale + '\n')
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        conf = MdadmConfig(self.conf)
+        arrays = [{'device': name, 'uuid': array['uuid']}
+                  for name, array in self.backend.state['arrays'].items()]
+        self.assertEqual(conf.conflicts(arrays), [stale])
+        self.assertEqual(conf.conflicts([{'device': '/dev/md9',
+                                          'uuid': '01234567:89ABCDEF:01234567:89ABCDEF'}]),
+                         [stale])
+        self.assertEqual(conf.conflicts([{'device': '/dev/md9', 'uuid': 'x'}]), [])
+
+        # The section's own lines give the metadata version from mdadm --detail.
+        for lines in conf.vgs()['jjl_vg1']['arrays']:
+            self.assertIn(' metadata=1.2 ', lines)
+
+    def test_assemble(self):
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[4]])
+        self.backend.sleep(3600)
+        arrays = dict((name, array['uuid'])
+                      for name, array in self.backend.state['arrays'].items())
+        members = sum(len(array['members'])
+                      for array in self.backend.state['arrays'].values())
+        self.backend.shutdown()
+
+        output = []
+        LvmRaidExec(['--mdadm-conf', self.conf, 'assemble'], backend=self.backend,
+                    output=output)
+        # Each array comes back under the same name.
+        self.assertEqual(dict((name, array['uuid'])
+                              for name, array in self.backend.state['arrays'].items()),
+                         arrays)
+        self.assertTrue(self.backend.state['vgs']['jjl_vg1']['active'])
+        self.assertEqual(output, ['jjl_vg1: assembled {} arrays in {:.2f}s, '
+                                  'activated in 0.00s'.format(
+                                      len(arrays),
+                                      SimulatedBackend.ASSEMBLE_TIME * members)])
+
+        # Nothing to do a second time, but the VG is activated again.
+        self.run_lvmraid5(['assemble', vg_name])
+        with self.assertRaises(LvmRaidException):
+            self.run_lvmraid5(['assemble', '/dev/jjl_vg2'])
+
+
+class LvmRaid5SimRebuildTest(LvmRaid5SimTest):
+    """replace rebuilds the arrays holding data first, and recreates the rest."""
+
+    def setUp(self):
+        super(LvmRaid5SimRebuildTest, self).setUp()
+        self.commands = []
+        self.writes = []
+        run = self.backend.run
+        self.backend.run = lambda cmd, **kwargs: (self.commands.append(cmd) or
+                                                  run(cmd, **kwargs))
+        write_file = self.backend.write_file
+        self.backend.write_file = lambda path, text: (
+            self.writes.append((path, text.strip())) or write_file(path, text))
+
+        # Three arrays: /dev/md0 with four members, /dev/md1 with three and
+        # /dev/md2 with two, all with a member on the drive removed.
+        self.create([sim_drive_names[0], sim_drive_names[2], sim_drive_names[6],
+                      sim_drive_names[7]])
+        self.backend.sleep(3600)
+
+    def index(self, *args):
+        """The index of the first command with all of args."""
+        return [ii for ii, cmd in enumerate(self.commands)
+                if all(arg in cmd for arg in args)][0]
+
+    def test_free(self):
+        # Shrink the LV to /dev/md0, so that the other arrays hold no data.
+        lv = self.backend.state['lvs'][lv_name[len('/dev/'):]]
+        lv['extents'] = self.backend.state['pvs']['/dev/md0']['extents']
+        self.run_lvmraid5(['remove', lv_name, sim_drive_names[7]])
+        del self.commands[:]
+        self.run_lvmraid5(['replace', lv_name, sim_drive_names[8]])
+
+        # Only /dev/md0 is rebuilt, at high priority.
+        self.assertEqual([cmd[1] for cmd in self.commands if '--add' in cmd],
+                         ['/dev/md0'])
+        self.assertEqual([text for path, text in self.writes
+                          if path == '/sys/block/md0/md/sync_speed_min'],
+                         [str(RaidArray.HIGH_PRIORITY_SPEED), 'system'])
+
+        # The others are recreated without a rebuild, after it.
+        for array in ('/dev/md1', '/dev/md2'):
+            self.assertGreater(self.index('--create', array, '--assume-clean'),
+                               self.index('--add', '/dev/md0'))
+        self.assertEqual(sorted(self.backend.state['vgs']['jjl_vg1']['pvs']),
+                         ['/dev/md0', '/dev/md1', '/dev/md2'])
+        self.assertEqual(lv['extents'], self.backend.state['pvs']['/dev/md0']['extents'])
+
+        # The RAID5 then has its parity repaired in the background.
+        arrays = self.backend.state['arrays']
+        self.assertEqual(arrays['/dev/md1']['op']['action'], 'repair')
+        self.assertIsNone(arrays['/dev/md2']['op'])
+        self.backend.sleep(3600)
+        self.assertEqual(set(self.array_states().values()), set(['clean']))
+
+    def test_order(self):
+        # With every array full, the one with the least to rebuild for the
+        # data it holds goes first: the most members.
+        self.run_lvmraid5(['remove', lv_name, sim_drive_names[7]])
+        self.run_lvmraid5(['replace', lv_name, sim_drive_names[8]])
+        self.assertEqual([cmd[1] for cmd in self.commands if '--add' in cmd],
+                         ['/dev/md0', '/dev/md1', '/dev/md2'])
+        self.assertFalse([cmd for cmd in self.commands if '--assume-clean' in cmd])
+
+
+class LayoutTest(unittest.TestCase):
+    """The layout engine, on drives of any size."""
+    TB = 1000 ** 4
+
+    def test_subset_sum(self):
+        self.assertEqual(best_subset_sum([3, 5, 7], 12), [1, 2])
+        self.assertEqual(best_subset_sum([3, 5, 7], 100), [0, 1, 2])
+        self.assertEqual(best_subset_sum([3, 5, 7], 2), [])
+        # Large sizes are searched in steps, but never overfilled.
+        sizes = [self.TB + ii * 7919 for ii in range(20)]
+        chosen = best_subset_sum(sizes, 10 * self.TB + 50000)
+        self.assertEqual(len(chosen), 9)
+
+    def test_create(self):
+        # Tiers at each distinct size use all but the largest drive.
+        sizes = [1, 1, 3, 4, 4, 8, 12]
+        layout = compute_layout([], [{'name': str(ii), 'free': size * self.TB}
+                                     for ii, size in enumerate(sizes)])
+        self.assertEqual(layout['capacity'], (sum(sizes) - max(sizes)) * self.TB)
+        self.assertEqual([tier['member_size'] for tier in layout['new_tiers']],
+                         [self.TB, 2 * self.TB, self.TB, 4 * self.TB])
+
+    def test_join(self):
+        # A drive which matches no tier joins the subset filling it best.
+        tiers = [{'member_size': 1 * self.TB, 'drives': ['a', 'b', 'c'], 'clean': True},
+                 {'member_size': 2 * self.TB, 'drives': ['b', 'c'], 'clean': True},
+                 {'member_size': 2 * self.TB, 'drives': ['c', 'd'], 'clean': True}]
+        layout = compute_layout(tiers, [{'name': 'new', 'free': 9 * self.TB // 2}])
+        self.assertEqual(layout['joins']['new'], [1, 2])
+        self.assertEqual(layout['capacity'], 4 * self.TB)
+
+        # Degraded tiers are only joined to rebuild them.
+        tiers[0]['clean'] = False
+        layout = compute_layout(tiers, [{'name': 'new', 'free': 5 * self.TB,
+                                         'required': [0]}])
+        self.assertEqual(layout['joins']['new'], [0, 1, 2])
+
+    def test_leftovers(self):
+        # Space left over on several drives makes a multi-member tier.
+        tiers = [{'member_size': 2 * self.TB, 'drives': ['a', 'b'], 'clean': True}]
+        layout = compute_layout(tiers, [{'name': 'new', 'free': 5 * self.TB},
+                                        {'name': 'c', 'free': 3 * self.TB},
+                                        {'name': 'd', 'free': 3 * self.TB}])
+        self.assertEqual(layout['joins'], {'new': [0], 'c': [0], 'd': [0]})
+        self.assertEqual(layout['new_tiers'],
+                         [{'member_size': self.TB, 'drives': ['new', 'c', 'd']}])
+        self.assertEqual(layout['leftover'], {'new': 2 * self.TB, 'c': 0, 'd': 0})
+
+
+class RealBackendTest(unittest.TestCase):
+    """Running commands: these only run harmless shell commands."""
+
+    def setUp(self):
+        self.backend = RealBackend()
+
+    def test_streamed_output(self):
+        lines = []
+        output = self.backend.run(['sh', '-c', 'echo one; echo two >&2'],
+                                  on_output=lines.append)
+        self.assertEqual(output, 'one\ntwo\n')
+        self.assertEqual(lines, ['one\n', 'two\n'])
+
+    def test_failure(self):
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            self.backend.run(['sh', '-c', 'echo oops; exit 3'])
+        self.assertEqual(cm.exception.returncode, 3)
+        self.assertEqual(cm.exception.output, 'oops\n')
+
+    def test_output_tail(self):
+        # Only the end of long output is kept, unless all of it is asked for.
+        limit = RealBackend.OUTPUT_TAIL_LINES
+        output = self.backend.run(['seq', str(limit * 2)])
+        self.assertEqual(output.split(), [str(ii) for ii in range(limit + 1, limit * 2 + 1)])
+        output = self.backend.run(['seq', str(limit * 2)], full_output=True)
+        self.assertEqual(len(output.split()), limit * 2)
+
+    def test_timeout(self):
+        with self.assertRaises(LvmRaidTimeout):
+            self.backend.run(['sleep', '30'], timeout=0.2)
+
+    def test_cancel(self):
+        cancel = threading.Event()
+        threading.Timer(0.2, cancel.set).start()
+        with self.assertRaises(LvmRaidCancelled):
+            self.backend.run(['sleep', '30'], cancel=cancel)
+        with self.assertRaises(LvmRaidCancelled):
+            self.backend.sleep(30, cancel=cancel)
+
+
+
+class LoggingTest(unittest.TestCase):
+    """Logging is written in the background, and long output is cut short."""
+
+    def test_background_handler(self):
+        records = []
+        target = logging.Handler()
+        target.emit = records.append
+        handler = BackgroundLogHandler(target)
+        logger = logging.getLogger('lvmraid5.test')
+        # Keep the records from the program's own handlers.
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            for ii in range(100):
+                logger.warning('line %d', ii)
+            handler.flush()
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        self.assertEqual([record.msg for record in records],
+                         ['line {}'.format(ii) for ii in range(100)])
+        self.assertFalse(handler.thread.is_alive())
+
+    def test_dropped_records(self):
+        # With the writer stuck, records beyond the queue are dropped rather
+        # than holding up logging, and counted once there's room.
+        records = []
+        writing = threading.Event()
+        stuck = threading.Event()
+
+        def emit(record):
+            writing.set()
+            stuck.wait()
+            records.append(record)
+        target = logging.Handler()
+        target.emit = emit
+        handler = BackgroundLogHandler(target)
+        logger = logging.getLogger('lvmraid5.test')
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            logger.warning('first')
+            writing.wait()
+            for ii in range(BackgroundLogHandler.QUEUE_SIZE + 9):
+                logger.warning('line %d', ii)
+            stuck.set()
+            handler.flush()
+            logger.warning('after')
+            handler.flush()
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+        self.assertEqual(records[-2].getMessage(),
+                         '(9 log records dropped: the log fell behind)')
+        self.assertEqual(records[-1].getMessage(), 'after')
+
+    def test_named_logger(self):
+        # The program's handlers go on its own logger, leaving the root
+        # logger of a program using the library API alone.
+        root_handlers = list(logging.getLogger('').handlers)
+        LvmRaidExec(['create', '--vg_name', vg_name, sim_drive_names[0],
+                     sim_drive_names[2]], backend=SimulatedBackend(sim_drive_sizes))
+        logger = logging.getLogger(lvmraid5.LOGGER_NAME)
+        self.assertTrue(logger.handlers)
+        self.assertFalse(logger.propagate)
+        self.assertEqual(logging.getLogger('').handlers, root_handlers)
+
+    def test_bounded_output(self):
+        lvmexec = LvmRaidExec(['create', '--vg_name', vg_name,
+                               sim_drive_names[0], sim_drive_names[2]],
+                              backend=SimulatedBackend(sim_drive_sizes))
+        lvmexec.backend = RealBackend()
+        limit = LvmRaidExec.LOGGED_OUTPUT_LINES
+        lines = []
+        output = lvmexec.run_cmd(['seq', '100'], log=lines.append)
+        self.assertEqual(len(output.splitlines()), 100)
+        self.assertEqual(lines[1:limit + 1],
+                         ['> {}'.format(ii + 1) for ii in range(limit)])
+        self.assertEqual(lines[limit + 1:],
+                         ['> ({} more lines not logged)'.format(100 - limit)])
+
+        # All of the output of a failed command is logged.
+        lines = []
+        with self.assertRaises(subprocess.CalledProcessError):
+            lvmexec.run_cmd(['sh', '-c', 'seq 100; exit 1'], log=lines.append)
+        self.assertEqual([line for line in lines if line.startswith('> ')],
+                         ['> {}'.format(ii + 1) for ii in range(100)])
+
+
 if __name__ == '__main__':
     unittest.main()